@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+"""Async (ASGI) serving mode for the lookup endpoints.
+
+Serves /, /detail, /pin/<lat>/<lon>, /batch and /map. Run with an ASGI server:
+
+    hypercorn asgi:app
+"""
+
+import asyncio
+import typing
+from time import time
+
+from pygments.formatters import HtmlFormatter
+from quart import Quart, jsonify, redirect, render_template, request, url_for
+from werkzeug.wrappers import Response
+
+import geocode
+from geocode import aio, cache, formats, mail, points, sparql, upstream, wikidata
+
+app = Quart(__name__)
+app.config.from_object("config.default")
+app.jinja_env.filters["highlight_sparql"] = sparql.highlight_sparql
+upstream.configure(app.config)
+cache.configure(app.config)
+wikidata.configure(app.config)
+mail.start_queue(app.config)
+logging_enabled = True
+
+
+@app.before_serving
+async def startup() -> None:
+    """Create HTTP client and database engine within the event loop."""
+    app.extensions["lookup"] = aio.AsyncLookup(app.config)
+
+
+@app.after_serving
+async def shutdown() -> None:
+    """Close HTTP client and database engine."""
+    await get_lookup().close()
+
+
+def get_lookup() -> aio.AsyncLookup:
+    """Async lookup for this app."""
+    return typing.cast(aio.AsyncLookup, app.extensions["lookup"])
+
+
+def coords_error(lat: float, lon: float) -> wikidata.WikidataDict | None:
+    """Error for coordinates outside the valid range."""
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return None
+    return {
+        "coords": {"lat": lat, "lon": lon},
+        "error": "lat must be between -90 and 90, "
+        + "and lon must be between -180 and 180",
+    }
+
+
+async def lookup_result(lat: float, lon: float) -> wikidata.WikidataDict:
+    """Lookup lat/lon and return the API result."""
+    if error := coords_error(lat, lon):
+        return error
+    reply = await get_lookup().lat_lon_to_wikidata(lat, lon)
+    result: wikidata.WikidataDict = reply["result"]
+    result.pop("element", None)
+    return result
+
+
+@app.route("/")
+async def index() -> str | Response | tuple[Response, int]:
+    """Index page."""
+    t0 = time()
+    q = request.args.get("q")
+    if q and q.strip():
+        lat_str, lon_str = [v.strip() for v in q.split(",", 1)]
+        return redirect(url_for("detail_page", lat=lat_str, lon=lon_str))
+
+    lat_str, lon_str = request.args.get("lat"), request.args.get("lon")
+
+    if lat_str is None or lon_str is None:
+        samples = sorted(geocode.samples, key=lambda row: row[2])
+        return await render_template("index.html", samples=samples)
+
+    lat, lon = float(lat_str), float(lon_str)
+    if error := coords_error(lat, lon):
+        return jsonify(error)
+    try:
+        selected = formats.parse_fields(request.args.get("fields"))
+    except formats.FieldError as e:
+        return jsonify(error=str(e)), 400
+
+    result = await lookup_result(lat, lon)
+    if logging_enabled:
+        remote_addr = request.headers.get("X-Forwarded-For", request.remote_addr)
+        response_time_ms = int((time() - t0) * 1000)
+        await get_lookup().log_lookup(lat, lon, remote_addr, result, response_time_ms)
+    return jsonify(formats.select_fields(result, selected))
+
+
+@app.route("/batch", methods=["POST"])
+async def batch() -> Response | tuple[Response, int]:
+    """Lookup a list of [lat, lon] points concurrently.
+
+    Results are JSON, NDJSON or MessagePack, chosen by the format argument or
+    the Accept header.
+    """
+    max_points = app.config.get("BATCH_MAX_POINTS", 1000)
+    try:
+        coords = points.parse_batch(await request.get_json(silent=True), max_points)
+        selected = formats.parse_fields(request.args.get("fields"))
+        fmt = formats.pick_format(
+            request.args.get("format"),
+            request.accept_mimetypes.best_match(formats.content_types.values()),
+        )
+    except (points.PointsError, formats.FieldError) as e:
+        return jsonify(error=str(e)), 400
+
+    limit = asyncio.Semaphore(app.config.get("BATCH_CONCURRENCY", 16))
+
+    async def lookup_point(lat: float, lon: float) -> wikidata.WikidataDict:
+        async with limit:
+            return await lookup_result(lat, lon)
+
+    results = await asyncio.gather(*(lookup_point(lat, lon) for lat, lon in coords))
+    selected_results = [formats.select_fields(r, selected) for r in results]
+    return app.response_class(
+        formats.serialise_batch(selected_results, fmt),
+        content_type=formats.content_types[fmt],
+    )
+
+
+@app.route("/detail")
+async def detail_page() -> str | Response:
+    """Detail page, without the boundary outline the sync app draws."""
+    lat_str, lon_str = request.args.get("lat"), request.args.get("lon")
+    if lat_str is None or lon_str is None:
+        return redirect(url_for("index"))
+    lat, lon = float(lat_str), float(lon_str)
+    if coords_error(lat, lon):
+        error = (
+            "latitude must be between -90 and 90, "
+            + "and longitude must be between -180 and 180"
+        )
+        return await render_template("query_error.html", lat=lat, lon=lon, error=error)
+
+    try:
+        reply = await get_lookup().lat_lon_to_wikidata(lat, lon)
+    except wikidata.QueryError as e:
+        query, r = e.args
+        return await render_template(
+            "query_error.html", lat=lat, lon=lon, query=query, r=r
+        )
+    element = reply["result"].pop("element", None)
+
+    css = HtmlFormatter().get_style_defs(".highlight")
+
+    return await render_template(
+        "detail.html",
+        lat=lat,
+        lon=lon,
+        str=str,
+        element_id=element,
+        geojson=None,
+        css=css,
+        **reply,
+    )
+
+
+@app.route("/pin/<lat>/<lon>")
+async def pin_detail(lat: str, lon: str) -> Response:
+    """Details for map pin location."""
+    reply = await get_lookup().lat_lon_to_wikidata(float(lat), float(lon))
+    element = reply["result"].pop("element", None)
+
+    css = HtmlFormatter().get_style_defs(".highlight")
+
+    html = await render_template(
+        "pin_detail.html",
+        lat=lat,
+        lon=lon,
+        str=str,
+        element_id=element,
+        css=css,
+        **reply,
+    )
+
+    return jsonify(html=html)
+
+
+@app.route("/map")
+async def map_page() -> str:
+    """Map page."""
+    css = HtmlFormatter().get_style_defs(".highlight")
+    return await render_template("map.html", css=css)
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0")
@@ -0,0 +1,373 @@
+"""Async lookup for the ASGI serving mode.
+
+Mirrors the synchronous lookup in lookup.py, using httpx for Wikidata, asyncpg
+for the database and a semaphore per upstream to cap concurrent calls.
+"""
+
+import asyncio
+import json
+import socket
+import typing
+from collections.abc import Awaitable, Callable
+
+import backoff
+import backoff.types
+import httpx
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from . import (
+    cache,
+    data_version,
+    headers,
+    mail,
+    model,
+    scotland,
+    sparql,
+    upstream,
+    wikidata,
+)
+from .boundaries import Boundary, BoundaryIndex, parse_admin_level
+from .upstream import UpstreamUnavailable
+from .wikidata import APIResponseError, Hit, QueryError, Row
+
+Config = typing.Mapping[str, typing.Any]
+T = typing.TypeVar("T")
+Element = model.Polygon | Boundary
+StrDict = dict[str, typing.Any]
+
+
+def giveup(details: backoff.types.Details) -> None:
+    """Queue mail to admin about API call failure."""
+    last_exception = details["exception"]  # type: ignore
+    if last_exception and isinstance(last_exception, APIResponseError):
+        status = last_exception.response.status_code
+        if not mail.due(f"api call {status}", wikidata.giveup_mail_interval):
+            return
+        body = f"Error making Wikidata API call\n\n{last_exception.response.text}"
+        lookup: AsyncLookup = details["args"][0]
+        kind = type(last_exception).__name__
+        mail.send_to_admin("Geocode error", body, lookup.config, kind=kind)
+
+
+def async_db_url(config: Config) -> str:
+    """Database URL using the asyncpg driver."""
+    if config.get("ASYNC_DB_URL"):
+        return typing.cast(str, config["ASYNC_DB_URL"])
+    url = make_url(config["DB_URL"]).set(drivername="postgresql+asyncpg")
+    return url.render_as_string(hide_password=False)
+
+
+class AsyncLookup:
+    """Shared HTTP client, database engine and per-upstream concurrency limits."""
+
+    def __init__(self, config: Config) -> None:
+        """Create clients, must be called from within the event loop."""
+        self.config = config
+        self.http = httpx.AsyncClient(
+            headers=headers, timeout=config.get("HTTP_TIMEOUT", 60)
+        )
+        self.engine = create_async_engine(
+            async_db_url(config),
+            pool_size=config.get("ASYNC_DB_POOL_SIZE", 20),
+            pool_recycle=3600,
+        )
+        self.db_session = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self.wdqs_limit = asyncio.Semaphore(config.get("WDQS_CONCURRENCY", 8))
+        self.api_limit = asyncio.Semaphore(config.get("API_CONCURRENCY", 16))
+        self.db_limit = asyncio.Semaphore(config.get("ASYNC_DB_POOL_SIZE", 20))
+        self.boundary_index = (
+            BoundaryIndex(config["BOUNDARY_INDEX"])
+            if config.get("BOUNDARY_INDEX")
+            else None
+        )
+
+    async def close(self) -> None:
+        """Close HTTP client and database connections."""
+        await self.http.aclose()
+        await self.engine.dispose()
+
+    async def cached(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[T]],
+        store: Callable[[T], bool] = lambda v: True,
+        refs: Callable[[T], typing.Sequence[str]] | None = None,
+    ) -> T:
+        """Return fresh cached value or fetch it, falling back to a stale value."""
+        if not cache.enabled():
+            return await fetch()
+
+        if (value := await self.cache_get(key, cache.ttl)) is not None:
+            return typing.cast(T, value)
+        try:
+            value = await fetch()
+        except UpstreamUnavailable:
+            if (stale := await self.cache_get(key)) is not None:
+                return typing.cast(T, stale)
+            raise
+        if store(value):
+            async with self.db_limit, self.db_session() as session:
+                old = (await session.execute(cache.select_value(key))).scalar()
+                upsert = cache.upsert_value(key, value, refs(value) if refs else None)
+                await session.execute(upsert)
+                if cache.changed(old, value):
+                    await session.execute(data_version.bump_statement("wikidata"))
+                await session.commit()
+        return typing.cast(T, value)
+
+    async def cache_get(self, key: str, max_age: int | None = None) -> typing.Any:
+        """Get cached value, None if missing or too old."""
+        async with self.db_limit, self.db_session() as session:
+            result = await session.execute(cache.select_value(key, max_age))
+            return result.scalar()
+
+    @backoff.on_exception(
+        backoff.expo,
+        (httpx.HTTPError, APIResponseError),
+        max_tries=5,
+        on_giveup=giveup,
+    )
+    async def api_request(self, params: dict[str, str | int]) -> dict[str, typing.Any]:
+        """Wikidata API call, subject to the api.php rate limit and circuit breaker."""
+        api_params: dict[str, str | int] = {
+            "format": "json",
+            "formatversion": 2,
+            **params,
+        }
+        await asyncio.sleep(await asyncio.to_thread(upstream.api.acquire))
+        async with self.api_limit:
+            try:
+                r = await self.http.get(wikidata.api_url, params=api_params)
+            except httpx.HTTPError:
+                upstream.api.record_failure()
+                raise
+        upstream.api.check_response(r.status_code, r.headers)
+        try:
+            return typing.cast(dict[str, typing.Any], r.json())
+        except json.JSONDecodeError:
+            raise APIResponseError("Failed to decode JSON", r)  # type: ignore
+
+    async def api_call(self, params: dict[str, str | int]) -> dict[str, typing.Any]:
+        """Wikidata API call, using the cache when enabled."""
+        return await self.cached(
+            cache.api_key(params),
+            lambda: self.api_request(params),
+            lambda v: "error" not in v,
+            wikidata.entity_refs,
+        )
+
+    @backoff.on_exception(backoff.expo, QueryError, max_tries=5)
+    async def wdqs_request(self, query: str) -> list[Row]:
+        """Pass query to WDQS, subject to the WDQS rate limit and circuit breaker."""
+        await asyncio.sleep(await asyncio.to_thread(upstream.wdqs.acquire))
+        async with self.wdqs_limit:
+            try:
+                r = await self.http.post(
+                    wikidata.wikidata_query_api_url,
+                    data={"query": query, "format": "json"},
+                )
+            except httpx.HTTPError:
+                upstream.wdqs.record_failure()
+                raise
+        upstream.wdqs.check_response(r.status_code, r.headers)
+        try:
+            return typing.cast(list[Row], r.json()["results"]["bindings"])
+        except json.JSONDecodeError:
+            raise QueryError(query, r)  # type: ignore
+
+    async def wdqs(self, query: str) -> list[Row]:
+        """Pass query to the Wikidata Query Service, using the cache when enabled."""
+        return await self.cached(
+            cache.wdqs_key(query),
+            lambda: self.wdqs_request(query),
+            refs=lambda rows: wikidata.query_refs(query, rows),
+        )
+
+    async def get_entity(self, qid: str) -> dict[str, typing.Any] | None:
+        """Get Wikidata entity."""
+        json_data = await self.api_call({"action": "wbgetentities", "ids": qid})
+        return wikidata.entity_from_response(json_data)
+
+    async def qid_to_commons_category(
+        self, qid: str, check_p910: bool = True
+    ) -> str | None:
+        """Commons category for a given Wikidata item."""
+        entity = await self.get_entity(qid)
+        if not entity:
+            return None
+
+        cat = wikidata.commons_cat_from_entity(entity)
+        if cat or not check_p910 or not (cat_qid := wikidata.category_item_qid(entity)):
+            return cat
+
+        return await self.qid_to_commons_category(cat_qid, check_p910=False)
+
+    async def get_scotland_code(self, lat: float, lon: float) -> str | None:
+        """Find civil parish in Scotland for given lat/lon."""
+        if self.boundary_index:
+            return self.boundary_index.get_scotland_code(lat, lon)
+        async with self.db_limit, self.db_session() as session:
+            result = await session.execute(scotland.scotland_code_select(lat, lon))
+            row = result.first()
+        return row[0] if row else None
+
+    async def coords_within(self, lat: float, lon: float) -> list[Element]:
+        """Polygons that contain given coordinates, smallest first."""
+        if self.boundary_index:
+            return list(self.boundary_index.coords_within(lat, lon))
+        async with self.db_limit, self.db_session() as session:
+            stmt = model.Polygon.coords_within_select(lat, lon)
+            result = await session.execute(stmt)
+            return list(result.scalars())
+
+    async def hit_from_tags(
+        self, tags: typing.Mapping[str, str], lat: float, lon: float
+    ) -> Hit | None:
+        """Check wikidata tag, then ref:gss tag, then name for a hit."""
+        if (qid := tags.get("wikidata")) and (
+            commons := await self.qid_to_commons_category(qid)
+        ):
+            return {"wikidata": qid, "commons_cat": commons}
+
+        if gss := tags.get("ref:gss"):
+            if hit := wikidata.commons_from_rows(
+                await self.wdqs(sparql.gss_query(gss))
+            ):
+                return hit
+
+        if not (name := tags.get("name")):
+            return None
+        if name.endswith(" CP"):  # civil parish
+            name = name[:-3]
+
+        rows = await self.wdqs(sparql.name_query(name, lat, lon))
+        return wikidata.commons_from_rows(rows) if len(rows) == 1 else None
+
+    async def osm_lookup(
+        self, elements: typing.Sequence[Element], lat: float, lon: float
+    ) -> Hit | None:
+        """OSM lookup."""
+        admin_level = None
+        for e in elements:
+            assert e.tags
+            tags: typing.Mapping[str, str] = e.tags
+            admin_level = parse_admin_level(tags.get("admin_level"))
+            if not admin_level and tags.get("boundary") not in ("political", "place"):
+                continue
+            if not (hit := await self.hit_from_tags(tags, lat, lon)):
+                continue
+            hit["admin_level"] = admin_level
+            hit["element"] = e.osm_id
+            return hit
+
+        has_wikidata_tag = [e for e in elements if e.tags.get("wikidata")]
+        if len(has_wikidata_tag) != 1:
+            return None
+
+        e = has_wikidata_tag[0]
+        qid = e.tags["wikidata"]
+        return {
+            "wikidata": qid,
+            "element": e.osm_id,
+            "commons_cat": await self.qid_to_commons_category(qid),
+            "admin_level": admin_level,
+        }
+
+    async def do_lookup(
+        self, elements: typing.Sequence[Element], lat: float, lon: float
+    ) -> wikidata.WikidataDict:
+        """Do lookup."""
+        try:
+            hit = await self.osm_lookup(elements, lat, lon)
+        except QueryError as e:
+            return {
+                "query": e.query,
+                "error": e.r.text,
+                "query_url": "https://query.wikidata.org/#" + e.query,
+            }
+        except UpstreamUnavailable:
+            result = wikidata.build_dict(wikidata.degraded_hit(elements), lat, lon)
+            result["degraded"] = True
+            return result
+
+        return wikidata.build_dict(hit, lat, lon)
+
+    async def lat_lon_to_wikidata(self, lat: float, lon: float) -> StrDict:
+        """Lookup lat/lon and find most appropriate Wikidata item."""
+        scotland_code = await self.get_scotland_code(lat, lon)
+
+        elements: list[Element]
+        degraded = False
+        if scotland_code:
+            try:
+                rows = await self.wdqs(sparql.scottish_parish_query(scotland_code))
+            except UpstreamUnavailable:
+                rows = []
+                degraded = True
+            wikidata.add_missing_commons_cat(rows)
+            hit = wikidata.commons_from_rows(rows)
+            result = wikidata.build_dict(hit, lat, lon)
+
+            if not result.get("missing"):
+                return {"elements": [], "result": result}
+
+        elements = await self.coords_within(lat, lon)
+        result = await self.do_lookup(elements, lat, lon)
+        if degraded:
+            result["degraded"] = True
+
+        # special case because the City of London is admin_level=6 in OSM
+        if result.get("wikidata") == wikidata.city_of_london_qid:
+            return {"elements": elements, "result": result}
+
+        admin_level = result.get("admin_level")
+        if not admin_level:
+            return {"elements": elements, "result": result}
+
+        assert isinstance(admin_level, int)
+        if admin_level >= 7:
+            return {"elements": elements, "result": result}
+
+        query = sparql.geosearch_query(lat, lon)
+        try:
+            row = wikidata.pick_geosearch_row(await self.wdqs(query))
+        except UpstreamUnavailable:
+            # keep the OSM result without the geosearch refinement
+            result["degraded"] = True
+            return {"elements": elements, "result": result, "query": query}
+        if row:
+            hit = wikidata.commons_from_rows([row])
+            elements = []
+            result = wikidata.build_dict(hit, lat, lon)
+
+        return {"elements": elements, "result": result, "query": query}
+
+    async def log_lookup(
+        self,
+        lat: float,
+        lon: float,
+        remote_addr: str | None,
+        result: wikidata.WikidataDict,
+        response_time_ms: int,
+    ) -> None:
+        """Save lookup to the lookup log."""
+        fqdn = (
+            await asyncio.to_thread(socket.getfqdn, remote_addr)
+            if remote_addr
+            else None
+        )
+        log = model.LookupLog(
+            lat=lat,
+            lon=lon,
+            remote_addr=remote_addr,
+            fqdn=fqdn,
+            result=result,
+            response_time_ms=response_time_ms,
+        )
+        async with self.db_limit, self.db_session() as session:
+            session.add(log)
+            await session.commit()
@@ -0,0 +1,469 @@
+"""Memory-mapped boundary index for point-in-polygon lookups without PostGIS.
+
+The export writes every qualifying boundary into one flat file:
+
+    header | records | rings | chunks | points | R-tree nodes | tags
+
+Records are stored in Sort-Tile-Recursive order so the leaves of the packed
+R-tree are runs of consecutive records.  Each ring is split into chunks of
+segments with their own latitude range and maximum longitude, so the ray
+casting test can skip most of the segments of a large boundary.
+
+The file is opened with mmap, so every worker process on a host shares the
+same pages from the page cache.
+"""
+
+import json
+import math
+import mmap
+import os
+import struct
+import typing
+from array import array
+from collections.abc import Iterable, Iterator
+
+from sqlalchemy import func
+
+from .database import session
+from .model import Polygon, Scotland
+
+MAGIC = b"GCBI"
+VERSION = 1
+
+OSM_POLYGON = 0
+SCOTTISH_PARISH = 1
+
+NODE_SIZE = 16
+CHUNK_SEGMENTS = 32
+
+# magic, version, then counts of records, rings, chunks, points, nodes, leaves
+# and the length of the tags section
+HEADER = struct.Struct("<4sI7Q")
+# osm_id, area, bbox, first ring, ring count, tags offset, tags length,
+# admin_level (-1 for none), kind
+RECORD = struct.Struct("<q5dIIIIiB3x")
+# first point, first chunk, point count, chunk count, exterior flag
+RING = struct.Struct("<QQIIB7x")
+# min lat, max lat, max lon, first point, segment count
+CHUNK = struct.Struct("<dddQI4x")
+# bbox, first child, child count
+NODE = struct.Struct("<4dII")
+POINT_SIZE = 16
+
+Tags = dict[str, str]
+Geometry = dict[str, typing.Any]
+Source = tuple[int, int, float, int | None, Tags, Geometry]
+
+
+def parse_admin_level(admin_level: str | None) -> int | None:
+    """Convert admin_level tag to an integer."""
+    return int(admin_level) if admin_level and admin_level.isdigit() else None
+
+
+def polygons_from_geometry(geometry: Geometry) -> list[list[list[list[float]]]]:
+    """List of polygons from a GeoJSON Polygon or MultiPolygon."""
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return typing.cast(list[list[list[list[float]]]], geometry["coordinates"])
+    if geometry["type"] == "GeometryCollection":
+        return [
+            polygon
+            for part in geometry["geometries"]
+            if part["type"] in ("Polygon", "MultiPolygon")
+            for polygon in polygons_from_geometry(part)
+        ]
+    return []
+
+
+class IndexWriter:
+    """Collect boundaries and write them to an index file."""
+
+    def __init__(self) -> None:
+        """Init."""
+        self.records: list[tuple[typing.Any, ...]] = []
+        self.rings = bytearray()
+        self.chunks = bytearray()
+        self.points = array("d")
+        self.tags = bytearray()
+        self.ring_count = 0
+        self.chunk_count = 0
+
+    def add_ring(self, ring: list[list[float]], exterior: bool) -> None:
+        """Add ring, splitting the segments into chunks."""
+        first_point = len(self.points) // 2
+        first_chunk = self.chunk_count
+        for lon, lat in ring:
+            self.points.extend((lon, lat))
+
+        segments = len(ring) - 1
+        for start in range(0, segments, CHUNK_SEGMENTS):
+            chunk = ring[start : start + CHUNK_SEGMENTS + 1]
+            lats = [lat for lon, lat in chunk]
+            max_lon = max(lon for lon, lat in chunk)
+            self.chunks += CHUNK.pack(
+                min(lats), max(lats), max_lon, first_point + start, len(chunk) - 1
+            )
+            self.chunk_count += 1
+
+        self.rings += RING.pack(
+            first_point,
+            first_chunk,
+            len(ring),
+            self.chunk_count - first_chunk,
+            exterior,
+        )
+        self.ring_count += 1
+
+    def add(
+        self,
+        kind: int,
+        osm_id: int,
+        area: float,
+        admin_level: int | None,
+        tags: Tags,
+        geometry: Geometry,
+    ) -> None:
+        """Add a boundary to the index."""
+        polygons = polygons_from_geometry(geometry)
+        if not polygons:
+            return
+
+        first_ring = self.ring_count
+        lons: list[float] = []
+        lats: list[float] = []
+        for polygon in polygons:
+            for ring_num, ring in enumerate(polygon):
+                if len(ring) < 4:
+                    continue
+                self.add_ring(ring, exterior=ring_num == 0)
+                lons += (lon for lon, lat in ring)
+                lats += (lat for lon, lat in ring)
+
+        if not lons:
+            return
+
+        tags_bytes = json.dumps(tags, separators=(",", ":")).encode("utf-8")
+        bbox = (min(lons), min(lats), max(lons), max(lats))
+        self.records.append(
+            (
+                osm_id,
+                area,
+                *bbox,
+                first_ring,
+                self.ring_count - first_ring,
+                len(self.tags),
+                len(tags_bytes),
+                admin_level if admin_level is not None else -1,
+                kind,
+            )
+        )
+        self.tags += tags_bytes
+
+    def sort_records(self) -> None:
+        """Put records into Sort-Tile-Recursive order."""
+
+        def center(record: tuple[typing.Any, ...], axis: int) -> float:
+            return typing.cast(float, (record[2 + axis] + record[4 + axis]) / 2)
+
+        leaf_count = math.ceil(len(self.records) / NODE_SIZE)
+        slice_size = math.ceil(math.sqrt(leaf_count)) * NODE_SIZE
+        by_lon = sorted(self.records, key=lambda r: center(r, 0))
+        self.records = [
+            record
+            for start in range(0, len(by_lon), slice_size)
+            for record in sorted(
+                by_lon[start : start + slice_size], key=lambda r: center(r, 1)
+            )
+        ]
+
+    def build_tree(self) -> tuple[list[tuple[typing.Any, ...]], int]:
+        """Build packed R-tree, return nodes and the number of leaf nodes."""
+        boxes = [r[2:6] for r in self.records]
+        nodes: list[tuple[typing.Any, ...]] = []
+        child_start = 0
+        leaf_count = 0
+        while True:
+            level = []
+            for first in range(0, len(boxes), NODE_SIZE):
+                group = boxes[first : first + NODE_SIZE]
+                bbox = (
+                    min(b[0] for b in group),
+                    min(b[1] for b in group),
+                    max(b[2] for b in group),
+                    max(b[3] for b in group),
+                )
+                level.append((*bbox, child_start + first, len(group)))
+            level_start = len(nodes)
+            nodes += level
+            leaf_count = leaf_count or len(level)
+            if len(level) == 1:
+                return nodes, leaf_count
+            boxes = [n[:4] for n in level]
+            child_start = level_start
+
+    def write(self, path: str) -> None:
+        """Write the index file."""
+        self.sort_records()
+        nodes, leaf_count = self.build_tree() if self.records else ([], 0)
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            len(self.records),
+            self.ring_count,
+            self.chunk_count,
+            len(self.points) // 2,
+            len(nodes),
+            leaf_count,
+            len(self.tags),
+        )
+        # write to a new file and rename it into place: workers that still
+        # have the old file mapped keep reading the old pages
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for record in self.records:
+                f.write(RECORD.pack(*record))
+            f.write(self.rings)
+            f.write(self.chunks)
+            self.points.tofile(f)
+            for node in nodes:
+                f.write(NODE.pack(*node))
+            f.write(self.tags)
+        os.replace(tmp_path, path)
+
+
+def write_index(path: str, boundaries: Iterable[Source]) -> int:
+    """Write boundaries to an index file, return number of boundaries."""
+    writer = IndexWriter()
+    for boundary in boundaries:
+        writer.add(*boundary)
+    writer.write(path)
+    return len(writer.records)
+
+
+def boundaries_from_db(
+    bbox: tuple[float, float, float, float] | None = None,
+) -> Iterator[Source]:
+    """Qualifying OSM polygons and Scottish parishes from the database.
+
+    With a bbox (west, south, east, north) only boundaries intersecting it.
+    """
+    envelope = func.ST_MakeEnvelope(*bbox, 4326) if bbox else None
+    polygons = session.query(
+        Polygon.osm_id, Polygon.area, Polygon.tags, Polygon.geojson_str
+    ).filter(Polygon.is_candidate())
+    if envelope is not None:
+        polygons = polygons.filter(Polygon.way.intersects(envelope))
+    for osm_id, area, tags, geojson in polygons.yield_per(1000):
+        admin_level = parse_admin_level(tags.get("admin_level"))
+        yield OSM_POLYGON, osm_id, area, admin_level, tags, json.loads(geojson)
+
+    parishes = session.query(
+        Scotland.gid,
+        Scotland.code,
+        Scotland.name,
+        func.ST_AsGeoJSON(func.ST_Transform(Scotland.geom, 4326), 6),
+    )
+    if envelope is not None:
+        parishes = parishes.filter(
+            func.ST_Intersects(Scotland.geom, func.ST_Transform(envelope, 27700))
+        )
+    for gid, code, name, geojson in parishes.yield_per(1000):
+        tags = {"code": code, "name": name}
+        yield SCOTTISH_PARISH, gid, 0.0, None, tags, json.loads(geojson)
+
+
+class Boundary:
+    """Boundary from the index, with the attributes of model.Polygon."""
+
+    __slots__ = ("index", "position", "osm_id", "area", "admin_level", "tags")
+
+    def __init__(
+        self,
+        index: "BoundaryIndex",
+        position: int,
+        osm_id: int,
+        area: float,
+        admin_level: int | None,
+        tags: Tags,
+    ) -> None:
+        """Init."""
+        self.index = index
+        self.position = position
+        self.osm_id = osm_id
+        self.area = area
+        self.admin_level = admin_level
+        self.tags = tags
+
+    def __repr__(self) -> str:
+        """Repr."""
+        return f"<Boundary osm_id={self.osm_id} name={self.tags.get('name')!r}>"
+
+    @property
+    def osm_url(self) -> str:
+        """OSM URL for polygon."""
+        osm_type = "way" if self.osm_id > 0 else "relation"
+        return f"https://www.openstreetmap.org/{osm_type}/{abs(self.osm_id)}"
+
+    @property
+    def area_in_sq_km(self) -> float:
+        """Area in square kilometers."""
+        return self.area / (1000 * 1000)
+
+    @property
+    def geojson_str(self) -> str:
+        """Boundary geometry as GeoJSON."""
+        return json.dumps(self.index.geometry(self.position), separators=(",", ":"))
+
+
+class BoundaryIndex:
+    """Read-only boundary index backed by a memory-mapped file."""
+
+    def __init__(self, path: str) -> None:
+        """Open index file."""
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            self.record_count,
+            ring_count,
+            chunk_count,
+            point_count,
+            self.node_count,
+            self.leaf_count,
+            tags_len,
+        ) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a boundary index (version {VERSION})")
+
+        self.records_offset = HEADER.size
+        self.rings_offset = self.records_offset + self.record_count * RECORD.size
+        self.chunks_offset = self.rings_offset + ring_count * RING.size
+        points_offset = self.chunks_offset + chunk_count * CHUNK.size
+        self.nodes_offset = points_offset + point_count * POINT_SIZE
+        self.tags_offset = self.nodes_offset + self.node_count * NODE.size
+
+        points_end = points_offset + point_count * POINT_SIZE
+        self.points = memoryview(self.mm)[points_offset:points_end].cast("d")
+
+    def close(self) -> None:
+        """Close index file."""
+        self.points.release()
+        self.mm.close()
+
+    def __len__(self) -> int:
+        """Number of boundaries in the index."""
+        return typing.cast(int, self.record_count)
+
+    def record(self, position: int) -> tuple[typing.Any, ...]:
+        """Read record at position."""
+        offset = self.records_offset + position * RECORD.size
+        return RECORD.unpack_from(self.mm, offset)
+
+    def candidates(self, lon: float, lat: float) -> Iterator[int]:
+        """Positions of records with a bounding box that contains the point."""
+        if not self.node_count:
+            return
+        stack = [self.node_count - 1]
+        while stack:
+            node = stack.pop()
+            offset = self.nodes_offset + node * NODE.size
+            min_lon, min_lat, max_lon, max_lat, first, count = NODE.unpack_from(
+                self.mm, offset
+            )
+            if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+                continue
+            if node >= self.leaf_count:
+                stack.extend(range(first, first + count))
+                continue
+            for position in range(first, first + count):
+                record = self.record(position)
+                if record[2] <= lon <= record[4] and record[3] <= lat <= record[5]:
+                    yield position
+
+    def contains(self, record: tuple[typing.Any, ...], lon: float, lat: float) -> bool:
+        """Even-odd ray casting test against every ring of the record."""
+        points = self.points
+        inside = False
+        first_ring, ring_count = record[6], record[7]
+        for ring in range(first_ring, first_ring + ring_count):
+            ring_offset = self.rings_offset + ring * RING.size
+            _, first_chunk, _, chunk_count, _ = RING.unpack_from(self.mm, ring_offset)
+            for chunk in range(first_chunk, first_chunk + chunk_count):
+                chunk_offset = self.chunks_offset + chunk * CHUNK.size
+                min_lat, max_lat, max_lon, start, segments = CHUNK.unpack_from(
+                    self.mm, chunk_offset
+                )
+                if lat < min_lat or lat >= max_lat or max_lon < lon:
+                    continue
+                i = start * 2
+                x1, y1 = points[i], points[i + 1]
+                for _ in range(segments):
+                    i += 2
+                    x2, y2 = points[i], points[i + 1]
+                    if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (
+                        y2 - y1
+                    ) + x1:
+                        inside = not inside
+                    x1, y1 = x2, y2
+        return inside
+
+    def tags(self, record: tuple[typing.Any, ...]) -> Tags:
+        """Decode tags for record."""
+        start = self.tags_offset + record[8]
+        return typing.cast(Tags, json.loads(self.mm[start : start + record[9]]))
+
+    def boundary(self, position: int, record: tuple[typing.Any, ...]) -> Boundary:
+        """Build boundary object for record."""
+        admin_level = record[10] if record[10] >= 0 else None
+        return Boundary(
+            self, position, record[0], record[1], admin_level, self.tags(record)
+        )
+
+    def containing(self, lat: float, lon: float, kind: int) -> Iterator[Boundary]:
+        """Boundaries of the given kind that contain the point."""
+        for position in self.candidates(lon, lat):
+            record = self.record(position)
+            if record[11] == kind and self.contains(record, lon, lat):
+                yield self.boundary(position, record)
+
+    def coords_within(self, lat: float, lon: float) -> list[Boundary]:
+        """Polygons that contain given coordinates, same order as the database."""
+        found = self.containing(lat, lon, OSM_POLYGON)
+        # order by area, admin_level descending with nulls first
+        return sorted(
+            found,
+            key=lambda b: (
+                b.area,
+                b.admin_level is not None,
+                -(b.admin_level or 0),
+            ),
+        )
+
+    def get_scotland_code(self, lat: float, lon: float) -> str | None:
+        """Find civil parish in Scotland for given lat/lon."""
+        parish = next(self.containing(lat, lon, SCOTTISH_PARISH), None)
+        return parish.tags["code"] if parish else None
+
+    def geometry(self, position: int) -> Geometry:
+        """Rebuild GeoJSON geometry for the record at position."""
+        record = self.record(position)
+        polygons: list[list[list[list[float]]]] = []
+        first_ring, ring_count = record[6], record[7]
+        for ring in range(first_ring, first_ring + ring_count):
+            first_point, _, point_count, _, exterior = RING.unpack_from(
+                self.mm, self.rings_offset + ring * RING.size
+            )
+            coords = self.points[first_point * 2 : (first_point + point_count) * 2]
+            points = [[coords[i], coords[i + 1]] for i in range(0, len(coords), 2)]
+            if exterior or not polygons:
+                polygons.append([points])
+            else:
+                polygons[-1].append(points)
+
+        if len(polygons) == 1:
+            return {"type": "Polygon", "coordinates": polygons[0]}
+        return {"type": "MultiPolygon", "coordinates": polygons}
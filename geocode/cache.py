@@ -0,0 +1,127 @@
+"""Cache Wikidata API and WDQS responses in the database.
+
+Fresh entries are used instead of calling the upstream. When the upstream is
+unavailable an entry of any age is better than no answer.
+"""
+
+import hashlib
+import typing
+import urllib.parse
+from collections.abc import Callable
+from datetime import timedelta
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Insert, Select
+
+from . import data_version
+from .database import now_utc, session
+from .model import WikidataCache
+from .upstream import UpstreamUnavailable
+
+Config = typing.Mapping[str, typing.Any]
+T = typing.TypeVar("T")
+
+# seconds before an entry needs to be refreshed, None disables the cache
+ttl: int | None = None
+
+
+def configure(config: Config) -> None:
+    """Enable cache if WIKIDATA_CACHE_TTL is set in app config."""
+    global ttl
+    ttl = config.get("WIKIDATA_CACHE_TTL")
+
+
+def enabled() -> bool:
+    """Cache is enabled."""
+    return ttl is not None
+
+
+def api_key(params: typing.Mapping[str, str | int]) -> str:
+    """Cache key for a Wikidata API call."""
+    return "api:" + urllib.parse.urlencode(sorted(params.items()))
+
+
+def wdqs_key(query: str) -> str:
+    """Cache key for a WDQS query."""
+    return "wdqs:" + hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+def select_value(key: str, max_age: int | None = None) -> Select:
+    """Select cached value, optionally only when newer than max_age seconds."""
+    q = select(WikidataCache.value).where(WikidataCache.key == key)
+    if max_age is not None:
+        q = q.where(WikidataCache.fetched > now_utc() - timedelta(seconds=max_age))
+    return q
+
+
+def upsert_value(
+    key: str, value: typing.Any, refs: typing.Sequence[str] | None = None
+) -> Insert:
+    """Insert or replace cached value."""
+    q = insert(WikidataCache).values(
+        key=key, value=value, fetched=now_utc(), refs=list(refs or [])
+    )
+    return q.on_conflict_do_update(
+        index_elements=[WikidataCache.key],
+        set_={
+            "value": q.excluded.value,
+            "fetched": q.excluded.fetched,
+            "refs": q.excluded.refs,
+        },
+    )
+
+
+def get(key: str, max_age: int | None = None, db: Session | None = None) -> typing.Any:
+    """Get cached value, None if missing or too old."""
+    with (db or session).get_bind().connect() as conn:
+        return conn.execute(select_value(key, max_age)).scalar()
+
+
+def changed(old: typing.Any, new: typing.Any) -> bool:
+    """A refreshed value differs from the one it replaces."""
+    return old is not None and old != new
+
+
+def put(
+    key: str,
+    value: typing.Any,
+    db: Session | None = None,
+    refs: typing.Sequence[str] | None = None,
+) -> None:
+    """Save value in the cache, bumping the wikidata data version if it changed."""
+    with (db or session).get_bind().begin() as conn:
+        old = conn.execute(select_value(key)).scalar()
+        conn.execute(upsert_value(key, value, refs))
+        if not changed(old, value):
+            return
+        conn.execute(data_version.bump_statement("wikidata"))
+    data_version.expire()
+
+
+def cached(
+    key: str,
+    fetch: Callable[[], T],
+    store: Callable[[T], bool] = lambda v: True,
+    db: Session | None = None,
+    refs: Callable[[T], typing.Sequence[str]] | None = None,
+) -> T:
+    """Return fresh cached value or fetch it, falling back to a stale value.
+
+    refs gives the QIDs and codes a value depends on, see changes.py.
+    """
+    if not enabled():
+        return fetch()
+
+    if (value := get(key, ttl, db)) is not None:
+        return typing.cast(T, value)
+    try:
+        value = fetch()
+    except UpstreamUnavailable:
+        if (stale := get(key, db=db)) is not None:
+            return typing.cast(T, stale)
+        raise
+    if store(value):
+        put(key, value, db, refs(value) if refs else None)
+    return typing.cast(T, value)
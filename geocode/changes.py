@@ -0,0 +1,295 @@
+"""Invalidate cached results from Wikidata and OSM change feeds.
+
+Change files are read from a local directory:
+
+- Wikidata recent changes: an api.php list=recentchanges response (.json),
+  recentchange events or entity JSON one per line (.jsonl, .ndjson) or a
+  QID per line (.txt).
+- OSM replication diffs in osmChange format (.osc).
+
+Any of these can be compressed with gzip or bzip2. Only the cache entries,
+simplified geometry and resolved boundaries that depend on a changed QID, GSS
+code or osm_id are touched, so the caches can keep a long TTL.
+
+Cached WDQS lookups by name and geosearch results are keyed by the name or
+coordinates, not by item, so an item that gains a matching label or
+coordinates doesn't invalidate them. Those misses last until the TTL.
+"""
+
+import bz2
+import gzip
+import json
+import os
+import re
+import typing
+import xml.etree.ElementTree as ET
+from collections.abc import Callable, Iterable, Iterator
+
+import requests
+from sqlalchemy import bindparam, delete, inspect, or_, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.types import String
+
+from . import cache, data_version, wikidata
+from .database import session
+from .model import Polygon, ResolvedBoundary, SimplifiedGeometry, WikidataCache
+
+StrDict = dict[str, typing.Any]
+
+qid_re = re.compile(r"^Q\d+$")
+wikidata_suffixes = (".json", ".jsonl", ".ndjson", ".txt")
+osm_suffixes = (".osc",)
+# properties with codes used in SPARQL lookups, and their ref prefix
+code_properties = {"P836": "gss", "P528": "parish"}
+done_dir = "done"
+
+
+def open_text(path: str) -> typing.TextIO:
+    """Open a change file, decompressing by file extension."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def base_name(path: str) -> str:
+    """File name without a compression extension."""
+    name = os.path.basename(path)
+    for ext in (".gz", ".bz2"):
+        name = name.removesuffix(ext)
+    return name
+
+
+def qid_from_change(change: typing.Any) -> str | None:
+    """QID from a recentchange event, API change or entity."""
+    if not isinstance(change, dict):
+        return None
+    if change.get("wiki", "wikidatawiki") != "wikidatawiki":
+        return None
+    for key in ("title", "id"):
+        value = change.get(key)
+        if isinstance(value, str) and qid_re.match(value):
+            return value
+    return None
+
+
+def wikidata_changes(path: str) -> set[str]:
+    """QIDs changed according to a Wikidata change file."""
+    name = base_name(path)
+    with open_text(path) as f:
+        if name.endswith(".txt"):
+            return {line.strip() for line in f if qid_re.match(line.strip())}
+        if name.endswith(".json"):
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = data.get("query", {}).get("recentchanges", [data])
+            changes: Iterable[typing.Any] = data
+        else:
+            changes = (json.loads(line) for line in f if line.strip())
+        return {qid for change in changes if (qid := qid_from_change(change))}
+
+
+def osm_changes(path: str) -> dict[str, set[int]]:
+    """IDs of changed nodes, ways and relations in an osmChange file."""
+    changed: dict[str, set[int]] = {"node": set(), "way": set(), "relation": set()}
+    with open_text(path) as f:
+        for event, element in ET.iterparse(f):
+            if element.tag in changed:
+                changed[element.tag].add(int(element.attrib["id"]))
+                element.clear()
+    return changed
+
+
+def ways_with_nodes(nodes: set[int]) -> set[int]:
+    """Ways using any of the nodes, from the osm2pgsql slim tables."""
+    if not nodes:
+        return set()
+    q = text(
+        "SELECT id FROM planet_osm_ways WHERE nodes && CAST(:nodes AS bigint[])"
+    ).bindparams(nodes=sorted(nodes))
+    return set(session.execute(q).scalars())
+
+
+def relations_with_ways(ways: set[int]) -> set[int]:
+    """Relations with any of the ways as members, from the osm2pgsql slim tables.
+
+    Handles the legacy middle with parts/way_off/rel_off columns and the newer
+    one with members as JSON.
+    """
+    if not ways:
+        return set()
+    columns = {
+        c["name"] for c in inspect(session.get_bind()).get_columns("planet_osm_rels")
+    }
+    if "parts" in columns:
+        sql = (
+            "SELECT id FROM planet_osm_rels"
+            " WHERE parts[way_off + 1 : rel_off] && CAST(:ways AS bigint[])"
+        )
+    else:
+        sql = (
+            "SELECT id FROM planet_osm_rels WHERE EXISTS ("
+            "SELECT 1 FROM jsonb_array_elements(members) m "
+            "WHERE m->>'type' = 'W'"
+            " AND (m->>'ref')::bigint = ANY(CAST(:ways AS bigint[])))"
+        )
+    return set(session.execute(text(sql).bindparams(ways=sorted(ways))).scalars())
+
+
+def affected_osm_ids(changed: dict[str, set[int]]) -> set[int]:
+    """osm_ids in planet_osm_polygon whose geometry or tags may have changed.
+
+    A moved node changes the ways that use it and the relations those ways are
+    members of. That needs the osm2pgsql slim tables, without them only the
+    ways and relations in the diff are used. Relations have negative osm_ids.
+    """
+    ways = set(changed["way"])
+    relations = set(changed["relation"])
+    if inspect(session.get_bind()).has_table("planet_osm_ways"):
+        ways |= ways_with_nodes(changed["node"])
+        relations |= relations_with_ways(ways)
+    return ways | {-r for r in relations}
+
+
+def invalidate_osm(osm_ids: set[int]) -> StrDict:
+    """Drop simplified geometry and resolved boundaries for changed polygons.
+
+    Simplified geometry is recomputed on demand, resolve-boundaries picks up
+    the boundaries again.
+    """
+    ids = sorted(osm_ids)
+    simplified = session.execute(
+        delete(SimplifiedGeometry).where(SimplifiedGeometry.osm_id.in_(ids))
+    )
+    resolved = session.execute(
+        delete(ResolvedBoundary).where(ResolvedBoundary.osm_id.in_(ids))
+    )
+    session.commit()
+    return {
+        "simplified_geometry": simplified.rowcount,
+        "resolved_boundary": resolved.rowcount,
+    }
+
+
+def entity_codes(json_data: StrDict | None) -> set[str]:
+    """Refs for the codes of an entity used in SPARQL lookups, like gss:E05000026."""
+    entity = wikidata.entity_from_response(json_data) if json_data else None
+    if not entity:
+        return set()
+    codes = set()
+    for prop, prefix in code_properties.items():
+        for claim in entity.get("claims", {}).get(prop, []):
+            value = claim.get("mainsnak", {}).get("datavalue", {}).get("value")
+            if isinstance(value, str):
+                codes.add(f"{prefix}:{value}")
+    return codes
+
+
+def entity_key(qid: str) -> str:
+    """Cache key of the wbgetentities call for an item."""
+    return cache.api_key({"action": "wbgetentities", "ids": qid})
+
+
+def refresh_entities(
+    qids: set[str], http: requests.Session | None = None
+) -> tuple[int, set[str]]:
+    """Fetch changed items that are in the cache and store the new version.
+
+    Returns the number refreshed and the codes that were added or removed,
+    which change the results of the SPARQL lookups by code.
+    """
+    keys = {entity_key(qid): qid for qid in qids}
+    rows = session.execute(
+        select(WikidataCache.key, WikidataCache.value).where(
+            WikidataCache.key.in_(list(keys))
+        )
+    ).all()
+    changed_codes: set[str] = set()
+    for key, old in rows:
+        new = wikidata.api_request({"action": "wbgetentities", "ids": keys[key]}, http)
+        if "error" in new:
+            continue
+        cache.put(key, new, refs=wikidata.entity_refs(new))
+        changed_codes |= entity_codes(old) ^ entity_codes(new)
+    return len(rows), changed_codes
+
+
+def invalidate_wikidata(
+    qids: set[str], http: requests.Session | None = None
+) -> StrDict:
+    """Refresh cached items, drop cached queries and resolved boundaries using them."""
+    refreshed, codes = refresh_entities(qids, http)
+    refs = sorted(qids | codes)
+    queries = session.execute(
+        delete(WikidataCache).where(
+            WikidataCache.key.startswith("wdqs:"),
+            WikidataCache.refs.overlap(bindparam("refs", refs, type_=ARRAY(String))),
+        )
+    )
+    gss = [code.removeprefix("gss:") for code in codes if code.startswith("gss:")]
+    by_gss = select(Polygon.osm_id).where(Polygon.tags["ref:gss"].in_(gss))
+    resolved = session.execute(
+        delete(ResolvedBoundary).where(
+            or_(
+                ResolvedBoundary.wikidata.in_(sorted(qids)),
+                ResolvedBoundary.osm_id.in_(by_gss),
+            )
+        )
+    )
+    session.commit()
+    return {
+        "entities_refreshed": refreshed,
+        "codes_changed": len(codes),
+        "queries_dropped": queries.rowcount,
+        "resolved_boundary": resolved.rowcount,
+    }
+
+
+def change_files(directory: str) -> Iterator[str]:
+    """Change files waiting in the directory, oldest name first."""
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and base_name(path).endswith(
+            wikidata_suffixes + osm_suffixes
+        ):
+            yield path
+
+
+def ingest(
+    directory: str,
+    http: requests.Session | None = None,
+    progress: Callable[[str], None] = lambda msg: None,
+) -> StrDict:
+    """Apply the change files in a directory, then move them to done/.
+
+    Lookups by name and geosearch results are left to expire with the TTL.
+    """
+    files = list(change_files(directory))
+    qids: set[str] = set()
+    osm: dict[str, set[int]] = {"node": set(), "way": set(), "relation": set()}
+    for path in files:
+        if base_name(path).endswith(osm_suffixes):
+            for kind, ids in osm_changes(path).items():
+                osm[kind] |= ids
+        else:
+            qids |= wikidata_changes(path)
+    progress(
+        f"{len(files):,d} files: {len(qids):,d} items, "
+        + ", ".join(f"{len(ids):,d} {kind}s" for kind, ids in osm.items())
+    )
+
+    summary: StrDict = {"files": len(files), "qids": len(qids)}
+    if any(osm.values()):
+        osm_ids = affected_osm_ids(osm)
+        summary["osm_ids"] = len(osm_ids)
+        summary |= invalidate_osm(osm_ids)
+        data_version.bump("planet_osm_polygon")
+    if qids:
+        summary |= invalidate_wikidata(qids, http)
+        data_version.bump("wikidata")
+
+    os.makedirs(os.path.join(directory, done_dir), exist_ok=True)
+    for path in files:
+        os.replace(path, os.path.join(directory, done_dir, os.path.basename(path)))
+    return summary
@@ -0,0 +1,121 @@
+"""Version of the boundary and Wikidata data, used for HTTP caching.
+
+The version is a hash of the refresh times recorded in the data_version
+table and the boundary index file. It changes whenever either is refreshed,
+which makes every ETag derived from it change too. Imports bump their source
+explicitly, and the Wikidata cache bumps wikidata when a refreshed value
+differs from the one it replaces.
+"""
+
+import functools
+import hashlib
+import os
+import time
+import typing
+
+import flask
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import Insert
+from werkzeug.wrappers import Response
+
+from .database import now_utc, session
+from .model import DataVersion
+
+Config = typing.Mapping[str, typing.Any]
+View = typing.Callable[..., typing.Any]
+
+sources = ("planet_osm_polygon", "scotland", "wikidata")
+
+# seconds to reuse the version before checking the database again
+check_interval = 60
+boundary_index_path: str | None = None
+cached: tuple[float, str] | None = None
+
+
+def configure(config: Config) -> None:
+    """Read settings from app config."""
+    global check_interval, boundary_index_path
+    check_interval = config.get("DATA_VERSION_CHECK_INTERVAL", check_interval)
+    boundary_index_path = config.get("BOUNDARY_INDEX")
+
+
+def bump_statement(source: str) -> Insert:
+    """Record that a data source has been refreshed, for use in a transaction."""
+    q = insert(DataVersion).values(source=source, updated=now_utc())
+    return q.on_conflict_do_update(
+        index_elements=[DataVersion.source], set_={"updated": q.excluded.updated}
+    )
+
+
+def expire() -> None:
+    """Recompute the version on next use in this process."""
+    global cached
+    cached = None
+
+
+def bump(source: str) -> None:
+    """Record that a data source has been refreshed."""
+    session.execute(bump_statement(source))
+    session.commit()
+    expire()
+
+
+def compute() -> str:
+    """Compute the data version from the database and boundary index."""
+    parts = [
+        f"{source}={updated.isoformat()}"
+        for source, updated in session.query(DataVersion.source, DataVersion.updated)
+        .order_by(DataVersion.source)
+        .all()
+    ]
+    if boundary_index_path:
+        st = os.stat(boundary_index_path)
+        parts.append(f"index:{st.st_mtime_ns}:{st.st_size}")
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def current() -> str:
+    """Current data version, rechecked at most every check_interval seconds."""
+    global cached
+    now = time.monotonic()
+    if cached is None or now - cached[0] > check_interval:
+        cached = (now, compute())
+    return cached[1]
+
+
+def etag(path: str) -> str:
+    """ETag for a resource at the current data version."""
+    return hashlib.sha1(f"{current()} {path}".encode("utf-8")).hexdigest()
+
+
+def no_store_if_degraded(result: typing.Mapping[str, typing.Any]) -> None:
+    """Stop degraded or failed lookups being cached by clients and the CDN."""
+    if result.get("degraded") or "error" in result:
+        flask.g.no_store = True
+
+
+def versioned(view: View) -> View:
+    """Add ETag and Cache-Control headers based on the data version.
+
+    A request with a matching If-None-Match gets a 304 before any lookup work.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args: typing.Any, **kwargs: typing.Any) -> Response:
+        app = flask.current_app
+        tag = etag(flask.request.full_path)
+        max_age = app.config.get("HTTP_CACHE_MAX_AGE", 3600)
+        if flask.request.if_none_match.contains(tag):
+            response = Response(status=304)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or flask.g.get("no_store"):
+                response.cache_control.no_store = True
+                return response
+
+        response.set_etag(tag)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response
+
+    return wrapper
@@ -1,9 +1,25 @@
+import logging
+import typing
+
 import flask
 import sqlalchemy
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, event, func
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+Config = typing.Mapping[str, typing.Any]
+
+logger = logging.getLogger(__name__)
+
 session = scoped_session(sessionmaker())
+# read-only spatial queries, bound to the replica when one is configured
+read_session = scoped_session(sessionmaker())
+
+# statements prepared on each new connection, name to SQL, see prepared.py
+prepared_statements: dict[str, str] = {}
+# prepared statements whose tables are missing from the database
+unprepared: set[str] = set()
+# SQLSTATE for a missing table
+undefined_table = "42P01"
 
 
 def init_db(db_url: str, echo: bool = False) -> None:
@@ -11,19 +27,81 @@ def init_db(db_url: str, echo: bool = False) -> None:
     session.configure(bind=get_engine(db_url, echo=echo))
 
 
-def get_engine(db_url: str, echo: bool = False) -> sqlalchemy.engine.base.Engine:
-    """Create an engine object."""
-    return create_engine(db_url, pool_recycle=3600, echo=echo)
+def engine_options(config: Config) -> dict[str, typing.Any]:
+    """Connection pool settings from app config."""
+    return {
+        "pool_size": config.get("DB_POOL_SIZE", 5),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", 3600),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", True),
+        "prepare": config.get("DB_PREPARED_STATEMENTS", True),
+    }
+
+
+def prepare_statements(
+    dbapi_connection: typing.Any, connection_record: typing.Any
+) -> None:
+    """Prepare the hot statements on a new connection.
+
+    A statement whose table is missing, like scotland in a database holding
+    another region, is skipped and recorded in unprepared.
+    """
+    cursor = dbapi_connection.cursor()
+    for name, sql in prepared_statements.items():
+        try:
+            cursor.execute(f"PREPARE {name} AS {sql}")
+        except Exception as e:
+            if getattr(e, "pgcode", None) != undefined_table:
+                raise
+            dbapi_connection.rollback()
+            logger.warning("not preparing %s: %s", name, e)
+            unprepared.add(name)
+            continue
+        dbapi_connection.commit()
+    cursor.close()
+
+
+def get_engine(
+    db_url: str, echo: bool = False, prepare: bool = False, **options: typing.Any
+) -> sqlalchemy.engine.base.Engine:
+    """Create an engine object.
+
+    Connections are checked before use, so a dropped connection is replaced
+    instead of failing the request.
+    """
+    options = {"pool_recycle": 3600, "pool_pre_ping": True, **options}
+    engine = create_engine(db_url, echo=echo, **options)
+    if prepare:
+        event.listen(engine, "connect", prepare_statements)
+    return engine
+
+
+def get_engines(
+    config: Config, echo: bool = False
+) -> tuple[sqlalchemy.engine.base.Engine, sqlalchemy.engine.base.Engine]:
+    """Primary engine and engine for read-only queries, the replica if set.
+
+    Statements are only prepared on connections of the engine for reads.
+    """
+    options = engine_options(config)
+    if not config.get("DB_REPLICA_URL"):
+        primary = get_engine(config["DB_URL"], echo=echo, **options)
+        return primary, primary
+    primary = get_engine(config["DB_URL"], echo=echo, **(options | {"prepare": False}))
+    return primary, get_engine(config["DB_REPLICA_URL"], echo=echo, **options)
 
 
 def init_app(app: flask.app.Flask, echo: bool = False) -> None:
     """Initialise database connection within flask app."""
-    db_url = app.config["DB_URL"]
-    session.configure(bind=get_engine(db_url, echo=echo))
+    primary, replica = get_engines(app.config, echo=echo)
+    session.configure(bind=primary)
+    read_session.configure(bind=replica)
 
     @app.teardown_appcontext
     def shutdown_session(exception: Exception | None = None) -> None:
         session.remove()
+        read_session.remove()
 
 
 def now_utc():
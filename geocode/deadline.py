@@ -0,0 +1,99 @@
+"""Latency budget for a request.
+
+The deadline is set with start for the request and checked by every upstream
+call: HTTP timeouts, backoff retries, rate limit waits and the database
+statement timeout are all cut to the time remaining. When it runs out the
+call raises DeadlineExceeded, an UpstreamUnavailable, so the lookup falls back
+to the best answer it has, marked as degraded.
+"""
+
+import contextlib
+import contextvars
+import time
+from collections.abc import Iterator
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .upstream import UpstreamUnavailable
+
+# smallest timeout passed to requests, which rejects a timeout of 0
+min_timeout = 0.01
+
+# Session.info key for the transaction the statement timeout was set in
+timeout_key = "deadline_transaction"
+
+current: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """The request ran out of time."""
+
+
+@contextlib.contextmanager
+def start(seconds: float | None) -> Iterator[None]:
+    """Give the code inside a budget in seconds, None for no limit."""
+    token = current.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+def remaining() -> float | None:
+    """Seconds left, None without a deadline."""
+    if (deadline := current.get()) is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def expired() -> bool:
+    """The deadline has passed."""
+    return remaining() == 0.0
+
+
+def check() -> None:
+    """Raise DeadlineExceeded if the deadline has passed."""
+    if expired():
+        raise DeadlineExceeded("deadline exceeded")
+
+
+def timeout() -> float | None:
+    """Timeout for an upstream request, raises DeadlineExceeded if no time is left."""
+    check()
+    if (seconds := remaining()) is None:
+        return None
+    return max(seconds, min_timeout)
+
+
+@contextlib.contextmanager
+def upstream_call() -> Iterator[None]:
+    """Check the deadline before a call, and treat errors after it as running out."""
+    check()
+    try:
+        yield
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if expired():
+            raise DeadlineExceeded("deadline exceeded") from e
+        raise
+
+
+def statement_timeout(db: Session) -> None:
+    """Limit queries for the rest of the transaction to the time remaining.
+
+    The timeout is set once per transaction, later queries only check that
+    the deadline hasn't passed, so they don't pay for another round trip.
+    """
+    if (seconds := remaining()) is None:
+        return
+    check()
+    transaction = db.get_transaction()
+    if transaction is not None and db.info.get(timeout_key) is transaction:
+        return
+    ms = max(int(seconds * 1000), 1)
+    db.execute(text(f"SET LOCAL statement_timeout = {ms}"))
+    db.info[timeout_key] = db.get_transaction()
@@ -0,0 +1,430 @@
+"""Lookup engine that runs without a Flask app.
+
+The database session, HTTP session and boundary index are passed in, so the
+same lookup can serve the web app, a standalone script or a worker pool.
+"""
+
+import typing
+from collections.abc import Callable
+
+import requests
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import (
+    cache,
+    database,
+    deadline,
+    headers,
+    mail,
+    model,
+    prepared,
+    scotland,
+    upstream,
+    wikidata,
+)
+from .boundaries import Boundary, BoundaryIndex, parse_admin_level
+from .wikidata import BatchLookup, Hit, NameKey, WikidataDict
+
+Config = typing.Mapping[str, typing.Any]
+Tags = typing.Mapping[str, str]
+Element = model.Polygon | Boundary
+StrDict = dict[str, typing.Any]
+T = typing.TypeVar("T")
+
+# SQLSTATE for a statement cancelled by statement_timeout
+query_canceled = "57014"
+
+
+def is_candidate(tags: Tags) -> bool:
+    """Element can give the lookup result."""
+    return bool(
+        parse_admin_level(tags.get("admin_level"))
+        or tags.get("boundary") in ("political", "place")
+    )
+
+
+def name_for_lookup(tags: Tags) -> str | None:
+    """Name to search Wikidata for."""
+    if not (name := tags.get("name")):
+        return None
+    return name[:-3] if name.endswith(" CP") else name  # civil parish
+
+
+class Batches:
+    """WDQS lookups by code and name for a request, batched across elements.
+
+    Keys are queued for the elements likely to need them and fetched together
+    the first time one of them is needed.
+    """
+
+    def __init__(self, wd: wikidata.Wikidata) -> None:
+        """Init."""
+        self.gss: BatchLookup[str] = BatchLookup(wd.lookup_gss_many)
+        self.parishes: BatchLookup[str] = BatchLookup(wd.lookup_scottish_parish_many)
+        self.names: BatchLookup[NameKey] = BatchLookup(wd.lookup_by_name_many)
+
+    def add_elements(
+        self, elements: typing.Iterable[Element], lat: float, lon: float
+    ) -> None:
+        """Queue the GSS code and name of candidates without a wikidata tag."""
+        for e in elements:
+            tags: Tags = e.tags
+            if "wikidata" in tags or not is_candidate(tags):
+                continue
+            if gss := tags.get("ref:gss"):
+                self.gss.add(gss)
+            if name := name_for_lookup(tags):
+                self.names.add((name, lat, lon))
+
+
+class LookupEngine:
+    """Convert lat/lon to Wikidata item and Commons category.
+
+    The spatial queries run on read_db, which can be bound to a replica.
+    Writes, such as to the Wikidata cache, go to db.
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        http: requests.Session | None = None,
+        boundary_index: BoundaryIndex | None = None,
+        read_db: Session | None = None,
+        use_prepared: bool = False,
+    ) -> None:
+        """Init."""
+        self.db = db
+        self.read_db = read_db or db
+        self.wikidata = wikidata.Wikidata(http, db)
+        self.boundary_index = boundary_index
+        self.use_prepared = use_prepared
+
+    @classmethod
+    def from_config(cls, config: Config) -> "LookupEngine":
+        """Create an engine with its own connections, for a script or worker."""
+        upstream.configure(config)
+        cache.configure(config)
+        mail.configure(config)
+        wikidata.configure(config)
+
+        primary, replica = database.get_engines(config)
+        http = requests.Session()
+        http.headers.update(headers)
+        boundary_index = (
+            BoundaryIndex(config["BOUNDARY_INDEX"])
+            if config.get("BOUNDARY_INDEX")
+            else None
+        )
+        return cls(
+            sessionmaker(bind=primary)(),
+            http,
+            boundary_index,
+            read_db=sessionmaker(bind=replica)(),
+            use_prepared=config.get("DB_PREPARED_STATEMENTS", True),
+        )
+
+    def read_query(self, run: Callable[[], T]) -> T:
+        """Run a query on read_db limited to the time left for the request.
+
+        A query cancelled by the statement timeout raises DeadlineExceeded.
+        """
+        deadline.statement_timeout(self.read_db)
+        try:
+            return run()
+        except OperationalError as e:
+            if getattr(e.orig, "pgcode", None) != query_canceled:
+                raise
+            self.read_db.rollback()
+            raise deadline.DeadlineExceeded("statement timeout") from e
+
+    def get_scotland_code(self, lat: float, lon: float) -> str | None:
+        """Find civil parish in Scotland, using the boundary index if available."""
+        if self.boundary_index:
+            return self.boundary_index.get_scotland_code(lat, lon)
+        if "scotland_code" in database.unprepared:
+            return None  # no scotland table, a database for another region
+        if self.use_prepared:
+            params = {"lat": lat, "lon": lon}
+            code = self.read_query(
+                lambda: self.read_db.execute(prepared.scotland_code, params).scalar()
+            )
+        else:
+            q = scotland.scotland_code_select(lat, lon)
+            code = self.read_query(lambda: self.read_db.execute(q).scalar())
+        return typing.cast(str | None, code)
+
+    def coords_within(self, lat: float, lon: float) -> list[Element]:
+        """Polygons that contain given coordinates, smallest first."""
+        if self.boundary_index:
+            return list(self.boundary_index.coords_within(lat, lon))
+        if self.use_prepared and "coords_within" not in database.unprepared:
+            q = select(model.Polygon).from_statement(prepared.coords_within)
+            params = {"lat": lat, "lon": lon}
+            return self.read_query(lambda: list(self.read_db.scalars(q, params).all()))
+        q = model.Polygon.coords_within_select(lat, lon)
+        return self.read_query(lambda: list(self.read_db.scalars(q).all()))
+
+    def scotland_code_in_time(self, lat: float, lon: float) -> str | None:
+        """Scottish parish code, None if the request runs out of time."""
+        try:
+            return self.get_scotland_code(lat, lon)
+        except deadline.DeadlineExceeded:
+            return None
+
+    def hit_from_wikidata_tag(self, tags: Tags) -> Hit | None:
+        """Check element for a wikidata tag."""
+        return (
+            {
+                "wikidata": qid,
+                "commons_cat": commons,
+            }
+            if "wikidata" in tags
+            and (
+                commons := self.wikidata.qid_to_commons_category(
+                    qid := tags["wikidata"]
+                )
+            )
+            else None
+        )
+
+    def hit_from_ref_gss_tag(
+        self, tags: Tags, batches: Batches | None = None
+    ) -> Hit | None:
+        """Check element for rss:gss tag."""
+        if not (gss := tags.get("ref:gss")):
+            return None
+        if batches is None:
+            return self.wikidata.get_commons_cat_from_gss(gss)
+        return wikidata.commons_from_rows(batches.gss.get(gss))
+
+    def hit_from_name(
+        self, tags: Tags, lat: float, lon: float, batches: Batches | None = None
+    ) -> Hit | None:
+        """Use name to look for hit."""
+        if not (name := name_for_lookup(tags)):
+            return None
+
+        rows = (
+            batches.names.get((name, lat, lon))
+            if batches
+            else self.wikidata.lookup_by_name(name, lat, lon)
+        )
+        return wikidata.commons_from_rows(rows) if len(rows) == 1 else None
+
+    def element_hit(
+        self, tags: Tags, lat: float, lon: float, batches: Batches | None = None
+    ) -> Hit | None:
+        """Hit from the tags of a single element."""
+        return (
+            self.hit_from_wikidata_tag(tags)
+            or self.hit_from_ref_gss_tag(tags, batches)
+            or self.hit_from_name(tags, lat, lon, batches)
+        )
+
+    def osm_lookup(
+        self,
+        elements: typing.Sequence[Element],
+        lat: float,
+        lon: float,
+        hits: dict[int, Hit | None] | None = None,
+        batches: Batches | None = None,
+    ) -> Hit | None:
+        """OSM lookup.
+
+        Pass hits to share the result for each element between lookups, and
+        batches to share batched WDQS lookups.
+        """
+        if batches is None:
+            batches = Batches(self.wikidata)
+            batches.add_elements(elements, lat, lon)
+        for e in elements:
+            assert e.tags
+            tags: Tags = e.tags
+            admin_level = parse_admin_level(tags.get("admin_level"))
+            if not is_candidate(tags):
+                continue
+            if hits is None:
+                hit = self.element_hit(tags, lat, lon, batches)
+            elif e.osm_id in hits:
+                hit = hits[e.osm_id]
+            else:
+                hit = hits[e.osm_id] = self.element_hit(tags, lat, lon, batches)
+            if not hit:
+                continue
+            return {**hit, "admin_level": admin_level, "element": e.osm_id}
+
+        has_wikidata_tag = [e for e in elements if e.tags.get("wikidata")]
+        if len(has_wikidata_tag) != 1:
+            return None
+
+        e = has_wikidata_tag[0]
+        assert e.tags
+        qid = e.tags["wikidata"]
+        return {
+            "wikidata": qid,
+            "element": e.osm_id,
+            "commons_cat": self.wikidata.qid_to_commons_category(qid),
+            "admin_level": admin_level,
+        }
+
+    def do_lookup(
+        self,
+        elements: typing.Sequence[Element],
+        lat: float,
+        lon: float,
+        hits: dict[int, Hit | None] | None = None,
+        batches: Batches | None = None,
+    ) -> WikidataDict:
+        """Do lookup."""
+        try:
+            hit = self.osm_lookup(elements, lat, lon, hits, batches)
+        except wikidata.QueryError as e:
+            return {
+                "query": e.query,
+                "error": e.r.text,
+                "query_url": "https://query.wikidata.org/#" + e.query,
+            }
+        except wikidata.UpstreamUnavailable:
+            result = wikidata.build_dict(wikidata.degraded_hit(elements), lat, lon)
+            result["degraded"] = True
+            return result
+
+        return wikidata.build_dict(hit, lat, lon)
+
+    def scottish_parish(
+        self, code: str, lat: float, lon: float, batches: Batches | None = None
+    ) -> WikidataDict:
+        """Lookup Scottish civil parish in Wikidata."""
+        try:
+            rows = (
+                batches.parishes.get(code)
+                if batches
+                else self.wikidata.lookup_scottish_parish(code)
+            )
+        except wikidata.UpstreamUnavailable:
+            result = wikidata.build_dict(None, lat, lon)
+            result["degraded"] = True
+            return result
+        wikidata.add_missing_commons_cat(rows)
+        return wikidata.build_dict(wikidata.commons_from_rows(rows), lat, lon)
+
+    def lat_lon_to_wikidata(self, lat: float, lon: float) -> StrDict:
+        """Lookup lat/lon and find most appropriate Wikidata item."""
+        return self.resolve_point(lat, lon, self.scotland_code_in_time(lat, lon))
+
+    def resolve_point(
+        self,
+        lat: float,
+        lon: float,
+        scotland_code: str | None,
+        elements: list[Element] | None = None,
+        batches: Batches | None = None,
+    ) -> StrDict:
+        """Lookup for a point, the containing polygons are found if not given.
+
+        When the request runs out of time the best result so far is returned,
+        marked as degraded.
+        """
+        degraded = False
+        if scotland_code:
+            result = self.scottish_parish(scotland_code, lat, lon, batches)
+            if not result.get("missing"):
+                return {"elements": [], "result": result}
+            degraded = bool(result.get("degraded"))
+
+        if elements is None:
+            try:
+                elements = self.coords_within(lat, lon)
+            except deadline.DeadlineExceeded:
+                result = wikidata.build_dict(None, lat, lon)
+                result["degraded"] = True
+                return {"elements": [], "result": result}
+        result = self.do_lookup(elements, lat, lon, batches=batches)
+        if degraded:
+            result["degraded"] = True
+
+        # special case because the City of London is admin_level=6 in OSM
+        if result.get("wikidata") == wikidata.city_of_london_qid:
+            return {"elements": elements, "result": result}
+
+        admin_level = result.get("admin_level")
+        if not admin_level:
+            return {"elements": elements, "result": result}
+
+        assert isinstance(admin_level, int)
+        if admin_level >= 7:
+            return {"elements": elements, "result": result}
+
+        query = wikidata.geosearch_query(lat, lon)
+        try:
+            row = self.wikidata.geosearch(lat, lon)
+        except wikidata.UpstreamUnavailable:
+            # keep the OSM result without the geosearch refinement
+            result["degraded"] = True
+            return {"elements": elements, "result": result, "query": query}
+
+        if row:
+            hit = wikidata.commons_from_rows([row])
+            elements = []
+            result = wikidata.build_dict(hit, lat, lon)
+
+        return {"elements": elements, "result": result, "query": query}
+
+    def lookup(self, lat: float, lon: float) -> WikidataDict:
+        """Lookup result for lat/lon, without the OSM element."""
+        result: WikidataDict = self.lat_lon_to_wikidata(lat, lon)["result"]
+        result.pop("element", None)
+        return result
+
+    def lookup_many(
+        self, points: typing.Sequence[tuple[float, float]]
+    ) -> list[WikidataDict]:
+        """Lookup results for many points, batching the WDQS lookups by code and name.
+
+        The containing polygons are found for every point up front so their
+        codes and names can be queued, even for points that turn out to be
+        answered by a Scottish parish.
+        """
+        batches = Batches(self.wikidata)
+        found: list[tuple[str | None, list[Element] | None]] = []
+        for lat, lon in points:
+            code = self.scotland_code_in_time(lat, lon)
+            try:
+                elements = self.coords_within(lat, lon)
+            except deadline.DeadlineExceeded:
+                found.append((code, None))
+                continue
+            if code:
+                batches.parishes.add(code)
+            batches.add_elements(elements, lat, lon)
+            found.append((code, elements))
+
+        results = []
+        for (lat, lon), (code, elements) in zip(points, found):
+            reply = self.resolve_point(lat, lon, code, elements, batches)
+            result: WikidataDict = reply["result"]
+            result.pop("element", None)
+            results.append(result)
+        return results
+
+
+# engine for the current worker process, see init_worker
+worker_engine: LookupEngine | None = None
+
+
+def init_worker(config: Config) -> None:
+    """Create the engine for a worker process, use as a pool initializer."""
+    global worker_engine
+    worker_engine = LookupEngine.from_config(config)
+
+
+def worker_lookup(point: tuple[float, float]) -> WikidataDict:
+    """Lookup one point in a worker process started with init_worker."""
+    assert worker_engine
+    try:
+        return worker_engine.lookup(*point)
+    finally:
+        worker_engine.db.rollback()
+        worker_engine.read_db.rollback()
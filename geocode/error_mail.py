@@ -6,11 +6,13 @@ from logging.handlers import SMTPHandler
 
 import flask
 
+from . import mail
+
 PROJECT = "geocode"
 
 
 class MySMTPHandler(SMTPHandler):
-    """Custom SMTP handler to change mail subject."""
+    """Custom SMTP handler to change mail subject and queue delivery."""
 
     def getSubject(self, record: logging.LogRecord) -> str:
         """Specify subject line for error mails."""
@@ -28,6 +30,21 @@ class MySMTPHandler(SMTPHandler):
 
         return subject
 
+    def emit(self, record: logging.LogRecord) -> None:
+        """Queue mail for the background thread instead of sending it now."""
+        kind = (
+            record.exc_info[0].__name__
+            if (record.exc_info and record.exc_info[0])
+            else record.levelname
+        )
+        try:
+            subject = self.getSubject(record)
+            body = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        mail.send_to_admin(subject, body, kind=kind)
+
 
 class RequestFormatter(Formatter):
     """Custom logging formatter to include request."""
@@ -40,6 +57,8 @@ class RequestFormatter(Formatter):
 
 def setup_error_mail(app: flask.Flask) -> None:
     """Send mail to admins when an error happens."""
+    mail.start_queue(app.config)
+
     formatter = RequestFormatter(
         """
     Message type:       {levelname}
@@ -0,0 +1,81 @@
+"""Field selection and compact serialisation for lookup API responses."""
+
+import typing
+
+import msgpack
+import orjson
+
+StrDict = dict[str, typing.Any]
+
+# fields a client can ask for with fields=
+fields = (
+    "wikidata",
+    "commons_cat",
+    "commons_cat.title",
+    "commons_cat.url",
+    "admin_level",
+    "coords",
+)
+# status of the lookup, always included so a client can tell what happened
+status_fields = ("missing", "degraded", "error", "query", "query_url")
+
+# batch output formats with their content type
+content_types = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "msgpack": "application/msgpack",
+}
+
+
+class FieldError(ValueError):
+    """Unknown field or format requested."""
+
+
+def parse_fields(value: str | None) -> frozenset[str] | None:
+    """Fields from a comma separated list, None for all fields."""
+    if not value:
+        return None
+    requested = frozenset(f.strip() for f in value.split(",") if f.strip())
+    if unknown := requested - set(fields):
+        raise FieldError(
+            f"unknown field {', '.join(sorted(unknown))}, "
+            + f"choose from {', '.join(fields)}"
+        )
+    return requested
+
+
+def select_fields(result: StrDict, selected: frozenset[str] | None) -> StrDict:
+    """Result with only the selected fields."""
+    if selected is None:
+        return result
+    out = {k: v for k, v in result.items() if k in selected or k in status_fields}
+    if "commons_cat" in selected or "commons_cat" not in result:
+        return out
+    parts = [k for k in ("title", "url") if f"commons_cat.{k}" in selected]
+    if parts:
+        cat = result["commons_cat"]
+        out["commons_cat"] = {k: cat[k] for k in parts} if cat else None
+    return out
+
+
+def pick_format(name: str | None, best_match: str | None) -> str:
+    """Output format from the format argument or the Accept header match."""
+    if name:
+        if name not in content_types:
+            raise FieldError(
+                f"unknown format {name}, choose from {', '.join(content_types)}"
+            )
+        return name
+    for fmt, content_type in content_types.items():
+        if best_match == content_type:
+            return fmt
+    return "json"
+
+
+def serialise_batch(results: list[StrDict], fmt: str) -> bytes:
+    """Batch results as NDJSON, a line per result, or MessagePack."""
+    if fmt == "ndjson":
+        return b"".join(orjson.dumps(r) + b"\n" for r in results)
+    if fmt == "msgpack":
+        return typing.cast(bytes, msgpack.packb({"results": results}))
+    return orjson.dumps({"results": results})
@@ -0,0 +1,94 @@
+"""Simplified boundary geometry for maps, cached in the database.
+
+Full resolution county boundaries are megabytes of GeoJSON. Pages embed a
+version simplified with a tolerance of about one map pixel at the zoom they
+show the boundary at, the full geometry is fetched separately on request.
+"""
+
+import math
+from collections.abc import Callable, Iterable
+
+from sqlalchemy import func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import Insert, Select
+from sqlalchemy.sql.selectable import Subquery
+
+from .database import now_utc, read_session, session
+from .model import Polygon, SimplifiedGeometry
+
+# simplification tolerance in degrees for each level, roughly 10 m, 50 m and 250 m
+tolerances = (0.0001, 0.0005, 0.0025)
+# width of the map on the pages in pixels
+map_width = 600
+metres_per_degree = 111_320
+
+
+def level_for_zoom(zoom: float) -> int:
+    """Coarsest level with a tolerance no bigger than a pixel at the zoom."""
+    pixel = 360 / (256 * 2**zoom)
+    fits = [level for level, tolerance in enumerate(tolerances) if tolerance <= pixel]
+    return fits[-1] if fits else 0
+
+
+def zoom_for_area(area: float) -> float:
+    """Map zoom that fits a boundary of the given area in square metres."""
+    extent = max(math.sqrt(area), 1.0) / metres_per_degree
+    return math.log2(360 * map_width / (256 * extent))
+
+
+def level_for_area(area: float) -> int:
+    """Level for showing the whole of a boundary on the map."""
+    return level_for_zoom(zoom_for_area(area))
+
+
+def cached_select(osm_id: int, level: int) -> Select:
+    """Select cached simplified GeoJSON."""
+    return select(SimplifiedGeometry.geojson).where(
+        SimplifiedGeometry.osm_id == osm_id, SimplifiedGeometry.level == level
+    )
+
+
+def upsert(level: int, rows: Subquery) -> Insert:
+    """Insert or replace cached geometry for rows of osm_id and GeoJSON."""
+    q = insert(SimplifiedGeometry).from_select(
+        ["osm_id", "level", "geojson", "updated"],
+        select(rows.c.osm_id, literal(level), rows.c.geojson, now_utc()),
+    )
+    return q.on_conflict_do_update(
+        index_elements=[SimplifiedGeometry.osm_id, SimplifiedGeometry.level],
+        set_={"geojson": q.excluded.geojson, "updated": q.excluded.updated},
+    )
+
+
+def simplified_rows(level: int, osm_ids: Iterable[int] | None = None) -> Subquery:
+    """Subquery of simplified GeoJSON for candidate polygons."""
+    way = func.ST_SimplifyPreserveTopology(Polygon.way, tolerances[level])
+    q = select(Polygon.osm_id, func.ST_AsGeoJSON(way, 6).label("geojson"))
+    if osm_ids is not None:
+        return q.where(Polygon.osm_id.in_(list(osm_ids))).subquery()
+    return q.where(Polygon.is_candidate()).subquery()
+
+
+def get_simplified(osm_id: int, level: int) -> str | None:
+    """Simplified GeoJSON for a polygon, computed and cached on first use."""
+    if (geojson := session.execute(cached_select(osm_id, level)).scalar()) is not None:
+        return str(geojson)
+    session.execute(upsert(level, simplified_rows(level, [osm_id])))
+    session.commit()
+    geojson = session.execute(cached_select(osm_id, level)).scalar()
+    return str(geojson) if geojson is not None else None
+
+
+def get_full(osm_id: int) -> str | None:
+    """Full resolution GeoJSON for a polygon."""
+    q = select(func.ST_AsGeoJSON(Polygon.way, 6)).where(Polygon.osm_id == osm_id)
+    geojson = read_session.execute(q).scalar()
+    return str(geojson) if geojson is not None else None
+
+
+def precompute(progress: Callable[[str], None] = lambda msg: None) -> None:
+    """Compute simplified geometry of every candidate polygon at every level."""
+    for level, tolerance in enumerate(tolerances):
+        result = session.execute(upsert(level, simplified_rows(level)))
+        session.commit()
+        progress(f"level {level} (tolerance {tolerance}): {result.rowcount:,d} rows")
@@ -1,28 +1,184 @@
-"""Send mail to admin."""
+"""Send mail to admin.
 
+When the mail queue is running, mail is delivered from a background thread so
+error reporting never waits on SMTP inside a request. Messages that arrive
+within the digest window are sent together, with repeats of the same kind of
+error collapsed into a count.
+"""
+
+import atexit
+import logging
+import os
+import queue
 import smtplib
+import threading
+import time
+import typing
 from email.mime.text import MIMEText
 from email.utils import formatdate, make_msgid
 
-import flask
+Config = typing.Mapping[str, typing.Any]
+# kind of error, subject, body, time
+Message = tuple[str, str, str, float]
+
+logger = logging.getLogger(__name__)
+last_sent: dict[str, float] = {}
+# mail settings used when send_to_admin is called without a config
+default_config: Config | None = None
+
+
+def configure(config: Config) -> None:
+    """Set the mail settings used by default."""
+    global default_config
+    default_config = config
 
 
-def send_to_admin(subject: str, body: str) -> None:
-    """Send an e-mail."""
-    app = flask.current_app
-    mail_from = app.config["MAIL_FROM"]
+def send_mail(subject: str, body: str, config: Config) -> None:
+    """Send an e-mail now."""
+    mail_from = config["MAIL_FROM"]
     msg = MIMEText(body, "plain", "UTF-8")
 
     msg["Subject"] = subject
-    msg["To"] = ", ".join(app.config["ADMINS"])
-    msg["From"] = f'{app.config["MAIL_FROM_NAME"]} <{app.config["MAIL_FROM"]}>'
+    msg["To"] = ", ".join(config["ADMINS"])
+    msg["From"] = f'{config["MAIL_FROM_NAME"]} <{config["MAIL_FROM"]}>'
     msg["Date"] = formatdate()
     msg["Message-ID"] = make_msgid()
 
     # extra mail headers from config
-    for header_name, value in app.config.get("MAIL_HEADERS", {}).items():
+    for header_name, value in config.get("MAIL_HEADERS", {}).items():
         msg[header_name] = value
 
-    s = smtplib.SMTP(app.config["SMTP_HOST"])
-    s.sendmail(mail_from, app.config["ADMINS"], msg.as_string())
+    s = smtplib.SMTP(config["SMTP_HOST"], timeout=config.get("SMTP_TIMEOUT", 30))
+    s.sendmail(mail_from, config["ADMINS"], msg.as_string())
     s.quit()
+
+
+def format_time(t: float) -> str:
+    """Format time for a digest."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+def digest(messages: list[Message]) -> tuple[str, str]:
+    """Combine messages into one mail, grouped by kind of error and subject."""
+    if len(messages) == 1:
+        return messages[0][1], messages[0][2]
+
+    groups: dict[tuple[str, str], list[Message]] = {}
+    for message in messages:
+        groups.setdefault((message[0], message[1]), []).append(message)
+
+    subject = f"Geocode error digest: {len(messages)} errors, {len(groups)} kinds"
+    sections = []
+    for (kind, group_subject), group in groups.items():
+        first, last = group[0][3], group[-1][3]
+        sections.append(
+            f"{len(group)} x {group_subject} ({kind})\n"
+            + f"first: {format_time(first)}  last: {format_time(last)}\n\n"
+            + group[0][2]
+        )
+    return subject, ("\n" + "-" * 70 + "\n\n").join(sections)
+
+
+class MailQueue:
+    """Deliver admin mail from a background thread as digests."""
+
+    def __init__(self, config: Config) -> None:
+        """Init."""
+        self.config = config
+        self.window: float = config.get("MAIL_DIGEST_WINDOW", 60)
+        self.pid = 0
+        self.queue: queue.Queue[Message | None] = queue.Queue()
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """Start delivery thread."""
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="mail", daemon=True)
+        self.thread.start()
+
+    def put(self, kind: str, subject: str, body: str) -> None:
+        """Queue mail for delivery."""
+        # threads don't survive a fork, so a worker starts its own
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put((kind, subject, body, time.time()))
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Deliver anything queued and stop the delivery thread."""
+        if not self.thread or self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+        self.pid = 0
+
+    def collect(self) -> tuple[list[Message], bool]:
+        """Wait for mail, then gather more for the digest window."""
+        first = self.queue.get()
+        if first is None:
+            return [], True
+        messages = [first]
+        deadline = time.monotonic() + self.window
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                message = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if message is None:
+                return messages, True
+            messages.append(message)
+        return messages, False
+
+    def run(self) -> None:
+        """Delivery thread."""
+        stop = False
+        while not stop:
+            messages, stop = self.collect()
+            if not messages:
+                continue
+            try:
+                send_mail(*digest(messages), self.config)
+            except Exception:
+                logger.exception("error mail delivery failed")
+
+
+mail_queue: MailQueue | None = None
+
+
+def start_queue(config: Config) -> MailQueue:
+    """Deliver admin mail from a background thread."""
+    global mail_queue
+    configure(config)
+    if mail_queue is None:
+        mail_queue = MailQueue(config)
+        mail_queue.start()
+        atexit.register(mail_queue.stop, 5)
+    return mail_queue
+
+
+def send_to_admin(
+    subject: str, body: str, config: Config | None = None, kind: str = "mail"
+) -> None:
+    """Send an e-mail, queued if the mail queue is running.
+
+    Without a queue, config defaults to the config passed to configure.
+    """
+    if mail_queue:
+        mail_queue.put(kind, subject, body)
+        return
+    if config is None:
+        config = default_config
+    if config is None:
+        logger.error("mail not configured, dropping admin mail: %s", subject)
+        return
+    send_mail(subject, body, config)
+
+
+def due(key: str, interval: float) -> bool:
+    """Rate limit mails, true if no mail with this key was sent in the interval."""
+    now = time.time()
+    if now - last_sent.get(key, 0.0) < interval:
+        return False
+    last_sent[key] = now
+    return True
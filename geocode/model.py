@@ -1,5 +1,7 @@
 """Database model."""
 
+import typing
+
 import sqlalchemy
 import sqlalchemy.orm.query
 from geoalchemy2 import Geometry
@@ -7,9 +9,19 @@ from sqlalchemy import and_, cast, func, or_
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import column_property
-from sqlalchemy.schema import Column
-from sqlalchemy.types import DateTime, Float, Integer, Numeric, String
+from sqlalchemy.orm import column_property, defer
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.types import (
+    BigInteger,
+    Boolean,
+    DateTime,
+    Float,
+    Integer,
+    LargeBinary,
+    Numeric,
+    String,
+    Text,
+)
 
 from .database import now_utc, session
 
@@ -45,23 +57,42 @@ class Polygon(Base):
         """Area in square kilometers."""
         return float(self.area) / (1000 * 1000)
 
+    @classmethod
+    def is_candidate(cls) -> sqlalchemy.sql.elements.ColumnElement[bool]:
+        """Filter for polygons that can be used for a lookup."""
+        return or_(
+            cls.boundary == "political",
+            cls.boundary == "place",
+            and_(
+                cls.admin_level.isnot(None),  # type: ignore
+                cls.admin_level.regexp_match(r"^\d+$"),  # type: ignore
+            ),
+        )
+
+    @classmethod
+    def coords_within_select(
+        cls, lat: typing.Any, lon: typing.Any, columns: typing.Sequence[typing.Any] = ()
+    ) -> sqlalchemy.sql.Select:
+        """Select polygons that contain given coordinates.
+
+        The geometry isn't loaded, a lookup only needs the tags.
+        """
+        point = func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
+        q = (
+            sqlalchemy.select(*columns)
+            if columns
+            else sqlalchemy.select(cls).options(defer(cls.way))
+        )
+        return q.filter(cls.is_candidate(), func.ST_Within(point, cls.way)).order_by(
+            cls.area, cast(cls.admin_level, Integer).desc()
+        )
+
     @classmethod
     def coords_within(
         cls, lat: str | float, lon: str | float
     ) -> sqlalchemy.orm.query.Query:  # type: ignore
         """Polygons that contain given coordinates."""
-        point = func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
-        q = cls.query.filter(
-            or_(
-                cls.boundary == "political",
-                cls.boundary == "place",
-                and_(
-                    cls.admin_level.isnot(None),  # type: ignore
-                    cls.admin_level.regexp_match(r"^\d+$"),  # type: ignore
-                ),
-            ),
-            func.ST_Within(point, cls.way),
-        ).order_by(cls.area, cast(cls.admin_level, Integer).desc())
+        q = session.query(cls).from_statement(cls.coords_within_select(lat, lon))
         return q  # type: ignore
 
 
@@ -96,3 +127,66 @@ class LookupLog(Base):
     fqdn = Column(String)
     result = Column(postgresql.JSONB)
     response_time_ms = Column(Integer)
+
+
+class WikidataCache(Base):
+    """Cached responses from the Wikidata API and WDQS."""
+
+    __tablename__ = "wikidata_cache"
+
+    key = Column(String, primary_key=True)
+    value = Column(postgresql.JSONB, nullable=False)
+    fetched = Column(DateTime, default=now_utc(), nullable=False)
+    # QIDs and codes the value depends on, for invalidation from change feeds
+    refs = Column(postgresql.ARRAY(String))
+
+    __table_args__ = (Index("wikidata_cache_refs_idx", refs, postgresql_using="gin"),)
+
+
+class DataVersion(Base):
+    """When each data source behind the lookups was last refreshed."""
+
+    __tablename__ = "data_version"
+
+    source = Column(String, primary_key=True)
+    updated = Column(DateTime, default=now_utc(), nullable=False)
+
+
+class SimplifiedGeometry(Base):
+    """Polygon geometry simplified for display, at several tolerance levels."""
+
+    __tablename__ = "simplified_geometry"
+
+    osm_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    level = Column(Integer, primary_key=True, autoincrement=False)
+    geojson = Column(Text, nullable=False)
+    updated = Column(DateTime, default=now_utc(), nullable=False)
+
+
+class ResolvedBoundary(Base):
+    """Wikidata item and Commons category resolved for a boundary, for map tiles."""
+
+    __tablename__ = "resolved_boundary"
+
+    osm_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    wikidata = Column(String)
+    commons_cat = Column(String)
+    admin_level = Column(Integer)
+    updated = Column(DateTime, default=now_utc(), nullable=False)
+
+
+class Profile(Base):
+    """Profile of a lookup, with the upstream calls it made."""
+
+    __tablename__ = "profile"
+
+    id = Column(Integer, primary_key=True)
+    lookup_log_id = Column(Integer, ForeignKey("lookup_log.id"), index=True)
+    dt = Column(DateTime, default=now_utc(), nullable=False)
+    lat = Column(Float)
+    lon = Column(Float)
+    sampled = Column(Boolean, nullable=False)
+    duration_ms = Column(Integer, nullable=False)
+    summary = Column(Text, nullable=False)
+    stats = Column(LargeBinary, nullable=False)
+    trace = Column(postgresql.JSONB, nullable=False)
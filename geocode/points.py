@@ -0,0 +1,31 @@
+"""Points of a /batch request, shared by the lookup, async and router apps."""
+
+import typing
+
+Point = tuple[float, float]
+
+
+class PointsError(ValueError):
+    """Batch request can't be parsed."""
+
+
+def parse_batch(data: typing.Any, max_points: int) -> list[Point]:
+    """Points from a JSON object with a list of [lat, lon] pairs.
+
+    Coordinates out of range are returned, each gets an error result.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("points"), list):
+        raise PointsError("expected a JSON object with a list of points")
+    pairs = data["points"]
+    if len(pairs) > max_points:
+        raise PointsError(f"batch is limited to {max_points} points")
+
+    points = []
+    for num, pair in enumerate(pairs):
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise PointsError(f"point {num}: expected [lat, lon]")
+        try:
+            points.append((float(pair[0]), float(pair[1])))
+        except (TypeError, ValueError):
+            raise PointsError(f"point {num}: lat and lon must be numbers")
+    return points
@@ -0,0 +1,45 @@
+"""Server-side prepared statements for the hot spatial queries.
+
+PostgreSQL plans a prepared statement once per connection instead of on
+every lookup. The statements are compiled from the same queries as the
+unprepared versions and prepared when a connection is opened, see
+database.get_engine.
+"""
+
+from sqlalchemy import literal_column, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import Select
+
+from . import database, scotland
+from .model import Polygon
+
+# columns of Polygon a lookup needs, in the order the statement returns them
+polygon_columns = (
+    Polygon.osm_id,
+    Polygon.admin_level,
+    Polygon.boundary,
+    Polygon.way_area,
+    Polygon.tags,
+    Polygon.area,
+)
+
+
+def compile_sql(select: Select) -> str:
+    """SQL for a query with all values inline, for use in PREPARE."""
+    dialect = postgresql.dialect(paramstyle="named")
+    compiled = select.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+    return str(compiled)
+
+
+lat, lon = literal_column("$1::float8"), literal_column("$2::float8")
+database.prepared_statements.update(
+    {
+        "coords_within": compile_sql(
+            Polygon.coords_within_select(lat, lon, polygon_columns)
+        ),
+        "scotland_code": compile_sql(scotland.scotland_code_select(lat, lon)),
+    }
+)
+
+coords_within = text("EXECUTE coords_within(:lat, :lon)").columns(*polygon_columns)
+scotland_code = text("EXECUTE scotland_code(:lat, :lon)")
@@ -0,0 +1,103 @@
+"""Profile lookups, on request by an admin or for a sample of requests."""
+
+import cProfile
+import hmac
+import io
+import marshal
+import pstats
+import random
+import time
+import typing
+from types import TracebackType
+
+from . import trace
+from .database import session
+from .model import Profile
+
+Config = typing.Mapping[str, typing.Any]
+
+# percentage of lookups to profile
+sample_percent = 0.0
+admin_password: str | None = None
+# number of functions in the text summary
+summary_lines = 40
+
+
+def configure(config: Config) -> None:
+    """Read PROFILE_SAMPLE_PERCENT and ADMIN_PASSWORD from app config."""
+    global sample_percent, admin_password
+    sample_percent = config.get("PROFILE_SAMPLE_PERCENT", 0.0)
+    admin_password = config.get("ADMIN_PASSWORD")
+
+
+def is_admin(password: str | None) -> bool:
+    """Password matches the admin password, always false if none is set."""
+    return bool(
+        admin_password
+        and password
+        and hmac.compare_digest(password.encode(), admin_password.encode())
+    )
+
+
+def sampled() -> bool:
+    """Pick this request for profiling, at the sample rate."""
+    return sample_percent > 0 and random.random() * 100 < sample_percent
+
+
+class Profiler:
+    """Run code under cProfile while collecting a trace of upstream calls."""
+
+    def __init__(self, sampled: bool) -> None:
+        """Init."""
+        self.sampled = sampled
+        self.profile = cProfile.Profile()
+        self.trace = trace.start()
+        self.calls: list[trace.Call] = []
+        self.start = 0.0
+        self.duration = 0.0
+
+    def __enter__(self) -> "Profiler":
+        """Start profiling."""
+        self.calls = self.trace.__enter__()
+        self.start = time.perf_counter()
+        self.profile.enable()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        """Stop profiling."""
+        self.profile.disable()
+        self.duration = time.perf_counter() - self.start
+        self.trace.__exit__(exc_type, exc, tb)
+
+    def summary(self) -> str:
+        """Functions with the most cumulative time, as text."""
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(summary_lines)
+        return out.getvalue()
+
+    def stats(self) -> bytes:
+        """Profile in the format written by cProfile, for pstats or snakeviz."""
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)  # type: ignore
+
+    def save(self, lookup_log_id: int | None, lat: float, lon: float) -> Profile:
+        """Store profile and trace."""
+        profile = Profile(
+            lookup_log_id=lookup_log_id,
+            lat=lat,
+            lon=lon,
+            sampled=self.sampled,
+            duration_ms=int(self.duration * 1000),
+            summary=self.summary(),
+            stats=self.stats(),
+            trace=[c.as_dict() for c in self.calls],
+        )
+        session.add(profile)
+        session.commit()
+        return profile
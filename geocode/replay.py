@@ -0,0 +1,219 @@
+"""Replay lookup_log traffic against an instance and compare with the log.
+
+Requests are sent with the same spacing as the logged traffic, optionally
+sped up, so the latency figures show how the target copes with real load.
+The stand-in server answers api.php and WDQS requests from the Wikidata
+cache, for replays that shouldn't depend on or add load to Wikidata.
+"""
+
+import http.server
+import json
+import threading
+import time
+import typing
+import urllib.parse
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from . import cache, headers
+from .database import session
+from .model import LookupLog
+
+StrDict = dict[str, typing.Any]
+
+
+def load(start: datetime, end: datetime, limit: int | None = None) -> list[LookupLog]:
+    """Logged lookups in the time window, oldest first."""
+    q = (
+        session.query(LookupLog)
+        .filter(LookupLog.dt >= start, LookupLog.dt < end)
+        .order_by(LookupLog.dt)
+    )
+    return q.limit(limit).all() if limit else q.all()
+
+
+def result_key(result: StrDict | None) -> tuple[typing.Any, ...]:
+    """Parts of a result that matter when comparing lookups."""
+    if not result:
+        return ()
+    commons_cat = result.get("commons_cat")
+    return (
+        result.get("wikidata"),
+        commons_cat.get("title") if isinstance(commons_cat, dict) else None,
+        result.get("admin_level"),
+        bool(result.get("missing")),
+        "error" in result,
+    )
+
+
+class Outcome:
+    """Replayed lookup with the logged and new response."""
+
+    def __init__(self, log: LookupLog) -> None:
+        """Init."""
+        self.log_id: int = log.id
+        self.lat: float = log.lat
+        self.lon: float = log.lon
+        self.logged_result: StrDict | None = log.result
+        self.logged_ms: int | None = log.response_time_ms
+        self.new_ms: float | None = None
+        self.status: int | None = None
+        self.result: StrDict | None = None
+        self.error: str | None = None
+
+    @property
+    def changed(self) -> bool:
+        """Result differs from the logged result."""
+        return self.error is None and result_key(self.result) != result_key(
+            self.logged_result
+        )
+
+
+local = threading.local()
+
+
+def fetch(target: str, outcome: Outcome, timeout: float) -> Outcome:
+    """Send one lookup to the target."""
+    if not hasattr(local, "http"):
+        local.http = requests.Session()
+        local.http.headers.update(headers)
+    params = {"lat": outcome.lat, "lon": outcome.lon}
+    t0 = time.perf_counter()
+    try:
+        r = local.http.get(target, params=params, timeout=timeout)
+        outcome.status = r.status_code
+        outcome.result = r.json()
+    except (requests.RequestException, ValueError) as e:
+        outcome.error = f"{type(e).__name__}: {e}"
+    outcome.new_ms = (time.perf_counter() - t0) * 1000
+    if outcome.status is not None and outcome.status != 200 and not outcome.error:
+        outcome.error = f"HTTP {outcome.status}"
+    return outcome
+
+
+def replay(
+    target: str,
+    logs: list[LookupLog],
+    speed: float = 1.0,
+    workers: int = 32,
+    timeout: float = 60.0,
+    progress: Callable[[str], None] = lambda msg: None,
+) -> list[Outcome]:
+    """Replay logged lookups with their original spacing divided by speed.
+
+    A speed of 0 sends requests as fast as the workers allow.
+    """
+    if not logs:
+        return []
+    first = logs[0].dt
+    started = time.monotonic()
+    futures: list[Future[Outcome]] = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for num, log in enumerate(logs, start=1):
+            if speed:
+                due = started + (log.dt - first).total_seconds() / speed
+                if (wait := due - time.monotonic()) > 0:
+                    time.sleep(wait)
+            futures.append(executor.submit(fetch, target, Outcome(log), timeout))
+            if num % 1000 == 0:
+                progress(f"{num:,d} / {len(logs):,d} requests sent")
+    return [f.result() for f in futures]
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def compare(outcomes: list[Outcome], duration: float) -> StrDict:
+    """Latency distribution and result changes compared with the log."""
+    logged = [float(o.logged_ms) for o in outcomes if o.logged_ms is not None]
+    new = [o.new_ms for o in outcomes if o.new_ms is not None and not o.error]
+    return {
+        "requests": len(outcomes),
+        "errors": sum(1 for o in outcomes if o.error),
+        "changed": [o for o in outcomes if o.changed],
+        "rate": len(outcomes) / duration if duration else 0.0,
+        "latency": {
+            p: (percentile(logged, p), percentile(new, p)) for p in (50, 90, 99, 100)
+        },
+    }
+
+
+def format_report(report: StrDict, examples: int = 20) -> list[str]:
+    """Report as lines of text."""
+
+    def ms(value: float | None) -> str:
+        return f"{value:,.0f} ms" if value is not None else "-"
+
+    lines = [
+        f"{report['requests']:,d} requests at {report['rate']:.1f}/s, "
+        + f"{report['errors']:,d} errors, {len(report['changed']):,d} changed results",
+        "percentile      logged         new",
+    ]
+    for p, (logged, new) in report["latency"].items():
+        label = "max" if p == 100 else f"p{p}"
+        lines.append(f"{label:>10} {ms(logged):>11} {ms(new):>11}")
+    for o in report["changed"][:examples]:
+        lines.append(
+            f"log {o.log_id} {o.lat:.4f},{o.lon:.4f}: "
+            + f"{result_key(o.logged_result)} -> {result_key(o.result)}"
+        )
+    return lines
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Answer api.php and WDQS requests from the Wikidata cache."""
+
+    latency = 0.0
+    misses = 0
+
+    def send_json(self, data: typing.Any) -> None:
+        """Send JSON response after the simulated latency."""
+        if self.latency:
+            time.sleep(self.latency)
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        """Wikidata API call."""
+        query = urllib.parse.urlparse(self.path).query
+        params = dict(urllib.parse.parse_qsl(query))
+        params.pop("format", None)
+        params.pop("formatversion", None)
+        value = cache.get(cache.api_key(params))
+        if value is None:
+            type(self).misses += 1
+            value = {"entities": {}}
+        self.send_json(value)
+
+    def do_POST(self) -> None:
+        """WDQS query."""
+        length = int(self.headers.get("Content-Length", 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+        value = cache.get(cache.wdqs_key(form["query"][0]))
+        if value is None:
+            type(self).misses += 1
+            value = []
+        self.send_json({"results": {"bindings": value}})
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        """Don't log every request."""
+
+
+def stand_in_server(
+    host: str, port: int, latency: float = 0.0
+) -> http.server.ThreadingHTTPServer:
+    """Server standing in for api.php and WDQS, latency is in seconds."""
+    StandInHandler.latency = latency
+    return http.server.ThreadingHTTPServer((host, port), StandInHandler)
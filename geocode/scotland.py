@@ -1,17 +1,19 @@
 """Reverse geocode civil parishes in Scotland."""
 
-from sqlalchemy import func
+from sqlalchemy import func, select
+from sqlalchemy.sql import Select
 
 from geocode.database import session
 from geocode.model import Scotland
 
 
+def scotland_code_select(lat: float, lon: float) -> Select:
+    """Select code of civil parish in Scotland containing given lat/lon."""
+    point = func.ST_Transform(func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326), 27700)
+    return select(Scotland.code).filter(func.ST_Contains(Scotland.geom, point)).limit(1)
+
+
 def get_scotland_code(lat: float, lon: float) -> str | None:
     """Find civil parish in Scotland for given lat/lon."""
-    point = func.ST_Transform(func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326), 27700)
-    result = (
-        session.query(Scotland.code)
-        .filter(func.ST_Contains(Scotland.geom, point))
-        .first()
-    )
+    result = session.execute(scotland_code_select(lat, lon)).first()
     return result[0] if result else None
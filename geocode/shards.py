@@ -0,0 +1,180 @@
+"""Split boundary data by region and route lookups to regional shards.
+
+A shard is an instance of the lookup app serving one region, from a boundary
+index or database holding every boundary that intersects the region's bounding
+box. Any boundary containing a point inside the box is then on the shard, so
+any shard whose box contains a point gives the same answer as a single
+instance with all the data. Boxes of neighbouring regions overlap at borders.
+"""
+
+import typing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import headers, wikidata
+
+Config = typing.Mapping[str, typing.Any]
+StrDict = dict[str, typing.Any]
+Point = tuple[float, float]
+# west, south, east, north
+BBox = tuple[float, float, float, float]
+
+# default bounding boxes, with a margin around each region
+regions: dict[str, BBox] = {
+    "england_wales": (-6.5, 49.8, 2.0, 55.9),
+    "scotland": (-8.8, 54.6, -0.6, 61.0),
+    "northern_ireland": (-8.3, 53.9, -5.3, 55.5),
+    "ireland": (-10.7, 51.3, -5.9, 55.5),
+}
+
+
+class ShardError(Exception):
+    """Shard didn't answer."""
+
+    def __init__(self, shard: "Shard", reason: str) -> None:
+        """Init."""
+        super().__init__(f"shard {shard.name}: {reason}")
+        self.shard = shard
+
+
+class Shard:
+    """Lookup app instance serving one region."""
+
+    def __init__(self, name: str, url: str, bbox: BBox) -> None:
+        """Init."""
+        self.name = name
+        self.url = url.rstrip("/")
+        self.bbox = bbox
+
+    def __repr__(self) -> str:
+        """Repr."""
+        return f"Shard({self.name!r}, {self.url!r})"
+
+    @property
+    def area(self) -> float:
+        """Area of the bounding box in square degrees."""
+        west, south, east, north = self.bbox
+        return (east - west) * (north - south)
+
+    def contains(self, lat: float, lon: float) -> bool:
+        """Point is inside the bounding box."""
+        west, south, east, north = self.bbox
+        return west <= lon <= east and south <= lat <= north
+
+
+def region_bbox(config: Config, name: str) -> BBox:
+    """Bounding box of a region, from SHARDS config or the default regions."""
+    settings = config.get("SHARDS", {}).get(name, {})
+    bbox = settings.get("bbox") or regions.get(name)
+    if not bbox:
+        raise KeyError(f"unknown region {name}")
+    return typing.cast(BBox, tuple(bbox))
+
+
+def load(config: Config) -> list[Shard]:
+    """Shards from SHARDS config, a dict of region name to url and bbox."""
+    return [
+        Shard(name, settings["url"], region_bbox(config, name))
+        for name, settings in config.get("SHARDS", {}).items()
+    ]
+
+
+def outside(lat: float, lon: float) -> wikidata.WikidataDict:
+    """Result for a point outside every shard."""
+    return wikidata.build_dict(None, lat, lon)
+
+
+class Router:
+    """Send each point to the smallest shard containing it and merge results."""
+
+    def __init__(
+        self,
+        shards: list[Shard],
+        http: requests.Session | None = None,
+        timeout: float = 30.0,
+        workers: int = 8,
+    ) -> None:
+        """Init."""
+        self.shards = sorted(shards, key=lambda shard: shard.area)
+        if http is None:
+            http = requests.Session()
+            http.headers.update(headers)
+        self.http = http
+        self.timeout = timeout
+        self.workers = workers
+
+    @classmethod
+    def from_config(cls, config: Config) -> "Router":
+        """Router for the shards in app config."""
+        return cls(
+            load(config),
+            timeout=config.get("ROUTER_TIMEOUT", 30.0),
+            workers=config.get("ROUTER_WORKERS", 8),
+        )
+
+    def shard_for(self, lat: float, lon: float) -> Shard | None:
+        """Smallest shard with the point inside its bounding box."""
+        return next((s for s in self.shards if s.contains(lat, lon)), None)
+
+    def request(
+        self, shard: Shard, method: str, path: str, **kwargs: typing.Any
+    ) -> typing.Any:
+        """Call a shard and decode the JSON response."""
+        try:
+            r = self.http.request(
+                method, shard.url + path, timeout=self.timeout, **kwargs
+            )
+            r.raise_for_status()
+            return r.json()
+        except (requests.RequestException, ValueError) as e:
+            raise ShardError(shard, str(e))
+
+    def lookup(
+        self, lat: float, lon: float, params: StrDict | None = None
+    ) -> wikidata.WikidataDict:
+        """Lookup one point on its shard, params are passed on."""
+        if not (shard := self.shard_for(lat, lon)):
+            return outside(lat, lon)
+        result: wikidata.WikidataDict = self.request(
+            shard, "GET", "/", params={**(params or {}), "lat": lat, "lon": lon}
+        )
+        return result
+
+    def batch(
+        self, points: list[Point], params: StrDict | None = None
+    ) -> list[wikidata.WikidataDict]:
+        """Lookup points with a batch per shard, results in the original order.
+
+        A shard that fails gives an error result for each of its points.
+        """
+        results: list[wikidata.WikidataDict | None] = [None] * len(points)
+        by_shard: dict[Shard, list[int]] = defaultdict(list)
+        for num, (lat, lon) in enumerate(points):
+            if shard := self.shard_for(lat, lon):
+                by_shard[shard].append(num)
+            else:
+                results[num] = outside(lat, lon)
+
+        def send(shard: Shard, nums: list[int]) -> None:
+            body = {"points": [points[num] for num in nums]}
+            try:
+                reply = self.request(shard, "POST", "/batch", params=params, json=body)
+                shard_results = reply["results"]
+            except ShardError as e:
+                shard_results = [
+                    {
+                        "coords": {"lat": points[num][0], "lon": points[num][1]},
+                        "error": str(e),
+                    }
+                    for num in nums
+                ]
+            for num, result in zip(nums, shard_results):
+                results[num] = result
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(send, *item) for item in by_shard.items()]:
+                future.result()
+
+        return [typing.cast(wikidata.WikidataDict, r) for r in results]
@@ -0,0 +1,80 @@
+"""Build SPARQL queries from templates without a Flask app context."""
+
+import os
+import typing
+
+import jinja2
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import SparqlLexer
+
+template_dir = os.path.join(os.path.dirname(__file__), "..", "templates", "sparql")
+env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(template_dir), auto_reload=False
+)
+# compiled once at import, so forked workers share them and never stat the files
+templates = {name: env.get_template(name) for name in env.list_templates()}
+
+
+class Query(str):
+    """SPARQL query, remembering the template it was rendered from.
+
+    refs are the codes the result depends on, used to invalidate the cached
+    result when an item gains or loses a code, see changes.py.
+    """
+
+    template: str
+    refs: typing.Sequence[str] = ()
+
+
+def render(
+    template_name: str, refs: typing.Sequence[str] = (), **context: typing.Any
+) -> Query:
+    """Render SPARQL template."""
+    query = Query(templates[template_name].render(**context))
+    query.template = template_name
+    query.refs = refs
+    return query
+
+
+def geosearch_query(lat: float, lon: float) -> str:
+    """Query for places near the given coordinates."""
+    return render("geosearch.sparql", lat=f"{lat:f}", lon=f"{lon:f}")
+
+
+def scottish_parish_query(code: str) -> str:
+    """Query for Scottish parish by code."""
+    return render("scottish_parish.sparql", refs=[f"parish:{code}"], code=code)
+
+
+def gss_query(gss: str) -> str:
+    """Query for item with a GSS code."""
+    return render("lookup_gss.sparql", refs=[f"gss:{gss}"], gss=gss)
+
+
+def name_query(name: str, lat: float, lon: float) -> str:
+    """Query for item with a given name near the coordinates."""
+    return render("lookup_by_name.sparql", name=repr(name), lat=str(lat), lon=str(lon))
+
+
+def scottish_parish_batch_query(codes: typing.Sequence[str]) -> Query:
+    """Query for Scottish parishes by code, ?key is the position in codes."""
+    return render("scottish_parish_batch.sparql", codes=codes)
+
+
+def gss_batch_query(codes: typing.Sequence[str]) -> Query:
+    """Query for items with GSS codes, ?key is the position in codes."""
+    return render("lookup_gss_batch.sparql", codes=codes)
+
+
+def name_batch_query(places: typing.Sequence[tuple[str, float, float]]) -> Query:
+    """Query for items by name near coordinates, ?key is the position in places."""
+    context = [(repr(name), str(lat), str(lon)) for name, lat, lon in places]
+    return render("lookup_by_name_batch.sparql", places=context)
+
+
+def highlight_sparql(query: str) -> str:
+    """Highlight SPARQL query syntax using Pygments."""
+    lexer = SparqlLexer()
+    formatter = HtmlFormatter()
+    return highlight(query, lexer, formatter)
@@ -0,0 +1,178 @@
+"""Mapbox Vector Tiles of resolved boundaries for the map page.
+
+Each qualifying boundary is resolved to a Wikidata item and Commons category
+ahead of time by resolve, so a tile is a single ST_AsMVT query and the map
+can show the result of a click without a lookup. Tiles are cached on disk in
+a directory per data version.
+"""
+
+import os
+import typing
+from collections.abc import Callable
+
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import Insert, Select
+
+from . import data_version, wikidata
+from .database import now_utc, read_session, session
+from .engine import LookupEngine
+from .model import Polygon, ResolvedBoundary
+from .upstream import UpstreamUnavailable
+from .warmup import Throttle
+
+Config = typing.Mapping[str, typing.Any]
+
+layer_name = "boundaries"
+min_zoom = 6
+max_zoom = 14
+extent = 4096
+# circumference of the earth in web mercator metres
+world_size = 40_075_016.686
+
+cache_dir: str | None = None
+
+
+def configure(config: Config) -> None:
+    """Enable the disk cache if TILE_CACHE_DIR is set in app config."""
+    global cache_dir
+    cache_dir = config.get("TILE_CACHE_DIR")
+
+
+def valid(z: int, x: int, y: int) -> bool:
+    """Tile coordinates are in range."""
+    return min_zoom <= z <= max_zoom and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def min_area(z: int) -> float:
+    """Smallest boundary drawn at a zoom, in square web mercator metres."""
+    screen_pixel = world_size / (256 * 2**z)
+    return (4 * screen_pixel) ** 2
+
+
+def tile_select(z: int, x: int, y: int) -> Select:
+    """Select the tile as MVT, smallest boundaries last so they draw on top.
+
+    Geometry is simplified to a tile pixel and boundaries smaller than a few
+    pixels are left out. Areas are measured in web mercator, way_area from
+    osm2pgsql is in square degrees for SRID 4326.
+    """
+    envelope = func.ST_TileEnvelope(z, x, y)
+    pixel = world_size / (extent * 2**z)
+    way = func.ST_Transform(Polygon.way, 3857)
+    area = func.ST_Area(way)
+    geom = func.ST_AsMVTGeom(func.ST_Simplify(way, pixel), envelope, extent)
+    rows = (
+        select(
+            Polygon.osm_id,
+            Polygon.tags["name"].label("name"),
+            ResolvedBoundary.admin_level,
+            ResolvedBoundary.wikidata,
+            ResolvedBoundary.commons_cat,
+            geom.label("geom"),
+        )
+        .join(ResolvedBoundary, ResolvedBoundary.osm_id == Polygon.osm_id)
+        .where(
+            ResolvedBoundary.wikidata.isnot(None),
+            Polygon.way.intersects(func.ST_Transform(envelope, 4326)),
+            area > min_area(z),
+        )
+        .order_by(area.desc())
+        .subquery("tile")
+    )
+    mvt = func.ST_AsMVT(literal_column("tile"), layer_name, extent, "geom")
+    return select(mvt).select_from(rows)
+
+
+def render(z: int, x: int, y: int) -> bytes:
+    """Render tile from the database."""
+    return bytes(read_session.execute(tile_select(z, x, y)).scalar() or b"")
+
+
+def tile_path(version: str, z: int, x: int, y: int) -> str:
+    """Path of a tile in the disk cache."""
+    assert cache_dir
+    return os.path.join(cache_dir, version, str(z), str(x), f"{y}.mvt")
+
+
+def get_tile(z: int, x: int, y: int) -> bytes:
+    """Tile from the disk cache, rendered and saved if missing."""
+    if not cache_dir:
+        return render(z, x, y)
+
+    path = tile_path(data_version.current(), z, x, y)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    tile = render(z, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(tile)
+    os.replace(tmp, path)
+    return tile
+
+
+def upsert_resolved(osm_id: int, hit: wikidata.Hit | None) -> Insert:
+    """Insert or replace the resolved Wikidata item for a boundary."""
+    values = {
+        "osm_id": osm_id,
+        "wikidata": hit["wikidata"] if hit else None,
+        "commons_cat": hit["commons_cat"] if hit else None,
+        "admin_level": hit.get("admin_level") if hit else None,
+        "updated": now_utc(),
+    }
+    q = insert(ResolvedBoundary).values(**values)
+    return q.on_conflict_do_update(
+        index_elements=[ResolvedBoundary.osm_id],
+        set_={k: getattr(q.excluded, k) for k in values if k != "osm_id"},
+    )
+
+
+def unresolved(refresh: bool = False) -> list[typing.Any]:
+    """Qualifying boundaries with a point inside, for resolving."""
+    point = func.ST_PointOnSurface(Polygon.way)
+    q = session.query(
+        Polygon.osm_id,
+        Polygon.tags,
+        func.ST_Y(point).label("lat"),
+        func.ST_X(point).label("lon"),
+    ).filter(Polygon.is_candidate())
+    if not refresh:
+        resolved = select(ResolvedBoundary.osm_id)
+        q = q.filter(Polygon.osm_id.not_in(resolved))
+    return q.all()
+
+
+def resolve(
+    lookup: LookupEngine,
+    refresh: bool = False,
+    rate: float = 2.0,
+    progress: Callable[[str], None] = lambda msg: None,
+) -> int:
+    """Resolve qualifying boundaries to a Wikidata item and Commons category.
+
+    Boundaries are resolved the way a lookup resolves its smallest boundary.
+    Stops early if Wikidata becomes unavailable, returns the number resolved.
+    """
+    throttle = Throttle(rate)
+    boundaries = unresolved(refresh)
+    count = 0
+    try:
+        for row in boundaries:
+            throttle.wait()
+            try:
+                hit = lookup.osm_lookup([row], row.lat, row.lon)
+            except wikidata.QueryError:
+                continue
+            session.execute(upsert_resolved(row.osm_id, hit))
+            session.commit()
+            count += 1
+            if count % 100 == 0:
+                progress(f"{count:,d} / {len(boundaries):,d} boundaries")
+    except UpstreamUnavailable as e:
+        progress(f"stopped early: {e}")
+    return count
@@ -0,0 +1,79 @@
+"""Trace of the upstream calls made while handling a request.
+
+Only collected inside start, so requests that aren't being profiled pay
+nothing beyond a context variable lookup.
+"""
+
+import contextlib
+import contextvars
+import time
+import typing
+from collections.abc import Iterator
+
+import backoff.types
+
+
+class Call:
+    """Call to api.php or WDQS, including retries and cache hits."""
+
+    def __init__(self, kind: str, detail: str | None) -> None:
+        """Init."""
+        self.kind = kind
+        self.detail = detail
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.retries = 0
+        self.cached = True
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        """Call details for storing as JSON."""
+        return {
+            "kind": self.kind,
+            "detail": self.detail,
+            "duration_ms": round(self.duration * 1000, 1),
+            "retries": self.retries,
+            "cached": self.cached,
+        }
+
+
+current: contextvars.ContextVar[list[Call] | None] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+@contextlib.contextmanager
+def start() -> Iterator[list[Call]]:
+    """Collect a trace of upstream calls."""
+    calls: list[Call] = []
+    token = current.set(calls)
+    try:
+        yield calls
+    finally:
+        current.reset(token)
+
+
+@contextlib.contextmanager
+def call(kind: str, detail: str | None) -> Iterator[Call | None]:
+    """Record an upstream call if a trace is being collected."""
+    calls = current.get()
+    if calls is None:
+        yield None
+        return
+    c = Call(kind, detail)
+    calls.append(c)
+    try:
+        yield c
+    finally:
+        c.duration = time.perf_counter() - c.start
+
+
+def fetched(c: Call | None) -> None:
+    """Mark call as going to the upstream rather than the cache."""
+    if c:
+        c.cached = False
+
+
+def retry(details: backoff.types.Details) -> None:
+    """Count a retry of the current call, for use as a backoff on_backoff handler."""
+    if calls := current.get():
+        calls[-1].retries += 1
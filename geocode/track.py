@@ -0,0 +1,225 @@
+"""Geocode a GPS track as a sequence of places.
+
+Instead of a lookup per point, the points are matched against the qualifying
+polygons that intersect the track in a single query. Each distinct polygon is
+then resolved through Wikidata once for the whole track.
+"""
+
+import typing
+
+from sqlalchemy import Float, Integer, bindparam, cast, func, select
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
+from sqlalchemy.orm import defer
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.selectable import CTE
+
+from . import deadline
+from .engine import Batches, Element, LookupEngine
+from .model import Polygon, Scotland
+from .wikidata import Hit, WikidataDict
+
+Point = tuple[float, float]
+StrDict = dict[str, typing.Any]
+
+
+class TrackError(ValueError):
+    """Track can't be geocoded."""
+
+
+def parse_points(data: typing.Any, max_points: int) -> list[Point]:
+    """Points from a list of [lat, lon] or a GeoJSON LineString or Feature."""
+    if not isinstance(data, dict):
+        raise TrackError("expected a JSON object")
+    if data.get("type") == "Feature":
+        data = data.get("geometry") or {}
+    if "points" in data:
+        pairs = data["points"]
+    elif data.get("type") == "LineString":
+        # GeoJSON positions are [lon, lat]
+        pairs = [position[1::-1] for position in data.get("coordinates", [])]
+    else:
+        raise TrackError("expected points or a GeoJSON LineString")
+
+    if len(pairs) < 2:
+        raise TrackError("a track needs at least 2 points")
+    if len(pairs) > max_points:
+        raise TrackError(f"track is limited to {max_points} points")
+
+    try:
+        points = [(float(lat), float(lon)) for lat, lon in pairs]
+    except (TypeError, ValueError):
+        raise TrackError("each point must be a pair of numbers")
+    for num, (lat, lon) in enumerate(points):
+        if lat < -90 or lat > 90 or lon < -180 or lon > 180:
+            raise TrackError(
+                f"point {num}: lat must be between -90 and 90, "
+                + "and lon must be between -180 and 180"
+            )
+    return points
+
+
+def points_cte(points: typing.Sequence[Point]) -> CTE:
+    """Track points with their index, from two array parameters."""
+    lats = bindparam("lats", [lat for lat, lon in points], type_=ARRAY(Float))
+    lons = bindparam("lons", [lon for lat, lon in points], type_=ARRAY(Float))
+    rows = (
+        func.unnest(lats, lons)
+        .table_valued("lat", "lon", with_ordinality="num")
+        .render_derived()
+    )
+    geom = func.ST_SetSRID(func.ST_MakePoint(rows.c.lon, rows.c.lat), 4326)
+    return select((rows.c.num - 1).label("idx"), geom.label("geom")).cte("points")
+
+
+def containing_select(points: typing.Sequence[Point]) -> Select:
+    """Polygons containing each point, smallest first, as (idx, osm_id) rows.
+
+    Only polygons that intersect the track line are tested against the points.
+    """
+    pts = points_cte(points)
+    line = func.ST_MakeLine(aggregate_order_by(pts.c.geom, pts.c.idx))
+    track = select(line.label("geom")).cte("track")
+    crossed = (
+        select(
+            Polygon.osm_id,
+            Polygon.admin_level,
+            Polygon.way,
+            Polygon.area.label("area"),
+        )
+        .where(Polygon.is_candidate(), func.ST_Intersects(Polygon.way, track.c.geom))
+        .cte("crossed")
+    )
+    return (
+        select(pts.c.idx, crossed.c.osm_id)
+        .join(crossed, func.ST_Within(pts.c.geom, crossed.c.way))
+        .order_by(
+            pts.c.idx, crossed.c.area, cast(crossed.c.admin_level, Integer).desc()
+        )
+    )
+
+
+def scotland_select(points: typing.Sequence[Point]) -> Select:
+    """Code of the Scottish civil parish for each point inside one."""
+    pts = points_cte(points)
+    point = func.ST_Transform(pts.c.geom, 27700)
+    return (
+        select(pts.c.idx, Scotland.code)
+        .join(Scotland, func.ST_Contains(Scotland.geom, point))
+        .distinct(pts.c.idx)
+        .order_by(pts.c.idx)
+    )
+
+
+def polygons_select(osm_ids: typing.Collection[int]) -> Select:
+    """Polygons by OSM ID, without geometry."""
+    return (
+        select(Polygon)
+        .options(defer(Polygon.way))
+        .where(Polygon.osm_id.in_(list(osm_ids)))
+    )
+
+
+def containing(
+    lookup: LookupEngine, points: typing.Sequence[Point]
+) -> tuple[list[str | None], list[list[Element]], bool]:
+    """Scottish parish code and containing polygons for each point.
+
+    The last item is False if the queries ran out of time, the codes and
+    polygons are then whatever was found before that.
+    """
+    if lookup.boundary_index:
+        return (
+            [lookup.get_scotland_code(lat, lon) for lat, lon in points],
+            [lookup.coords_within(lat, lon) for lat, lon in points],
+            True,
+        )
+
+    db = lookup.read_db
+    codes: list[str | None] = [None] * len(points)
+    elements: list[list[Element]] = [[] for _ in points]
+    try:
+        for idx, code in lookup.read_query(
+            lambda: db.execute(scotland_select(points)).all()
+        ):
+            codes[idx] = code
+
+        pairs = lookup.read_query(lambda: db.execute(containing_select(points)).all())
+        osm_ids = {osm_id for idx, osm_id in pairs}
+        polygons = (
+            lookup.read_query(
+                lambda: {p.osm_id: p for p in db.scalars(polygons_select(osm_ids))}
+            )
+            if osm_ids
+            else {}
+        )
+    except deadline.DeadlineExceeded:
+        return codes, elements, False
+
+    for idx, osm_id in pairs:
+        elements[idx].append(polygons[osm_id])
+    return codes, elements, True
+
+
+def place_key(result: WikidataDict) -> tuple[typing.Any, ...]:
+    """Parts of a result that identify the place."""
+    commons_cat = result.get("commons_cat")
+    return (
+        result.get("wikidata"),
+        commons_cat.get("title") if isinstance(commons_cat, dict) else None,
+        result.get("error"),
+    )
+
+
+def geocode_track(
+    lookup: LookupEngine, points: typing.Sequence[Point]
+) -> list[StrDict]:
+    """Places along the track in order, with the range of points in each.
+
+    Points inside the same set of polygons share a lookup, and the WDQS
+    lookups by code and name are batched across the track. Unlike a single
+    lookup there is no geosearch for points outside any boundary below
+    admin_level 7, that would need a WDQS query per point.
+
+    If the spatial queries run out of time every place is marked degraded.
+    """
+    codes, elements, complete = containing(lookup, points)
+
+    batches = Batches(lookup.wikidata)
+    queued = set()
+    for (lat, lon), code, found in zip(points, codes, elements):
+        if (key := (code, tuple(e.osm_id for e in found))) in queued:
+            continue
+        queued.add(key)
+        if code:
+            batches.parishes.add(code)
+        batches.add_elements(found, lat, lon)
+
+    hits: dict[int, Hit | None] = {}
+    parishes: dict[str, WikidataDict] = {}
+    results: dict[tuple[typing.Any, ...], WikidataDict] = {}
+    places: list[StrDict] = []
+    for idx, ((lat, lon), code, found) in enumerate(zip(points, codes, elements)):
+        key = (code, tuple(e.osm_id for e in found))
+        if key not in results:
+            result = None
+            if code:
+                if code not in parishes:
+                    parishes[code] = lookup.scottish_parish(code, lat, lon, batches)
+                result = parishes[code]
+            if not result or result.get("missing"):
+                degraded = bool(result and result.get("degraded"))
+                result = lookup.do_lookup(found, lat, lon, hits, batches)
+                if degraded:
+                    result = {**result, "degraded": True}
+            if not complete:
+                result = {**result, "degraded": True}
+            results[key] = result
+
+        result = results[key]
+        if places and place_key(places[-1]) == place_key(result):
+            places[-1]["end"] = idx
+            continue
+        place = {k: v for k, v in result.items() if k not in ("coords", "element")}
+        places.append({"start": idx, "end": idx, **place})
+
+    return places
@@ -0,0 +1,209 @@
+"""Rate limits and circuit breakers for calls to api.php and WDQS."""
+
+import contextlib
+import email.utils
+import fcntl
+import os
+import struct
+import threading
+import time
+import typing
+from collections.abc import Iterator
+
+Config = typing.Mapping[str, typing.Any]
+
+
+class UpstreamUnavailable(Exception):
+    """Upstream is rate limited or the circuit breaker is open."""
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a Retry-After header."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class TokenBucket:
+    """Token bucket, shared between worker processes when given a state file."""
+
+    # tokens, time of last update, time the upstream asked us to wait until
+    state_struct = struct.Struct("<ddd")
+
+    def __init__(
+        self, rate: float, burst: float, state_path: str | None = None
+    ) -> None:
+        """Init."""
+        self.rate = rate
+        self.burst = burst
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.state = [burst, time.time(), 0.0]
+
+    @contextlib.contextmanager
+    def locked_state(self) -> Iterator[list[float]]:
+        """Lock and yield the bucket state, saving any changes."""
+        if not self.state_path:
+            with self.lock:
+                yield self.state
+            return
+
+        # open the file on every call: flock locks belong to the open file,
+        # which is shared with any worker forked after it was opened
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, self.state_struct.size, 0)
+            state = (
+                list(self.state_struct.unpack(data))
+                if len(data) == self.state_struct.size
+                else [self.burst, time.time(), 0.0]
+            )
+            yield state
+            os.pwrite(fd, self.state_struct.pack(*state), 0)
+        finally:
+            os.close(fd)
+
+    def reserve(self, max_wait: float) -> float | None:
+        """Take a token, return seconds to wait for it or None if that is too long."""
+        with self.locked_state() as state:
+            tokens, updated, blocked_until = state
+            now = time.time()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = max(blocked_until - now, (1 - tokens) / self.rate, 0.0)
+            if wait > max_wait:
+                state[:2] = [tokens, now]
+                return None
+            state[:2] = [tokens - 1, now]
+            return wait
+
+    def block_until(self, until: float) -> None:
+        """Stop handing out tokens until the given time."""
+        with self.locked_state() as state:
+            state[2] = max(state[2], until)
+
+
+class CircuitBreaker:
+    """Stop calling an upstream after repeated failures or a Retry-After."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        """Init."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        """Circuit is open and calls should fail fast."""
+        return time.time() < self.open_until
+
+    def record_success(self) -> None:
+        """Close the circuit after a successful call."""
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self, retry_after: float | None = None) -> None:
+        """Count failure, open the circuit when over the threshold.
+
+        After the timeout the next call is let through. Until a call succeeds
+        the failure count stays over the threshold, so another failure opens
+        the circuit again straight away.
+        """
+        with self.lock:
+            self.failures += 1
+            if retry_after is not None:
+                self.open_until = max(self.open_until, time.time() + retry_after)
+            elif self.failures >= self.failure_threshold:
+                self.open_until = time.time() + self.reset_timeout
+
+
+class Upstream:
+    """Rate limit and circuit breaker for one upstream service."""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float,
+        max_wait: float = 2.0,
+        failure_threshold: int = 10,
+        reset_timeout: float = 30.0,
+        state_path: str | None = None,
+    ) -> None:
+        """Init."""
+        self.name = name
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(rate, burst, state_path)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def acquire(self, budget: float | None = None) -> float:
+        """Check the circuit and take a token, return seconds to wait.
+
+        budget is the time left for the request, waiting longer than it fails.
+        """
+        if self.breaker.is_open():
+            raise UpstreamUnavailable(f"{self.name}: circuit open")
+        max_wait = self.max_wait if budget is None else min(self.max_wait, budget)
+        wait = self.bucket.reserve(max_wait)
+        if wait is None:
+            raise UpstreamUnavailable(f"{self.name}: rate limited")
+        return wait
+
+    def before_request(self, budget: float | None = None) -> None:
+        """Wait for a token before making a request."""
+        if wait := self.acquire(budget):
+            time.sleep(wait)
+
+    def record_failure(self) -> None:
+        """Record a failed request, such as a connection error."""
+        self.breaker.record_failure()
+
+    def check_response(self, status_code: int, headers: Config) -> None:
+        """Update the circuit from the response status.
+
+        429 and 503 open the circuit for the Retry-After period and raise
+        UpstreamUnavailable, so callers don't retry. Other server errors count
+        as failures and are left to the caller.
+        """
+        if status_code in (429, 503):
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            self.breaker.record_failure(retry_after or self.breaker.reset_timeout)
+            if retry_after:
+                self.bucket.block_until(time.time() + retry_after)
+            raise UpstreamUnavailable(f"{self.name}: HTTP {status_code}")
+        if status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def configure(self, config: Config, prefix: str) -> None:
+        """Apply settings from app config, like WDQS_RATE and WDQS_BURST."""
+        state_dir = config.get("UPSTREAM_STATE_DIR")
+        state_path = os.path.join(state_dir, prefix.lower()) if state_dir else None
+        self.max_wait = config.get(f"{prefix}_MAX_WAIT", self.max_wait)
+        self.bucket = TokenBucket(
+            config.get(f"{prefix}_RATE", self.bucket.rate),
+            config.get(f"{prefix}_BURST", self.bucket.burst),
+            state_path,
+        )
+        self.breaker = CircuitBreaker(
+            config.get(f"{prefix}_FAILURE_THRESHOLD", self.breaker.failure_threshold),
+            config.get(f"{prefix}_RESET_TIMEOUT", self.breaker.reset_timeout),
+        )
+
+
+api = Upstream("api.php", rate=20, burst=20)
+wdqs = Upstream("WDQS", rate=5, burst=10)
+
+
+def configure(config: Config) -> None:
+    """Configure upstream limits from app config."""
+    api.configure(config, "API")
+    wdqs.configure(config, "WDQS")
@@ -0,0 +1,140 @@
+"""Fill the Wikidata cache from lookup history before workers take traffic."""
+
+import time
+import typing
+from collections.abc import Callable
+from datetime import timedelta
+
+import requests
+from sqlalchemy import func
+
+from . import samples, wikidata
+from .database import now_utc, session
+from .model import LookupLog
+from .upstream import UpstreamUnavailable
+
+# returns a reply like LookupEngine.lat_lon_to_wikidata
+Lookup = Callable[[float, float], dict[str, typing.Any]]
+
+# errors from a single lookup, counted and skipped
+lookup_errors = (
+    wikidata.QueryError,
+    wikidata.APIResponseError,
+    requests.RequestException,
+)
+
+
+def since(days: int) -> typing.Any:
+    """Start of the history window."""
+    return now_utc() - timedelta(days=days)
+
+
+def total_lookups(days: int) -> int:
+    """Number of lookups in the window."""
+    q = session.query(func.count(LookupLog.id)).filter(LookupLog.dt > since(days))
+    return typing.cast(int, q.scalar())
+
+
+def frequent_coords(days: int, limit: int) -> list[tuple[float, float, int]]:
+    """Most frequently requested distinct coordinates."""
+    num = func.count(LookupLog.id).label("num")
+    q = (
+        session.query(LookupLog.lat, LookupLog.lon, num)
+        .filter(LookupLog.dt > since(days))
+        .group_by(LookupLog.lat, LookupLog.lon)
+        .order_by(num.desc())
+        .limit(limit)
+    )
+    return [(lat, lon, count) for lat, lon, count in q]
+
+
+def frequent_places(days: int, limit: int) -> list[tuple[str, int]]:
+    """Most frequently returned Wikidata items."""
+    qid = LookupLog.result["wikidata"].astext.label("qid")
+    num = func.count(LookupLog.id).label("num")
+    q = (
+        session.query(qid, num)
+        .filter(LookupLog.dt > since(days), qid.isnot(None))
+        .group_by(qid)
+        .order_by(num.desc())
+        .limit(limit)
+    )
+    return [(qid, count) for qid, count in q]
+
+
+class Throttle:
+    """Space out calls to stay under a rate per second."""
+
+    def __init__(self, rate: float) -> None:
+        """Init."""
+        self.interval = 1 / rate
+        self.next_call = time.monotonic()
+
+    def wait(self) -> None:
+        """Sleep until the next call is allowed."""
+        now = time.monotonic()
+        if self.next_call > now:
+            time.sleep(self.next_call - now)
+        self.next_call = max(now, self.next_call) + self.interval
+
+
+def warm(
+    lookup: Lookup,
+    days: int = 7,
+    limit: int = 1000,
+    rate: float = 2.0,
+    progress: Callable[[str], None] = lambda msg: None,
+) -> dict[str, typing.Any]:
+    """Replay frequent coordinates, places and samples through the lookup.
+
+    Stops early if Wikidata becomes unavailable, which the lookup reports as a
+    degraded result. Returns counts and the share of lookups in the window
+    covered by the warmed coordinates and places.
+    """
+    throttle = Throttle(rate)
+    total = total_lookups(days)
+    coords = frequent_coords(days, limit)
+    places = frequent_places(days, limit)
+    points = [(lat, lon) for lat, lon, _ in coords]
+    points += [(lat, lon) for lat, lon, _ in samples if (lat, lon) not in points]
+
+    warmed_coords: set[tuple[float, float]] = set()
+    warmed_places: set[str] = set()
+    errors = 0
+    try:
+        for lat, lon in points:
+            throttle.wait()
+            try:
+                reply = lookup(lat, lon)
+            except lookup_errors:
+                errors += 1
+                continue
+            if reply["result"].get("degraded"):
+                raise UpstreamUnavailable("lookup degraded, Wikidata unavailable")
+            warmed_coords.add((lat, lon))
+            if len(warmed_coords) % 100 == 0:
+                progress(f"{len(warmed_coords):,d} / {len(points):,d} coordinates")
+
+        for qid, _ in places:
+            throttle.wait()
+            try:
+                wikidata.qid_to_commons_category(qid)
+            except lookup_errors:
+                errors += 1
+                continue
+            warmed_places.add(qid)
+    except UpstreamUnavailable as e:
+        progress(f"stopped early: {e}")
+
+    coords_hits = sum(
+        count for lat, lon, count in coords if (lat, lon) in warmed_coords
+    )
+    place_hits = sum(count for qid, count in places if qid in warmed_places)
+    return {
+        "total_lookups": total,
+        "coords": len(warmed_coords),
+        "places": len(warmed_places),
+        "errors": errors,
+        "coords_coverage": coords_hits / total if total else 0.0,
+        "places_coverage": place_hits / total if total else 0.0,
+    }
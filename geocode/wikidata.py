@@ -2,26 +2,57 @@
 
 import typing
 import urllib.parse
+from collections.abc import Callable, Iterable
 
 import backoff
 import backoff.types
 import requests
-from flask import render_template
 from requests.exceptions import JSONDecodeError, RequestException
+from sqlalchemy.orm import Session
 
-from . import headers, mail
+from . import cache, deadline, headers, mail, sparql, trace, upstream
+from .boundaries import parse_admin_level
+from .upstream import UpstreamUnavailable
 
+Config = typing.Mapping[str, typing.Any]
+
+api_url = "https://www.wikidata.org/w/api.php"
 wikidata_query_api_url = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
 wd_entity = "http://www.wikidata.org/entity/Q"
 commons_cat_start = "https://commons.wikimedia.org/wiki/Category:"
 
+city_of_london_qid = "Q23311"
+fallback_qid_to_commons_cat = {"Q68816332": "Orphir", "Q68815208": "Crail"}
+
+# seconds between admin mails about the same kind of failure
+giveup_mail_interval = 600
+# most keys in a batched WDQS query, keeps each query within the WDQS timeout
+batch_size = 50
+
+K = typing.TypeVar("K", bound=typing.Hashable)
+# name, lat, lon
+NameKey = tuple[str, float, float]
+
+
+def configure(config: Config) -> None:
+    """Use other api.php and WDQS endpoints if set, such as the replay stand-in."""
+    global api_url, wikidata_query_api_url, batch_size
+    api_url = config.get("WIKIDATA_API_URL", api_url)
+    wikidata_query_api_url = config.get("WDQS_URL", wikidata_query_api_url)
+    batch_size = config.get("WDQS_BATCH_SIZE", batch_size)
+
 
 def giveup(details: backoff.types.Details) -> None:
     """Display API call fail debug info."""
     last_exception = details["exception"]  # type: ignore
+    if deadline.expired():
+        return
     if last_exception and isinstance(last_exception, APIResponseError):
+        status = last_exception.response.status_code
+        if not mail.due(f"api call {status}", giveup_mail_interval):
+            return
         body = f"Error making Wikidata API call\n\n{last_exception.response.text}"
-        mail.send_to_admin("Geocode error", body)
+        mail.send_to_admin("Geocode error", body, kind=type(last_exception).__name__)
 
 
 class QueryError(Exception):
@@ -46,24 +77,38 @@ class APIResponseError(Exception):
     backoff.expo,
     (RequestException, APIResponseError),
     max_tries=5,
+    max_time=deadline.remaining,
+    on_backoff=trace.retry,
     on_giveup=giveup,
 )
-def api_call(params: dict[str, str | int]) -> dict[str, typing.Any]:
-    """Wikidata API call."""
+def api_request(
+    params: dict[str, str | int], http: requests.Session | None = None
+) -> dict[str, typing.Any]:
+    """Wikidata API call, subject to the api.php rate limit and circuit breaker.
+
+    Retries and the timeout are limited by the request deadline.
+    """
     api_params: dict[str, str | int] = {"format": "json", "formatversion": 2, **params}
+    upstream.api.before_request(deadline.remaining())
     try:
-        r = requests.get(
-            "https://www.wikidata.org/w/api.php", params=api_params, headers=headers
+        r = (http or requests).get(
+            api_url, params=api_params, headers=headers, timeout=deadline.timeout()
         )
+    except RequestException:
+        if not deadline.expired():
+            upstream.api.record_failure()
+        raise
+    upstream.api.check_response(r.status_code, r.headers)
+    try:
         return typing.cast(dict[str, typing.Any], r.json())
     except JSONDecodeError:
         raise APIResponseError("Failed to decode JSON", r)
 
 
-def get_entity(qid: str) -> dict[str, typing.Any] | None:
-    """Get Wikidata entity."""
-    json_data = api_call({"action": "wbgetentities", "ids": qid})
-
+def entity_from_response(
+    json_data: dict[str, typing.Any],
+) -> dict[str, typing.Any] | None:
+    """Entity from a wbgetentities response, None if missing."""
     try:
         entity: dict[str, typing.Any] = list(json_data["entities"].values())[0]
     except KeyError:
@@ -71,13 +116,9 @@ def get_entity(qid: str) -> dict[str, typing.Any] | None:
     return entity if "missing" not in entity else None
 
 
-def qid_to_commons_category(qid: str, check_p910: bool = True) -> str | None:
-    """Commons category for a given Wikidata item."""
-    entity = get_entity(qid)
+def commons_cat_from_entity(entity: dict[str, typing.Any]) -> str | None:
+    """Commons category from P373 or the Commons sitelink of an entity."""
     cat_start = "Category:"
-    if not entity:
-        return None
-
     try:
         cat: str = entity["claims"]["P373"][0]["mainsnak"]["datavalue"]["value"]
         return cat
@@ -91,27 +132,50 @@ def qid_to_commons_category(qid: str, check_p910: bool = True) -> str | None:
 
     if sitelink:
         return sitelink[len(cat_start) :] if sitelink.startswith(cat_start) else None
+    return None
 
-    if not check_p910:
-        return None
 
+def category_item_qid(entity: dict[str, typing.Any]) -> str | None:
+    """QID of the category item (P910) to check when there is no sitelink."""
+    if "commonswiki" in entity.get("sitelinks", {}):
+        return None
     try:
-        cat_qid = entity["claims"]["P910"][0]["mainsnak"]["datavalue"]["value"]["id"]
+        cat_qid: str = entity["claims"]["P910"][0]["mainsnak"]["datavalue"]["value"][
+            "id"
+        ]
+        return cat_qid
     except Exception:
         return None
 
-    return qid_to_commons_category(cat_qid, check_p910=False)
-
 
 Row = dict[str, dict[str, typing.Any]]
 
 
-@backoff.on_exception(backoff.expo, QueryError, max_tries=5)
-def wdqs(query: str) -> list[Row]:
-    """Pass query to the Wikidata Query Service."""
-    r = requests.post(
-        wikidata_query_api_url, data={"query": query, "format": "json"}, headers=headers
-    )
+@backoff.on_exception(
+    backoff.expo,
+    QueryError,
+    max_tries=5,
+    max_time=deadline.remaining,
+    on_backoff=trace.retry,
+)
+def wdqs_request(query: str, http: requests.Session | None = None) -> list[Row]:
+    """Pass query to WDQS, subject to the WDQS rate limit and circuit breaker.
+
+    Retries and the timeout are limited by the request deadline.
+    """
+    upstream.wdqs.before_request(deadline.remaining())
+    try:
+        r = (http or requests).post(
+            wikidata_query_api_url,
+            data={"query": query, "format": "json"},
+            headers=headers,
+            timeout=deadline.timeout(),
+        )
+    except RequestException:
+        if not deadline.expired():
+            upstream.wdqs.record_failure()
+        raise
+    upstream.wdqs.check_response(r.status_code, r.headers)
 
     try:
         return typing.cast(list[Row], r.json()["results"]["bindings"])
@@ -134,15 +198,12 @@ def wd_uri_to_qid(value: str) -> str:
 
 def geosearch_query(lat: float, lon: float) -> str:
     """Geosearch via WDQS."""
-    lat_str, lon_str = f"{lat:f}", f"{lon:f}"
-    query = render_template("sparql/geosearch.sparql", lat=lat_str, lon=lon_str)
-    return query
+    return sparql.geosearch_query(lat, lon)
 
 
-def geosearch(lat: float, lon: float) -> Row | None:
-    """Geosearch."""
+def pick_geosearch_row(rows: list[Row]) -> Row | None:
+    """Pick the nearest suitable place from geosearch results."""
     default_max_dist = 1
-    rows = wdqs(geosearch_query(lat, lon))
     max_dist = {
         "Q188509": 1,  # suburb
         "Q3957": 2,  # town
@@ -173,22 +234,18 @@ def geosearch(lat: float, lon: float) -> Row | None:
     return None
 
 
-def lookup_scottish_parish_in_wikidata(code: str) -> list[Row]:
-    """Lookup scottish parish in Wikidata."""
-    return wdqs(render_template("sparql/scottish_parish.sparql", code=code))
-
-
-def lookup_gss_in_wikidata(gss: str) -> list[Row]:
-    """Lookup GSS in Wikidata."""
-    return wdqs(render_template("sparql/lookup_gss.sparql", gss=gss))
+def add_missing_commons_cat(rows: list[Row]) -> None:
+    """Add missing details for Commons Categories to Wikidata query results."""
+    for row in rows:
+        if "commonsSiteLink" in row or "commonsCat" in row:
+            continue
 
+        qid = row["item"]["value"].rpartition("/")[2]
+        if qid not in fallback_qid_to_commons_cat:
+            continue
 
-def lookup_wikidata_by_name(name: str, lat: float, lon: float) -> list[Row]:
-    """Lookup place in Wikidata by name."""
-    query = render_template(
-        "sparql/lookup_by_name.sparql", name=repr(name), lat=str(lat), lon=str(lon)
-    )
-    return wdqs(query)
+        commons_cat = fallback_qid_to_commons_cat[qid]
+        row["commonsCat"] = {"type": "literal", "value": commons_cat}
 
 
 def unescape_title(t: str) -> str:
@@ -213,9 +270,272 @@ def commons_from_rows(rows: list[Row]) -> Hit | None:
     return None
 
 
+def entity_refs(json_data: dict[str, typing.Any]) -> list[str]:
+    """QIDs of the entities in an API response."""
+    return list(json_data.get("entities", {}))
+
+
+def query_refs(query: str, rows: list[Row]) -> list[str]:
+    """Codes a query depends on and the QIDs of the items in its result."""
+    qids = {
+        wd_uri_to_qid(row["item"]["value"])
+        for row in rows
+        if row.get("item", {}).get("type") == "uri"
+    }
+    return [*getattr(query, "refs", ()), *sorted(qids)]
+
+
+class Wikidata:
+    """Wikidata API and WDQS calls with injected HTTP session and database.
+
+    Without an HTTP session each request opens a new connection. Without a
+    database session the cache uses the global session.
+    """
+
+    def __init__(
+        self, http: requests.Session | None = None, db: Session | None = None
+    ) -> None:
+        """Init."""
+        self.http = http
+        self.db = db
+
+    def api_call(self, params: dict[str, str | int]) -> dict[str, typing.Any]:
+        """Wikidata API call, using the cache when enabled."""
+        with trace.call("api", str(params.get("ids") or params["action"])) as c:
+
+            def fetch() -> dict[str, typing.Any]:
+                trace.fetched(c)
+                with deadline.upstream_call():
+                    return api_request(params, self.http)
+
+            return cache.cached(
+                cache.api_key(params),
+                fetch,
+                lambda v: "error" not in v,
+                db=self.db,
+                refs=entity_refs,
+            )
+
+    def wdqs(self, query: str) -> list[Row]:
+        """Pass query to the Wikidata Query Service, using the cache when enabled."""
+        with trace.call("wdqs", getattr(query, "template", None)) as c:
+
+            def fetch() -> list[Row]:
+                trace.fetched(c)
+                with deadline.upstream_call():
+                    return wdqs_request(query, self.http)
+
+            return cache.cached(
+                cache.wdqs_key(query),
+                fetch,
+                db=self.db,
+                refs=lambda rows: query_refs(query, rows),
+            )
+
+    def get_entity(self, qid: str) -> dict[str, typing.Any] | None:
+        """Get Wikidata entity."""
+        return entity_from_response(
+            self.api_call({"action": "wbgetentities", "ids": qid})
+        )
+
+    def qid_to_commons_category(self, qid: str, check_p910: bool = True) -> str | None:
+        """Commons category for a given Wikidata item."""
+        entity = self.get_entity(qid)
+        if not entity:
+            return None
+
+        cat = commons_cat_from_entity(entity)
+        if cat or not check_p910 or not (cat_qid := category_item_qid(entity)):
+            return cat
+
+        return self.qid_to_commons_category(cat_qid, check_p910=False)
+
+    def geosearch(self, lat: float, lon: float) -> Row | None:
+        """Geosearch."""
+        return pick_geosearch_row(self.wdqs(geosearch_query(lat, lon)))
+
+    def lookup_scottish_parish(self, code: str) -> list[Row]:
+        """Lookup scottish parish in Wikidata."""
+        return self.wdqs(sparql.scottish_parish_query(code))
+
+    def lookup_gss(self, gss: str) -> list[Row]:
+        """Lookup GSS in Wikidata."""
+        return self.wdqs(sparql.gss_query(gss))
+
+    def lookup_by_name(self, name: str, lat: float, lon: float) -> list[Row]:
+        """Lookup place in Wikidata by name."""
+        return self.wdqs(sparql.name_query(name, lat, lon))
+
+    def get_commons_cat_from_gss(self, gss: str) -> Hit | None:
+        """Get commons from GSS via Wikidata."""
+        return commons_from_rows(self.lookup_gss(gss))
+
+    def wdqs_many(
+        self,
+        keys: Iterable[K],
+        single: Callable[[K], str],
+        batch: Callable[[list[K]], str],
+    ) -> dict[K, list[Row]]:
+        """Rows for each key, fetching keys that aren't cached in batched queries.
+
+        The rows for a key are cached as the result of its single-key query, so
+        single and batched lookups share the cache.
+        """
+        queries = {key: single(key) for key in keys}
+        results: dict[K, list[Row]] = {}
+        if cache.enabled():
+            for key, query in queries.items():
+                value = cache.get(cache.wdqs_key(query), cache.ttl, self.db)
+                if value is not None:
+                    results[key] = value
+        missing = [key for key in queries if key not in results]
+        for start in range(0, len(missing), batch_size):
+            chunk = missing[start : start + batch_size]
+            results |= self.wdqs_batch(chunk, queries, batch(chunk))
+        return results
+
+    def wdqs_batch(
+        self, chunk: list[K], queries: dict[K, str], query: str
+    ) -> dict[K, list[Row]]:
+        """Run a batched query and split the rows by the ?key position in chunk."""
+        with trace.call("wdqs", getattr(query, "template", None)) as c:
+            trace.fetched(c)
+            try:
+                with deadline.upstream_call():
+                    rows = wdqs_request(query, self.http)
+            except UpstreamUnavailable:
+                if not cache.enabled():
+                    raise
+                stale = {
+                    key: cache.get(cache.wdqs_key(queries[key]), db=self.db)
+                    for key in chunk
+                }
+                if any(value is None for value in stale.values()):
+                    raise
+                return stale
+
+        found: dict[K, list[Row]] = {key: [] for key in chunk}
+        for row in rows:
+            found[chunk[int(row.pop("key")["value"])]].append(row)
+        if cache.enabled():
+            for key, key_rows in found.items():
+                refs = query_refs(queries[key], key_rows)
+                cache.put(cache.wdqs_key(queries[key]), key_rows, self.db, refs)
+        return found
+
+    def lookup_gss_many(self, codes: Iterable[str]) -> dict[str, list[Row]]:
+        """Lookup GSS codes in Wikidata, in batches."""
+        return self.wdqs_many(codes, sparql.gss_query, sparql.gss_batch_query)
+
+    def lookup_scottish_parish_many(self, codes: Iterable[str]) -> dict[str, list[Row]]:
+        """Lookup Scottish parishes in Wikidata, in batches."""
+        return self.wdqs_many(
+            codes, sparql.scottish_parish_query, sparql.scottish_parish_batch_query
+        )
+
+    def lookup_by_name_many(
+        self, places: Iterable[NameKey]
+    ) -> dict[NameKey, list[Row]]:
+        """Lookup places in Wikidata by name near coordinates, in batches."""
+        return self.wdqs_many(
+            places, lambda place: sparql.name_query(*place), sparql.name_batch_query
+        )
+
+
+class BatchLookup(typing.Generic[K]):
+    """Keys likely to be looked up, fetched a batch at a time on first use.
+
+    Nothing is fetched until a key is needed, then that key is fetched along
+    with pending keys up to the batch size.
+    """
+
+    def __init__(self, fetch: Callable[[list[K]], dict[K, list[Row]]]) -> None:
+        """Init."""
+        self.fetch = fetch
+        self.pending: dict[K, None] = {}
+        self.results: dict[K, list[Row]] = {}
+
+    def add(self, key: K) -> None:
+        """Queue key for the next batch."""
+        if key not in self.results:
+            self.pending[key] = None
+
+    def get(self, key: K) -> list[Row]:
+        """Rows for key."""
+        if key not in self.results:
+            others = [k for k in self.pending if k != key]
+            keys = [key, *others[: batch_size - 1]]
+            self.results |= self.fetch(keys)
+            for k in keys:
+                self.pending.pop(k, None)
+        return self.results.get(key, [])
+
+
+def api_call(params: dict[str, str | int]) -> dict[str, typing.Any]:
+    """Wikidata API call, using the cache when enabled."""
+    return Wikidata().api_call(params)
+
+
+def wdqs(query: str) -> list[Row]:
+    """Pass query to the Wikidata Query Service, using the cache when enabled."""
+    return Wikidata().wdqs(query)
+
+
+def get_entity(qid: str) -> dict[str, typing.Any] | None:
+    """Get Wikidata entity."""
+    return Wikidata().get_entity(qid)
+
+
+def qid_to_commons_category(qid: str, check_p910: bool = True) -> str | None:
+    """Commons category for a given Wikidata item."""
+    return Wikidata().qid_to_commons_category(qid, check_p910)
+
+
+def geosearch(lat: float, lon: float) -> Row | None:
+    """Geosearch."""
+    return Wikidata().geosearch(lat, lon)
+
+
+def lookup_scottish_parish_in_wikidata(code: str) -> list[Row]:
+    """Lookup scottish parish in Wikidata."""
+    return Wikidata().lookup_scottish_parish(code)
+
+
+def lookup_gss_in_wikidata(gss: str) -> list[Row]:
+    """Lookup GSS in Wikidata."""
+    return Wikidata().lookup_gss(gss)
+
+
+def lookup_wikidata_by_name(name: str, lat: float, lon: float) -> list[Row]:
+    """Lookup place in Wikidata by name."""
+    return Wikidata().lookup_by_name(name, lat, lon)
+
+
 def get_commons_cat_from_gss(gss: str) -> Hit | None:
     """Get commons from GSS via Wikidata."""
-    return commons_from_rows(lookup_gss_in_wikidata(gss))
+    return Wikidata().get_commons_cat_from_gss(gss)
+
+
+def degraded_hit(elements: typing.Sequence[typing.Any]) -> Hit | None:
+    """Hit from the wikidata tag of the smallest boundary, without Wikidata calls.
+
+    Used when Wikidata is unavailable, so there is no Commons category.
+    """
+    for e in elements:
+        tags = e.tags
+        if not (qid := tags.get("wikidata")):
+            continue
+        admin_level = parse_admin_level(tags.get("admin_level"))
+        if admin_level is None and tags.get("boundary") not in ("political", "place"):
+            continue
+        return {
+            "wikidata": qid,
+            "commons_cat": None,
+            "admin_level": admin_level,
+            "element": e.osm_id,
+            "degraded": True,
+        }
+    return None
 
 
 WikidataDict = dict[str, None | bool | str | int | dict[str, typing.Any]]
@@ -232,8 +552,9 @@ def build_dict(hit: Hit | None, lat: float, lon: float) -> WikidataDict:
         "admin_level": hit.get("admin_level"),
         "wikidata": hit["wikidata"],
         "element": hit.get("element"),
-        "geojson": hit.get("geojson"),
     }
+    if hit.get("degraded"):
+        ret["degraded"] = True
     if not commons_cat:
         return ret
 
@@ -1,39 +1,84 @@
 #!/usr/bin/python3
 """Reverse geocode: convert lat/lon to Wikidata item & Wikimedia Commons category."""
 
+import contextlib
+import functools
 import inspect
 import random
 import socket
 import sys
 import traceback
 import typing
+from datetime import datetime
 from time import time
 
+import click
+import requests
 import sqlalchemy.exc
 import werkzeug.debug.tbtools
-from flask import Flask, jsonify, redirect, render_template, request, url_for
-from pygments import highlight
+from flask import (
+    Flask,
+    abort,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
 from pygments.formatters import HtmlFormatter
-from pygments.lexers import SparqlLexer
 from sqlalchemy import func
-from sqlalchemy.orm.query import Query
 from werkzeug.wrappers import Response
 
 import geocode
-from geocode import database, model, scotland, wikidata
+from geocode import (
+    boundaries,
+    cache,
+    changes,
+    data_version,
+    database,
+    deadline,
+    engine,
+    formats,
+    geometry,
+    model,
+    points,
+    profiling,
+    replay,
+    shards,
+    sparql,
+    tiles,
+    track,
+    upstream,
+    warmup,
+    wikidata,
+)
 from geocode.error_mail import setup_error_mail
 
-city_of_london_qid = "Q23311"
 app = Flask(__name__)
 app.config.from_object("config.default")
 database.init_app(app)
 setup_error_mail(app)
+upstream.configure(app.config)
+cache.configure(app.config)
+data_version.configure(app.config)
+tiles.configure(app.config)
+profiling.configure(app.config)
+wikidata.configure(app.config)
 
-Tags = typing.Mapping[str, str]
-StrDict = dict[str, typing.Any]
 logging_enabled = True
 
-fallback_qid_to_commons_cat = {"Q68816332": "Orphir", "Q68815208": "Crail"}
+boundary_index = (
+    boundaries.BoundaryIndex(app.config["BOUNDARY_INDEX"])
+    if app.config.get("BOUNDARY_INDEX")
+    else None
+)
+lookup_engine = engine.LookupEngine(
+    database.session,
+    boundary_index=boundary_index,
+    read_db=database.read_session,
+    use_prepared=app.config.get("DB_PREPARED_STATEMENTS", True),
+)
 
 
 @app.errorhandler(werkzeug.exceptions.InternalServerError)
@@ -75,151 +120,62 @@ def get_random_lat_lon() -> tuple[float, float]:
     return lat, lon
 
 
-def do_lookup(
-    elements: "Query[model.Polygon]", lat: float, lon: float
-) -> wikidata.WikidataDict:
-    """Do lookup."""
-    try:
-        hit = osm_lookup(elements, lat, lon)
-    except wikidata.QueryError as e:
-        return {
-            "query": e.query,
-            "error": e.r.text,
-            "query_url": "https://query.wikidata.org/#" + e.query,
-        }
-
-    return wikidata.build_dict(hit, lat, lon)
-
-
-def add_missing_commons_cat(rows: list[StrDict]) -> None:
-    """Add missing details for Commons Categories to Wikidata query results."""
-    for row in rows:
-        if "commonsSiteLink" in row or "commonsCat" in row:
-            continue
-
-        qid = row["item"]["value"].rpartition("/")[2]
-        if qid not in fallback_qid_to_commons_cat:
-            continue
-
-        commons_cat = fallback_qid_to_commons_cat[qid]
-        row["commonsCat"] = {"type": "literal", "value": commons_cat}
+def coords_valid(lat: float, lon: float) -> bool:
+    """Coordinates are in range."""
+    return -90 <= lat <= 90 and -180 <= lon <= 180
 
 
-def lat_lon_to_wikidata(lat: float, lon: float) -> dict[str, typing.Any]:
-    """Lookup lat/lon and find most appropriate Wikidata item."""
-    scotland_code = scotland.get_scotland_code(lat, lon)
+def lookup_deadline() -> typing.ContextManager[None]:
+    """Latency budget for a lookup of one point."""
+    return deadline.start(app.config.get("LOOKUP_DEADLINE", 10.0))
 
-    elements: typing.Any
-    if scotland_code:
-        rows = wikidata.lookup_scottish_parish_in_wikidata(scotland_code)
-        add_missing_commons_cat(rows)
-        hit = wikidata.commons_from_rows(rows)
-        elements = []
-        result = wikidata.build_dict(hit, lat, lon)
 
-        if not result.get("missing"):
-            return {"elements": elements, "result": result}
+def batch_deadline() -> typing.ContextManager[None]:
+    """Latency budget for a batch or track lookup."""
+    return deadline.start(app.config.get("BATCH_DEADLINE", 60.0))
 
-    elements = model.Polygon.coords_within(lat, lon)
-    result = do_lookup(elements, lat, lon)
 
-    # special case because the City of London is admin_level=6 in OSM
-    if result.get("wikidata") == city_of_london_qid:
-        return {"elements": elements, "result": result}
+View = typing.Callable[..., typing.Any]
 
-    admin_level = result.get("admin_level")
-    if not admin_level:
-        return {"elements": elements, "result": result}
 
-    assert isinstance(admin_level, int)
-    if admin_level >= 7:
-        return {"elements": elements, "result": result}
-
-    row = wikidata.geosearch(lat, lon)
-    if row:
-        hit = wikidata.commons_from_rows([row])
-        elements = []
-        result = wikidata.build_dict(hit, lat, lon)
-
-    query = wikidata.geosearch_query(lat, lon)
-
-    return {"elements": elements, "result": result, "query": query}
-
-
-def get_admin_level(tags: Tags) -> int | None:
-    """Read admin_level from tags."""
-    admin_level_tag = tags.get("admin_level")
-    return (
-        int(admin_level_tag) if admin_level_tag and admin_level_tag.isdigit() else None
-    )
+def element_geojson(
+    elements: list[engine.Element], element_id: int | None, zoom: float | None = None
+) -> str | None:
+    """Simplified GeoJSON of the element that gave the result.
 
+    The level comes from the map zoom if known, otherwise from the zoom that
+    shows the whole element.
+    """
+    if element_id is None:
+        return None
+    if zoom is not None:
+        level = geometry.level_for_zoom(zoom)
+    else:
+        area = next((e.area for e in elements if e.osm_id == element_id), 0.0)
+        level = geometry.level_for_area(area)
+    return geometry.get_simplified(element_id, level)
 
-def hit_from_wikidata_tag(tags: Tags) -> wikidata.Hit | None:
-    """Check element for a wikidata tag."""
-    return (
-        {
-            "wikidata": qid,
-            "commons_cat": commons,
-        }
-        if "wikidata" in tags
-        and (commons := wikidata.qid_to_commons_category(qid := tags["wikidata"]))
-        else None
-    )
 
+def is_admin() -> bool:
+    """Request has the admin password, via HTTP basic auth."""
+    auth = request.authorization
+    return profiling.is_admin(auth.password if auth else None)
 
-def hit_from_ref_gss_tag(tags: Tags) -> wikidata.Hit | None:
-    """Check element for rss:gss tag."""
-    gss = tags.get("ref:gss")
-    return wikidata.get_commons_cat_from_gss(gss) if gss else None
 
+def admin_required(view: View) -> View:
+    """Ask for the admin password before showing the view."""
 
-def hit_from_name(tags: Tags, lat: float, lon: float) -> wikidata.Hit | None:
-    """Use name to look for hit."""
-    if not (name := tags.get("name")):
-        return None
-    if name.endswith(" CP"):  # civil parish
-        name = name[:-3]
-
-    rows = wikidata.lookup_wikidata_by_name(name, lat, lon)
-    return wikidata.commons_from_rows(rows) if len(rows) == 1 else None
-
-
-def osm_lookup(
-    elements: "Query[model.Polygon]", lat: float, lon: float
-) -> wikidata.Hit | None:
-    """OSM lookup."""
-    for e in elements:
-        assert isinstance(e, model.Polygon)
-        assert e.tags
-        tags: typing.Mapping[str, str] = e.tags
-        admin_level: int | None = get_admin_level(tags)
-        if not admin_level and tags.get("boundary") not in ("political", "place"):
-            continue
-        if not (
-            (hit := hit_from_wikidata_tag(tags))
-            or (hit := hit_from_ref_gss_tag(tags))
-            or (hit := hit_from_name(tags, lat, lon))
-        ):
-            continue
-        hit["admin_level"] = admin_level
-        hit["element"] = e.osm_id
-        hit["geojson"] = typing.cast(str, e.geojson_str)
-        return hit
-
-    has_wikidata_tag = [e for e in elements if e.tags.get("wikidata")]
-    if len(has_wikidata_tag) != 1:
-        return None
+    @functools.wraps(view)
+    def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        if not is_admin():
+            return Response(
+                "admin login required",
+                401,
+                {"WWW-Authenticate": 'Basic realm="geocode admin"'},
+            )
+        return view(*args, **kwargs)
 
-    e = has_wikidata_tag[0]
-    assert e.tags
-    qid = e.tags["wikidata"]
-    return {
-        "wikidata": qid,
-        "element": e.osm_id,
-        "geojson": typing.cast(str, e.geojson_str),
-        "commons_cat": wikidata.qid_to_commons_category(qid),
-        "admin_level": admin_level,
-    }
+    return wrapper
 
 
 def redirect_to_detail(q: str) -> Response:
@@ -235,10 +191,10 @@ def handle_database_error(error: Exception) -> tuple[str, int]:
 
 
 @app.route("/")
+@data_version.versioned
 def index() -> str | Response:
     """Index page."""
     t0 = time()
-    database.session.execute("SELECT 1")
     q = request.args.get("q")
     if q and q.strip():
         return redirect_to_detail(q)
@@ -258,9 +214,21 @@ def index() -> str | Response:
             + "and lon must be between -180 and 180",
         )
 
-    result = lat_lon_to_wikidata(lat, lon)["result"]
-    result.pop("element", None)
-    result.pop("geojson", None)
+    try:
+        selected = formats.parse_fields(request.args.get("fields"))
+    except formats.FieldError as e:
+        return app.make_response((jsonify(error=str(e)), 400))
+
+    requested = request.args.get("profile") == "1" and is_admin()
+    profiler = (
+        profiling.Profiler(sampled=not requested)
+        if requested or profiling.sampled()
+        else None
+    )
+    with profiler or contextlib.nullcontext(), lookup_deadline():
+        result = lookup_engine.lookup(lat, lon)
+    data_version.no_store_if_degraded(result)
+    log_id = None
     if logging_enabled:
         remote_addr = request.headers.get("X-Forwarded-For", request.remote_addr)
         log = model.LookupLog(
@@ -273,7 +241,70 @@ def index() -> str | Response:
         )
         database.session.add(log)
         database.session.commit()
-    return jsonify(result)
+        log_id = log.id
+
+    response = jsonify(formats.select_fields(result, selected))
+    if profiler:
+        profile = profiler.save(log_id, lat, lon)
+        if requested:
+            g.no_store = True
+            response.headers["X-Profile"] = url_for(
+                "profile_page", profile_id=profile.id
+            )
+    return response
+
+
+@app.route("/batch", methods=["POST"])
+def batch() -> Response | tuple[Response, int]:
+    """Lookup a list of [lat, lon] points.
+
+    Results are JSON, NDJSON or MessagePack, chosen by the format argument or
+    the Accept header.
+    """
+    max_points = app.config.get("BATCH_MAX_POINTS", 1000)
+    try:
+        coords = points.parse_batch(request.get_json(silent=True), max_points)
+        selected = formats.parse_fields(request.args.get("fields"))
+        fmt = formats.pick_format(
+            request.args.get("format"),
+            request.accept_mimetypes.best_match(formats.content_types.values()),
+        )
+    except (points.PointsError, formats.FieldError) as e:
+        return jsonify(error=str(e)), 400
+
+    with batch_deadline():
+        found = iter(lookup_engine.lookup_many([p for p in coords if coords_valid(*p)]))
+    results = [
+        (
+            next(found)
+            if coords_valid(lat, lon)
+            else {
+                "coords": {"lat": lat, "lon": lon},
+                "error": "lat must be between -90 and 90, "
+                + "and lon must be between -180 and 180",
+            }
+        )
+        for lat, lon in coords
+    ]
+
+    selected_results = [formats.select_fields(r, selected) for r in results]
+    return Response(
+        formats.serialise_batch(selected_results, fmt),
+        content_type=formats.content_types[fmt],
+    )
+
+
+@app.route("/track", methods=["POST"])
+def track_lookup() -> Response | tuple[Response, int]:
+    """Places along a GPS track, as [lat, lon] points or a GeoJSON LineString."""
+    max_points = app.config.get("TRACK_MAX_POINTS", 10_000)
+    try:
+        points = track.parse_points(request.get_json(), max_points)
+    except track.TrackError as e:
+        return jsonify(error=str(e)), 400
+    with batch_deadline():
+        places = track.geocode_track(lookup_engine, points)
+    return jsonify(places=places)
 
 
 @app.route("/random")
@@ -289,31 +320,25 @@ def wikidata_tag() -> str:
     lat_str, lon_str = request.args["lat"], request.args["lon"]
     lat, lon = float(lat_str), float(lon_str)
 
-    scotland_code = scotland.get_scotland_code(lat, lon)
-
-    elements: typing.Any
-    if scotland_code:
-        rows = wikidata.lookup_scottish_parish_in_wikidata(scotland_code)
-        hit = wikidata.commons_from_rows(rows)
-        elements = []
-        result = wikidata.build_dict(hit, lat, lon)
-    else:
-        elements = model.Polygon.coords_within(lat, lon)
-        result = do_lookup(elements, lat, lon)
+    elements: list[engine.Element] = []
+    with lookup_deadline():
+        scotland_code = lookup_engine.scotland_code_in_time(lat, lon)
+        if scotland_code:
+            result = lookup_engine.scottish_parish(scotland_code, lat, lon)
+        else:
+            try:
+                elements = lookup_engine.coords_within(lat, lon)
+                result = lookup_engine.do_lookup(elements, lat, lon)
+            except deadline.DeadlineExceeded:
+                result = wikidata.build_dict(None, lat, lon)
+                result["degraded"] = True
 
     return render_template(
         "wikidata_tag.html", lat=lat, lon=lon, result=result, elements=elements
     )
 
 
-def highlight_sparql(query: str) -> str:
-    """Highlight SPARQL query syntax using Pygments."""
-    lexer = SparqlLexer()
-    formatter = HtmlFormatter()
-    return highlight(query, lexer, formatter)
-
-
-app.jinja_env.filters["highlight_sparql"] = highlight_sparql
+app.jinja_env.filters["highlight_sparql"] = sparql.highlight_sparql
 
 
 def build_detail_page(lat: float, lon: float) -> str:
@@ -326,13 +351,16 @@ def build_detail_page(lat: float, lon: float) -> str:
         return render_template("query_error.html", lat=lat, lon=lon, error=error)
 
     try:
-        reply = lat_lon_to_wikidata(lat, lon)
+        with lookup_deadline():
+            reply = lookup_engine.lat_lon_to_wikidata(lat, lon)
     except wikidata.QueryError as e:
+        g.no_store = True
         query, r = e.args
         return render_template("query_error.html", lat=lat, lon=lon, query=query, r=r)
 
+    data_version.no_store_if_degraded(reply["result"])
     element = reply["result"].pop("element", None)
-    geojson = reply["result"].pop("geojson", None)
+    geojson = element_geojson(reply["elements"], element)
 
     css = HtmlFormatter().get_style_defs(".highlight")
 
@@ -349,9 +377,9 @@ def build_detail_page(lat: float, lon: float) -> str:
 
 
 @app.route("/detail")
+@data_version.versioned
 def detail_page() -> Response | str:
     """Detail page."""
-    database.session.execute("SELECT 1")
     try:
         lat_str, lon_str = request.args["lat"], request.args["lon"]
         lat, lon = float(lat_str), float(lon_str)
@@ -410,12 +438,49 @@ def reports() -> str:
     )
 
 
+@app.route("/profiles")
+@admin_required
+def profiles() -> str:
+    """List recent lookup profiles."""
+    q = model.Profile.query.order_by(model.Profile.dt.desc()).limit(100)
+    return render_template("profiles.html", profiles=q)
+
+
+@app.route("/profiles/<int:profile_id>")
+@admin_required
+def profile_page(profile_id: int) -> str:
+    """Show lookup profile and the upstream calls it made."""
+    profile = database.session.get(model.Profile, profile_id)
+    if not profile:
+        abort(404)
+    return render_template("profile.html", profile=profile)
+
+
+@app.route("/profiles/<int:profile_id>.prof")
+@admin_required
+def profile_download(profile_id: int) -> Response:
+    """Download lookup profile for pstats or snakeviz."""
+    profile = database.session.get(model.Profile, profile_id)
+    if not profile:
+        abort(404)
+    filename = f"lookup-{profile_id}.prof"
+    return Response(
+        profile.stats,
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
 @app.route("/pin/<lat>/<lon>")
+@data_version.versioned
 def pin_detail(lat: str, lon: str) -> Response:
     """Details for map pin location."""
-    reply = lat_lon_to_wikidata(float(lat), float(lon))
+    with lookup_deadline():
+        reply = lookup_engine.lat_lon_to_wikidata(float(lat), float(lon))
+    data_version.no_store_if_degraded(reply["result"])
     element = reply["result"].pop("element", None)
-    geojson = reply["result"].pop("geojson", None)
+    zoom = request.args.get("zoom", type=float)
+    geojson = element_geojson(reply["elements"], element, zoom)
 
     css = HtmlFormatter().get_style_defs(".highlight")
 
@@ -430,14 +495,152 @@ def pin_detail(lat: str, lon: str) -> Response:
         **reply,
     )
 
-    return jsonify(html=html)
+    return jsonify(html=html, geojson=geojson)
+
+
+@app.route("/geometry/<int(signed=True):osm_id>")
+@data_version.versioned
+def element_geometry(osm_id: int) -> Response:
+    """GeoJSON for a polygon, full resolution unless a level is given."""
+    level = request.args.get("level", type=int)
+    if level is None:
+        geojson = geometry.get_full(osm_id)
+    elif 0 <= level < len(geometry.tolerances):
+        geojson = geometry.get_simplified(osm_id, level)
+    else:
+        abort(400)
+    if geojson is None:
+        abort(404)
+    return Response(geojson, mimetype="application/geo+json")
+
+
+@app.route("/tiles/<int:z>/<int:x>/<int:y>.pbf")
+@data_version.versioned
+def tile(z: int, x: int, y: int) -> Response:
+    """Vector tile of resolved boundaries."""
+    if not tiles.valid(z, x, y):
+        abort(404)
+    return Response(
+        tiles.get_tile(z, x, y), mimetype="application/vnd.mapbox-vector-tile"
+    )
 
 
 @app.route("/map")
 def map_page() -> str:
     """Map page."""
     css = HtmlFormatter().get_style_defs(".highlight")
-    return render_template("map.html", css=css)
+    tile_zoom = (tiles.min_zoom, tiles.max_zoom)
+    return render_template("map.html", css=css, tile_zoom=tile_zoom)
+
+
+@app.cli.command("export-boundaries")
+@click.argument("filename")
+@click.option("--region", help="Only boundaries for this shard region.")
+def export_boundaries(filename: str, region: str | None) -> None:
+    """Export qualifying boundaries to a memory-mapped boundary index."""
+    bbox = shards.region_bbox(app.config, region) if region else None
+    count = boundaries.write_index(filename, boundaries.boundaries_from_db(bbox))
+    click.echo(f"{count:,d} boundaries written to {filename}")
+
+
+@app.cli.command("simplify-boundaries")
+def simplify_boundaries() -> None:
+    """Precompute simplified geometry of qualifying boundaries for the maps."""
+    geometry.precompute(progress=click.echo)
+
+
+@app.cli.command("resolve-boundaries")
+@click.option("--refresh", is_flag=True, help="Resolve boundaries already done.")
+@click.option("--rate", default=2.0, help="Boundaries per second.")
+def resolve_boundaries(refresh: bool, rate: float) -> None:
+    """Resolve qualifying boundaries to Wikidata items for the map tiles."""
+    count = tiles.resolve(lookup_engine, refresh, rate, progress=click.echo)
+    data_version.bump("wikidata")
+    click.echo(f"{count:,d} boundaries resolved")
+
+
+@app.cli.command("warm-cache")
+@click.option("--days", default=7, help="Days of lookup history to replay.")
+@click.option("--limit", default=1000, help="Number of coordinates and places.")
+@click.option("--rate", default=2.0, help="Lookups per second.")
+def warm_cache(days: int, limit: int, rate: float) -> None:
+    """Replay frequent lookups from lookup_log to fill the Wikidata cache."""
+    if not cache.enabled():
+        raise click.ClickException("set WIKIDATA_CACHE_TTL to enable the cache")
+
+    report = warmup.warm(
+        lookup_engine.lat_lon_to_wikidata, days, limit, rate, progress=click.echo
+    )
+    data_version.bump("wikidata")
+    click.echo(
+        f"warmed {report['coords']:,d} coordinates and {report['places']:,d} places"
+        + f" ({report['errors']:,d} errors)"
+    )
+    click.echo(
+        f"of {report['total_lookups']:,d} lookups in the last {days} days: "
+        + f"{report['coords_coverage']:.1%} same coordinates, "
+        + f"{report['places_coverage']:.1%} same places"
+    )
+
+
+@app.cli.command("replay")
+@click.argument("target")
+@click.option("--start", type=click.DateTime(), required=True, help="Window start.")
+@click.option("--end", type=click.DateTime(), required=True, help="Window end.")
+@click.option("--speed", default=1.0, help="Speed up, 0 for as fast as possible.")
+@click.option("--workers", default=32, help="Concurrent requests.")
+@click.option("--limit", type=int, help="Maximum number of lookups.")
+def replay_traffic(
+    target: str,
+    start: datetime,
+    end: datetime,
+    speed: float,
+    workers: int,
+    limit: int | None,
+) -> None:
+    """Replay lookups from lookup_log against TARGET and compare with the log."""
+    logs = replay.load(start, end, limit)
+    click.echo(f"replaying {len(logs):,d} lookups against {target}")
+    t0 = time()
+    outcomes = replay.replay(target, logs, speed, workers, progress=click.echo)
+    report = replay.compare(outcomes, time() - t0)
+    for line in replay.format_report(report):
+        click.echo(line)
+
+
+@app.cli.command("wikidata-stand-in")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8100)
+@click.option("--latency", default=0.0, help="Added latency in milliseconds.")
+def wikidata_stand_in(host: str, port: int, latency: float) -> None:
+    """Serve api.php and WDQS responses from the Wikidata cache."""
+    server = replay.stand_in_server(host, port, latency / 1000)
+    click.echo(f"WIKIDATA_API_URL = 'http://{host}:{port}/w/api.php'")
+    click.echo(f"WDQS_URL = 'http://{host}:{port}/sparql'")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"{replay.StandInHandler.misses:,d} cache misses")
+
+
+@app.cli.command("ingest-changes")
+@click.argument("directory")
+def ingest_changes(directory: str) -> None:
+    """Invalidate cached results from Wikidata and OSM change files."""
+    http = requests.Session()
+    http.headers.update(geocode.headers)
+    summary = changes.ingest(directory, http, progress=click.echo)
+    for name, count in summary.items():
+        click.echo(f"{name}: {count:,d}")
+
+
+@app.cli.command("bump-data-version")
+@click.argument("source", type=click.Choice(data_version.sources))
+def bump_data_version(source: str) -> None:
+    """Record that a data source was refreshed, for example after an import."""
+    data_version.bump(source)
+    click.echo(f"data version: {data_version.current()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""Router for a region-sharded deployment.
+
+Serves / and /batch by sending each point to the shard for its region, see
+geocode/shards.py. Run it like the lookup app:
+
+    flask --app router run
+"""
+
+from flask import Flask, jsonify, request
+from werkzeug.wrappers import Response
+
+from geocode import formats, points, shards
+
+app = Flask(__name__)
+app.config.from_object("config.default")
+router = shards.Router.from_config(app.config)
+
+
+def coords_error(lat: float, lon: float) -> str | None:
+    """Error for coordinates outside the valid range."""
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return None
+    return "lat must be between -90 and 90, and lon must be between -180 and 180"
+
+
+@app.errorhandler(shards.ShardError)
+def shard_error(e: shards.ShardError) -> tuple[Response, int]:
+    """Shard didn't answer."""
+    return jsonify(error=str(e)), 502
+
+
+@app.route("/")
+def index() -> Response | tuple[Response, int]:
+    """Lookup a point on its shard."""
+    lat, lon = float(request.args["lat"]), float(request.args["lon"])
+    if error := coords_error(lat, lon):
+        return jsonify(coords={"lat": lat, "lon": lon}, error=error)
+    try:
+        selected = formats.parse_fields(request.args.get("fields"))
+    except formats.FieldError as e:
+        return jsonify(error=str(e)), 400
+
+    params = {"fields": request.args["fields"]} if selected else {}
+    return jsonify(formats.select_fields(router.lookup(lat, lon, params), selected))
+
+
+@app.route("/batch", methods=["POST"])
+def batch() -> Response | tuple[Response, int]:
+    """Lookup a list of [lat, lon] points with a batch per shard."""
+    max_points = app.config.get("BATCH_MAX_POINTS", 1000)
+    try:
+        coords = points.parse_batch(request.get_json(silent=True), max_points)
+        selected = formats.parse_fields(request.args.get("fields"))
+        fmt = formats.pick_format(
+            request.args.get("format"),
+            request.accept_mimetypes.best_match(formats.content_types.values()),
+        )
+    except (points.PointsError, formats.FieldError) as e:
+        return jsonify(error=str(e)), 400
+
+    valid = [p for p in coords if not coords_error(*p)]
+    params = {"fields": request.args["fields"]} if selected else {}
+    routed = iter(router.batch(valid, params))
+    results = [
+        (
+            {"coords": {"lat": lat, "lon": lon}, "error": error}
+            if (error := coords_error(lat, lon))
+            else formats.select_fields(next(routed), selected)
+        )
+        for lat, lon in coords
+    ]
+    return Response(
+        formats.serialise_batch(results, fmt), content_type=formats.content_types[fmt]
+    )
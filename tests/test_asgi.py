@@ -0,0 +1,115 @@
+import asyncio
+import importlib
+import json
+import sys
+import types
+import typing
+
+import pytest
+import pytest_mock
+from geocode import aio
+from geocode.upstream import UpstreamUnavailable
+
+
+class Element:
+    """Boundary with tags, standing in for a polygon from the database."""
+
+    def __init__(self, osm_id: int, tags: dict[str, str]) -> None:
+        """Init."""
+        self.osm_id = osm_id
+        self.tags = tags
+
+
+@pytest.fixture
+def asgi(
+    mocker: pytest_mock.plugin.MockerFixture, monkeypatch: pytest.MonkeyPatch
+) -> typing.Any:
+    """Async app with minimal config and a lookup without database or HTTP."""
+    default = types.ModuleType("config.default")
+    default.DB_URL = "postgresql+asyncpg://localhost/geocode"  # type: ignore
+    monkeypatch.setitem(sys.modules, "config", types.ModuleType("config"))
+    monkeypatch.setitem(sys.modules, "config.default", default)
+    monkeypatch.delitem(sys.modules, "asgi", raising=False)
+    mocker.patch("geocode.mail.start_queue")
+    module = importlib.import_module("asgi")
+    monkeypatch.setattr(module, "logging_enabled", False)
+
+    lookup = aio.AsyncLookup.__new__(aio.AsyncLookup)
+    lookup.config = module.app.config
+    lookup.get_scotland_code = mocker.AsyncMock(return_value=None)  # type: ignore
+    lookup.coords_within = mocker.AsyncMock(  # type: ignore
+        return_value=[Element(1, {"wikidata": "Q1", "admin_level": "8"})]
+    )
+    lookup.qid_to_commons_category = mocker.AsyncMock(  # type: ignore
+        return_value="Somewhere"
+    )
+    lookup.wdqs = mocker.AsyncMock(return_value=[])  # type: ignore
+    module.app.extensions["lookup"] = lookup
+    return module
+
+
+def request(
+    asgi: typing.Any, method: str, path: str, **kwargs: typing.Any
+) -> tuple[int, typing.Any]:
+    """Status and JSON body of a response from the async app."""
+
+    async def run() -> tuple[int, typing.Any]:
+        client = asgi.app.test_client()
+        r = await client.open(path, method=method, **kwargs)
+        return r.status_code, await r.get_json()
+
+    return asyncio.run(run())
+
+
+def test_index(asgi: typing.Any) -> None:
+    """Point lookup returns the Wikidata item and Commons category."""
+    status, result = request(asgi, "GET", "/", query_string={"lat": 51.5, "lon": 0})
+    assert status == 200
+    assert result["wikidata"] == "Q1"
+    assert result["commons_cat"]["title"] == "Somewhere"
+
+
+def test_batch(asgi: typing.Any) -> None:
+    """Batch gives a result per point, and rejects malformed points."""
+    body = {"points": [[51.5, 0], [95, 0]]}
+    status, reply = request(asgi, "POST", "/batch", json=body)
+    assert status == 200
+    assert reply["results"][0]["wikidata"] == "Q1"
+    assert "error" in reply["results"][1]
+
+    for body in ({}, {"points": [[1, 2, 3]]}, {"points": [["x", 1]]}):
+        status, reply = request(asgi, "POST", "/batch", json=body)
+        assert status == 400 and "error" in reply
+
+
+def test_degraded(asgi: typing.Any) -> None:
+    """Parish lookup failing in Scotland marks the fallback result degraded."""
+    lookup = asgi.app.extensions["lookup"]
+    lookup.get_scotland_code.return_value = "S1"
+    lookup.wdqs.side_effect = UpstreamUnavailable("wdqs")
+
+    status, result = request(asgi, "GET", "/", query_string={"lat": 55.9, "lon": -3})
+
+    assert status == 200
+    assert result["wikidata"] == "Q1"
+    assert result["degraded"] is True
+
+
+def test_batch_formats(asgi: typing.Any) -> None:
+    """Fields and output format work as in the sync app."""
+
+    async def run() -> tuple[str, bytes]:
+        client = asgi.app.test_client()
+        r = await client.post(
+            "/batch",
+            json={"points": [[51.5, 0], [51.6, 0]]},
+            query_string={"fields": "wikidata", "format": "ndjson"},
+        )
+        return r.content_type, await r.get_data()
+
+    content_type, body = asyncio.run(run())
+    assert content_type == "application/x-ndjson"
+    assert [json.loads(line) for line in body.splitlines()] == [
+        {"wikidata": "Q1"},
+        {"wikidata": "Q1"},
+    ]
@@ -0,0 +1,123 @@
+import json
+import pathlib
+import random
+
+from geocode import boundaries
+from geocode.boundaries import OSM_POLYGON, SCOTTISH_PARISH, BoundaryIndex
+
+
+def square(x: float, y: float, size: float) -> list[list[float]]:
+    """Closed ring for a square."""
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+def polygon(*rings: list[list[float]]) -> dict[str, object]:
+    """GeoJSON polygon."""
+    return {"type": "Polygon", "coordinates": list(rings)}
+
+
+def build(tmp_path: pathlib.Path, sources: list[boundaries.Source]) -> BoundaryIndex:
+    """Write sources to an index and open it."""
+    path = str(tmp_path / "boundaries.idx")
+    boundaries.write_index(path, sources)
+    return BoundaryIndex(path)
+
+
+def test_coords_within_order(tmp_path: pathlib.Path) -> None:
+    """Results are ordered by area then admin_level descending."""
+    index = build(
+        tmp_path,
+        [
+            (OSM_POLYGON, 1, 100.0, 4, {"name": "Country"}, polygon(square(0, 0, 10))),
+            (OSM_POLYGON, 2, 10.0, 8, {"name": "District"}, polygon(square(0, 0, 2))),
+            (OSM_POLYGON, 3, 10.0, 10, {"name": "Parish"}, polygon(square(0, 0, 2))),
+            (OSM_POLYGON, 4, 1.0, 10, {"name": "Elsewhere"}, polygon(square(5, 5, 1))),
+        ],
+    )
+    found = index.coords_within(1, 1)
+    assert [b.tags["name"] for b in found] == ["Parish", "District", "Country"]
+    assert index.coords_within(20, 20) == []
+    index.close()
+
+
+def test_coords_within_null_admin_level(tmp_path: pathlib.Path) -> None:
+    """Area wins over admin_level, and a null admin_level sorts first on a tie.
+
+    PostgreSQL sorts NULL first for ORDER BY admin_level DESC.
+    """
+    index = build(
+        tmp_path,
+        [
+            (OSM_POLYGON, 1, 5.0, 10, {"name": "Large"}, polygon(square(0, 0, 4))),
+            (OSM_POLYGON, 2, 2.0, 6, {"name": "Small"}, polygon(square(0, 0, 2))),
+            (OSM_POLYGON, 3, 5.0, 8, {"name": "Level 8"}, polygon(square(0, 0, 4))),
+            (OSM_POLYGON, 4, 5.0, None, {"name": "Place"}, polygon(square(0, 0, 4))),
+        ],
+    )
+    found = index.coords_within(1, 1)
+    assert [b.tags["name"] for b in found] == ["Small", "Place", "Large", "Level 8"]
+    assert found[1].admin_level is None
+    index.close()
+
+
+def test_holes_and_multipolygons(tmp_path: pathlib.Path) -> None:
+    """Points in a hole are outside, every part of a multipolygon is inside."""
+    donut = polygon(square(0, 0, 10), square(4, 4, 2))
+    multi = {
+        "type": "MultiPolygon",
+        "coordinates": [[square(20, 0, 1)], [square(30, 0, 1)]],
+    }
+    index = build(
+        tmp_path,
+        [
+            (OSM_POLYGON, -1, 1.0, 6, {"name": "Donut"}, donut),
+            (OSM_POLYGON, -2, 1.0, 6, {"name": "Islands"}, multi),
+        ],
+    )
+    assert [b.osm_id for b in index.coords_within(1, 1)] == [-1]
+    assert index.coords_within(5, 5) == []
+    assert [b.osm_id for b in index.coords_within(0.5, 30.5)] == [-2]
+
+    geometry = json.loads(index.coords_within(0.5, 20.5)[0].geojson_str)
+    assert geometry == multi
+    index.close()
+
+
+def test_scotland_code(tmp_path: pathlib.Path) -> None:
+    """Scottish parishes are looked up separately from OSM polygons."""
+    index = build(
+        tmp_path,
+        [
+            (SCOTTISH_PARISH, 7, 0.0, None, {"code": "123"}, polygon(square(0, 0, 1))),
+            (OSM_POLYGON, 8, 1.0, 10, {"name": "Parish"}, polygon(square(0, 0, 1))),
+        ],
+    )
+    assert index.get_scotland_code(0.5, 0.5) == "123"
+    assert index.get_scotland_code(5, 5) is None
+    assert [b.osm_id for b in index.coords_within(0.5, 0.5)] == [8]
+    index.close()
+
+
+def test_many_boundaries(tmp_path: pathlib.Path) -> None:
+    """R-tree search finds the same boundaries as a linear scan."""
+    rand = random.Random(1)
+    squares = [
+        (rand.uniform(-10, 10), rand.uniform(50, 60), rand.uniform(0.1, 3))
+        for _ in range(500)
+    ]
+    sources: list[boundaries.Source] = [
+        (OSM_POLYGON, num, size, 8, {}, polygon(square(x, y, size)))
+        for num, (x, y, size) in enumerate(squares)
+    ]
+    index = build(tmp_path, sources)
+    assert len(index) == 500
+
+    for _ in range(100):
+        lon, lat = rand.uniform(-10, 10), rand.uniform(50, 60)
+        expect = {
+            num
+            for num, (x, y, size) in enumerate(squares)
+            if x < lon < x + size and y < lat < y + size
+        }
+        assert {b.osm_id for b in index.coords_within(lat, lon)} == expect
+    index.close()
@@ -0,0 +1,62 @@
+import gzip
+import json
+import pathlib
+
+from geocode import changes, sparql, wikidata
+
+osc = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify><node id="10" lat="51.5" lon="-0.1"/></modify>
+  <create><way id="20"><nd ref="10"/></way></create>
+  <delete><relation id="30"/></delete>
+</osmChange>
+"""
+
+
+def test_wikidata_changes(tmp_path: pathlib.Path) -> None:
+    """QIDs come from API responses, event streams and plain lists."""
+    api = {
+        "query": {
+            "recentchanges": [
+                {"title": "Q1", "ns": 0},
+                {"title": "Property:P31", "ns": 120},
+            ]
+        }
+    }
+    (tmp_path / "rc.json").write_text(json.dumps(api))
+    events = [
+        {"title": "Q2", "wiki": "wikidatawiki"},
+        {"title": "Q3", "wiki": "enwiki"},
+    ]
+    with gzip.open(tmp_path / "events.jsonl.gz", "wt") as f:
+        f.writelines(json.dumps(e) + "\n" for e in events)
+    (tmp_path / "qids.txt").write_text("Q4\n\nnot a qid\n")
+
+    assert changes.wikidata_changes(str(tmp_path / "rc.json")) == {"Q1"}
+    assert changes.wikidata_changes(str(tmp_path / "events.jsonl.gz")) == {"Q2"}
+    assert changes.wikidata_changes(str(tmp_path / "qids.txt")) == {"Q4"}
+
+
+def test_osm_changes(tmp_path: pathlib.Path) -> None:
+    """Created, modified and deleted elements are all changes."""
+    path = tmp_path / "000.osc"
+    path.write_text(osc)
+    assert changes.osm_changes(str(path)) == {
+        "node": {10},
+        "way": {20},
+        "relation": {30},
+    }
+    assert list(changes.change_files(str(tmp_path))) == [str(path)]
+
+
+def test_refs() -> None:
+    """Cache entries record the items and codes they depend on."""
+    item = {"type": "uri", "value": "http://www.wikidata.org/entity/Q5"}
+    query = sparql.gss_query("E05000026")
+    assert wikidata.query_refs(query, [{"item": item}]) == ["gss:E05000026", "Q5"]
+
+    claim = {"mainsnak": {"datavalue": {"value": "E05000026"}}}
+    old = {"entities": {"Q5": {"id": "Q5", "claims": {"P836": [claim]}}}}
+    new = {"entities": {"Q5": {"id": "Q5", "claims": {}}}}
+    assert wikidata.entity_refs(old) == ["Q5"]
+    assert changes.entity_codes(old) ^ changes.entity_codes(new) == {"gss:E05000026"}
@@ -0,0 +1,84 @@
+import typing
+
+import flask
+import pytest
+import pytest_mock
+from geocode import cache, data_version
+
+
+@pytest.fixture
+def app(mocker: pytest_mock.plugin.MockerFixture) -> flask.Flask:
+    """App with a versioned view, at a fixed data version."""
+    mocker.patch.object(data_version, "current", return_value="v1")
+    app = flask.Flask(__name__)
+    calls = []
+
+    @app.route("/")
+    @data_version.versioned
+    def index() -> dict[str, typing.Any]:
+        calls.append(flask.request.args)
+        result = {"wikidata": "Q1", "degraded": "degraded" in flask.request.args}
+        data_version.no_store_if_degraded(result)
+        return result
+
+    app.config["calls"] = calls
+    return app
+
+
+def test_compute(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Version comes from the refresh times, and changes with them."""
+    session = mocker.patch.object(data_version, "session")
+    mocker.patch.object(data_version, "boundary_index_path", None)
+    rows = session.query.return_value.order_by.return_value.all
+    rows.return_value = [("wikidata", mocker.Mock(isoformat=lambda: "2026-01-01"))]
+    first = data_version.compute()
+    assert first == data_version.compute()
+
+    rows.return_value = [("wikidata", mocker.Mock(isoformat=lambda: "2026-01-02"))]
+    assert data_version.compute() != first
+    assert not session.execute.called
+
+
+def test_current(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Version is reused for check_interval seconds and recomputed after expire."""
+    compute = mocker.patch.object(data_version, "compute", side_effect=["v1", "v2"])
+    mocker.patch.object(data_version, "cached", None)
+    assert data_version.current() == "v1"
+    assert data_version.current() == "v1"
+    assert compute.call_count == 1
+
+    data_version.expire()
+    assert data_version.current() == "v2"
+
+
+def test_not_modified(app: flask.Flask) -> None:
+    """Matching If-None-Match gets a 304 without running the view."""
+    client = app.test_client()
+    first = client.get("/?lat=1")
+    assert first.status_code == 200 and first.cache_control.public
+
+    again = client.get("/?lat=1", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert len(app.config["calls"]) == 1
+
+
+def test_no_store(app: flask.Flask) -> None:
+    """Degraded results are sent with no-store and no ETag."""
+    r = app.test_client().get("/?degraded=1")
+    assert r.status_code == 200
+    assert r.cache_control.no_store
+    assert "ETag" not in r.headers
+
+
+def test_refresh_bumps(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """A refreshed cache value that differs bumps the wikidata version."""
+    db = mocker.MagicMock()
+    conn = db.get_bind.return_value.begin.return_value.__enter__.return_value
+    bump = mocker.patch.object(data_version, "bump_statement")
+
+    conn.execute.return_value.scalar.return_value = {"title": "Old"}
+    cache.put("api:x", {"title": "Old"}, db)
+    assert not bump.called
+
+    cache.put("api:x", {"title": "New"}, db)
+    bump.assert_called_once_with("wikidata")
@@ -0,0 +1,83 @@
+import pytest
+import pytest_mock
+from geocode import deadline, wikidata
+from geocode.engine import LookupEngine, query_canceled
+from sqlalchemy.exc import OperationalError
+
+
+class QueryCanceled(Exception):
+    """Driver error for a statement cancelled by statement_timeout."""
+
+    pgcode = query_canceled
+
+
+def test_remaining() -> None:
+    """Time left is only set inside start."""
+    assert deadline.remaining() is None
+    with deadline.start(30.0):
+        assert 29 < deadline.remaining() <= 30  # type: ignore
+        assert not deadline.expired()
+    with deadline.start(0.0):
+        assert deadline.expired()
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.check()
+    assert deadline.remaining() is None
+
+
+def test_upstream_call() -> None:
+    """Errors after the deadline count as running out of time."""
+    with deadline.start(0.0), pytest.raises(deadline.DeadlineExceeded):
+        with deadline.upstream_call():
+            pass
+
+    with deadline.start(30.0), pytest.raises(ValueError):
+        with deadline.upstream_call():
+            raise ValueError
+
+
+def test_wdqs_after_deadline(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """No query is sent once the deadline has passed."""
+    request = mocker.patch.object(wikidata, "wdqs_request")
+    with deadline.start(0.0), pytest.raises(deadline.DeadlineExceeded):
+        wikidata.Wikidata().lookup_gss("E05000026")
+    assert not request.called
+
+
+def test_statement_timeout(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Spatial query cancelled by the statement timeout gives a degraded result."""
+    db = mocker.Mock(info={})
+    db.scalars.side_effect = OperationalError("SELECT", {}, QueryCanceled())
+    engine = LookupEngine(db, use_prepared=False)
+    engine.wikidata = mocker.Mock(spec=wikidata.Wikidata)
+
+    with deadline.start(30.0):
+        reply = engine.resolve_point(51.5, -0.1, None)
+
+    assert reply["result"]["degraded"] is True
+    assert "SET LOCAL statement_timeout" in str(db.execute.call_args.args[0])
+    db.rollback.assert_called_once()
+
+
+def test_timeout(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Request timeouts are never 0, which requests rejects."""
+    assert deadline.timeout() is None
+    with deadline.start(30.0):
+        assert 29 < deadline.timeout() <= 30  # type: ignore
+    mocker.patch.object(deadline, "expired", return_value=False)
+    mocker.patch.object(deadline, "remaining", return_value=0.0)
+    assert deadline.timeout() == deadline.min_timeout
+
+
+def test_statement_timeout_once(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """The timeout is set once per transaction, not before every query."""
+    db = mocker.Mock(info={})
+    first, second = mocker.Mock(), mocker.Mock()
+    db.get_transaction.side_effect = [None, first, first, first, second, second]
+
+    with deadline.start(30.0):
+        deadline.statement_timeout(db)
+        deadline.statement_timeout(db)
+        deadline.statement_timeout(db)
+        assert db.execute.call_count == 1
+        deadline.statement_timeout(db)
+        assert db.execute.call_count == 2
@@ -0,0 +1,70 @@
+import typing
+
+import pytest_mock
+from geocode import wikidata
+from geocode.engine import LookupEngine
+from geocode.upstream import UpstreamUnavailable
+
+
+class Element:
+    """Boundary with tags, standing in for a polygon from the database."""
+
+    def __init__(self, osm_id: int, tags: dict[str, str]) -> None:
+        """Init."""
+        self.osm_id = osm_id
+        self.tags = tags
+        self.geojson_str = "{}"
+
+
+def make_engine(
+    mocker: pytest_mock.plugin.MockerFixture, elements: list[Element]
+) -> tuple[LookupEngine, typing.Any]:
+    """Engine with stub database, boundaries and Wikidata."""
+    engine = LookupEngine(mocker.Mock())
+    mocker.patch.object(engine, "get_scotland_code", return_value=None)
+    mocker.patch.object(engine, "coords_within", return_value=elements)
+    stub = mocker.Mock(spec=wikidata.Wikidata)
+    engine.wikidata = stub
+    return engine, stub
+
+
+def test_lookup_wikidata_tag(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Wikidata tag of the smallest boundary gives the result."""
+    elements = [Element(1, {"wikidata": "Q1", "admin_level": "8"})]
+    engine, stub = make_engine(mocker, elements)
+    stub.qid_to_commons_category.return_value = "Somewhere"
+
+    result = engine.lookup(51.5, -0.1)
+
+    assert result["wikidata"] == "Q1"
+    assert result["admin_level"] == 8
+    assert result["commons_cat"]["title"] == "Somewhere"  # type: ignore
+    assert "element" not in result and "geojson" not in result
+    stub.qid_to_commons_category.assert_called_once_with("Q1")
+
+
+def test_lookup_degraded(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Wikidata outage falls back to the OSM wikidata tag."""
+    elements = [Element(1, {"wikidata": "Q1", "admin_level": "8"})]
+    engine, stub = make_engine(mocker, elements)
+    stub.qid_to_commons_category.side_effect = UpstreamUnavailable("api.php")
+
+    result = engine.lookup(51.5, -0.1)
+
+    assert result["wikidata"] == "Q1"
+    assert result["degraded"] is True
+    assert "commons_cat" not in result
+
+
+def test_lookup_degraded_political(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Non-numeric admin_level on a political boundary doesn't break the fallback."""
+    tags = {"wikidata": "Q2", "boundary": "political", "admin_level": "6;8"}
+    engine, stub = make_engine(mocker, [Element(2, tags)])
+    stub.qid_to_commons_category.side_effect = UpstreamUnavailable("api.php")
+    stub.lookup_gss.side_effect = UpstreamUnavailable("wdqs")
+
+    result = engine.lookup(51.5, -0.1)
+
+    assert result["wikidata"] == "Q2"
+    assert result["degraded"] is True
+    assert result.get("admin_level") is None
@@ -0,0 +1,40 @@
+import msgpack
+import orjson
+import pytest
+from geocode import formats
+
+result = {
+    "coords": {"lat": 51.5, "lon": -0.1},
+    "admin_level": 8,
+    "wikidata": "Q1",
+    "commons_cat": {"title": "Somewhere", "url": "https://commons/Somewhere"},
+}
+
+
+def test_select_fields() -> None:
+    """Only the requested fields are returned, with the lookup status."""
+    selected = formats.parse_fields("wikidata,commons_cat.title")
+    assert formats.select_fields(result, selected) == {
+        "wikidata": "Q1",
+        "commons_cat": {"title": "Somewhere"},
+    }
+    missing = {"commons_cat": None, "missing": True, "coords": result["coords"]}
+    assert formats.select_fields(missing, selected) == {
+        "commons_cat": None,
+        "missing": True,
+    }
+    assert formats.select_fields(result, formats.parse_fields(None)) is result
+
+    with pytest.raises(formats.FieldError):
+        formats.parse_fields("wikidata,geojson")
+
+
+def test_serialise_batch() -> None:
+    """NDJSON has a line per result, MessagePack matches the JSON shape."""
+    results = [result, {"commons_cat": None, "missing": True}]
+    lines = formats.serialise_batch(results, "ndjson").splitlines()
+    assert [orjson.loads(line) for line in lines] == results
+    packed = formats.serialise_batch(results, "msgpack")
+    assert msgpack.unpackb(packed) == {"results": results}
+    assert formats.pick_format(None, "application/msgpack") == "msgpack"
+    assert formats.pick_format(None, None) == "json"
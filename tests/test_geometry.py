@@ -0,0 +1,20 @@
+from geocode import geometry
+
+
+def test_level_for_zoom() -> None:
+    """Zoomed out maps get coarser geometry."""
+    levels = [geometry.level_for_zoom(zoom) for zoom in (15, 12, 10, 7, 3)]
+    assert levels == sorted(levels)
+    assert levels[0] == 0
+    assert levels[-1] == len(geometry.tolerances) - 1
+
+
+def test_level_for_area() -> None:
+    """Bigger boundaries get coarser geometry, within a pixel at the fitted zoom."""
+    parish, county, country = 5e6, 3e9, 1.3e11
+    assert geometry.level_for_area(parish) == 0
+    assert geometry.level_for_area(county) <= geometry.level_for_area(country)
+    for area in county, country:
+        zoom = geometry.zoom_for_area(area)
+        pixel = 360 / (256 * 2**zoom)
+        assert geometry.tolerances[geometry.level_for_area(area)] <= pixel
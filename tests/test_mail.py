@@ -0,0 +1,49 @@
+import pytest_mock
+
+from geocode import mail
+
+config = {
+    "MAIL_FROM": "geocode@example.org",
+    "MAIL_FROM_NAME": "geocode",
+    "ADMINS": ["admin@example.org"],
+    "SMTP_HOST": "localhost",
+    "MAIL_DIGEST_WINDOW": 60,
+}
+
+
+def test_digest_groups_repeats() -> None:
+    """Repeats of the same error are collapsed into a count."""
+    subject, body = mail.digest(
+        [
+            ("APIResponseError", "Geocode error", "first body", 0.0),
+            ("APIResponseError", "Geocode error", "second body", 10.0),
+            ("KeyError", "geocode error: KeyError", "key error body", 20.0),
+        ]
+    )
+    assert subject == "Geocode error digest: 3 errors, 2 kinds"
+    assert "2 x Geocode error (APIResponseError)" in body
+    assert "first body" in body
+    assert "second body" not in body
+    assert "1 x geocode error: KeyError (KeyError)" in body
+
+
+def test_single_message_unchanged() -> None:
+    """A single message is sent as it is."""
+    assert mail.digest([("KeyError", "subject", "body", 0.0)]) == ("subject", "body")
+
+
+def test_queue_sends_one_digest(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Messages queued within the window are delivered as one mail."""
+    smtp = mocker.patch("smtplib.SMTP")
+    queue = mail.MailQueue(config)
+    queue.put("APIResponseError", "Geocode error", "body")
+    queue.put("APIResponseError", "Geocode error", "body")
+    smtp.assert_not_called()
+
+    queue.stop(timeout=5)
+    smtp.assert_called_once_with("localhost", timeout=30)
+    sendmail = smtp.return_value.sendmail
+    sendmail.assert_called_once()
+    assert (
+        "Subject: Geocode error digest: 2 errors, 1 kinds" in sendmail.call_args[0][2]
+    )
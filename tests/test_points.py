@@ -0,0 +1,27 @@
+import pytest
+from geocode import points
+
+
+def test_parse_batch() -> None:
+    """Pairs of numbers or numeric strings, out of range values kept."""
+    data = {"points": [[51.5, -0.1], ["55.9", "-3.2"], [95, 0]]}
+    assert points.parse_batch(data, 10) == [(51.5, -0.1), (55.9, -3.2), (95.0, 0.0)]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        None,
+        [],
+        {},
+        {"points": "51.5,-0.1"},
+        {"points": [[1, 2, 3]]},
+        {"points": [["x", 1]]},
+        {"points": [[None, 1]]},
+        {"points": [[0, 0]] * 11},
+    ],
+)
+def test_parse_batch_errors(data: object) -> None:
+    """Malformed bodies and points are rejected."""
+    with pytest.raises(points.PointsError):
+        points.parse_batch(data, 10)
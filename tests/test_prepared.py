@@ -0,0 +1,84 @@
+import typing
+
+import pytest_mock
+from geocode import database, prepared
+from geocode.model import Polygon
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import Session
+
+
+def test_statements_use_positional_parameters() -> None:
+    """Prepared SQL takes lat/lon as $1/$2 with no driver placeholders."""
+    for name in ("coords_within", "scotland_code"):
+        sql = database.prepared_statements[name]
+        assert "$1::float8" in sql and "$2::float8" in sql
+        assert "%(" not in sql and ":lat" not in sql
+
+
+def test_coords_within_skips_geometry() -> None:
+    """The statement returns the columns a lookup needs, without the geometry."""
+    sql = database.prepared_statements["coords_within"]
+    select_list = [c.strip() for c in sql.split("FROM")[0].split(",")]
+    assert "planet_osm_polygon.way_area" in select_list
+    assert "planet_osm_polygon.way" not in select_list
+    assert len(prepared.coords_within.selected_columns) == len(prepared.polygon_columns)
+
+
+def test_coords_within_maps_columns() -> None:
+    """EXECUTE result columns load Polygon attributes, including area."""
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "before_cursor_execute", retval=True)
+    def execute(
+        conn: typing.Any,
+        cursor: typing.Any,
+        statement: str,
+        parameters: typing.Any,
+        context: typing.Any,
+        executemany: bool,
+    ) -> tuple[str, typing.Any]:
+        assert statement.startswith("EXECUTE coords_within")
+        row = "SELECT -58446, '6', 'administrative', 0.3, '\"name\"=>\"Kent\"', 3.7e9"
+        return row, ()
+
+    with Session(engine) as db:
+        q = select(Polygon).from_statement(prepared.coords_within)
+        (polygon,) = db.scalars(q, {"lat": 51.2, "lon": 0.7}).all()
+
+    assert polygon.osm_id == -58446
+    assert polygon.admin_level == "6"
+    assert polygon.boundary == "administrative"
+    assert polygon.way_area == 0.3
+    assert polygon.tags == {"name": "Kent"}
+    assert polygon.area == 3.7e9
+
+
+def test_missing_table_is_skipped(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """A statement whose table is missing doesn't fail the connection."""
+
+    class UndefinedTable(Exception):
+        pgcode = database.undefined_table
+
+    def execute(sql: str) -> None:
+        if "scotland" in sql:
+            raise UndefinedTable("relation scotland does not exist")
+
+    mocker.patch.object(database, "unprepared", set())
+    conn = mocker.Mock()
+    conn.cursor.return_value.execute.side_effect = execute
+
+    database.prepare_statements(conn, None)
+
+    assert database.unprepared == {"scotland_code"}
+    conn.rollback.assert_called_once()
+
+
+def test_prepared_on_read_engine_only() -> None:
+    """With a replica only its connections prepare statements."""
+    config = {
+        "DB_URL": "postgresql+psycopg2://primary/geocode",
+        "DB_REPLICA_URL": "postgresql+psycopg2://replica/geocode",
+    }
+    primary, replica = database.get_engines(config)
+    assert not event.contains(primary, "connect", database.prepare_statements)
+    assert event.contains(replica, "connect", database.prepare_statements)
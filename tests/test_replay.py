@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import responses
+from geocode import replay
+from geocode.model import LookupLog
+
+target = "http://staging.example.org/"
+
+
+def logged(num: int, seconds: float, qid: str) -> LookupLog:
+    """Logged lookup."""
+    return LookupLog(
+        id=num,
+        dt=datetime(2024, 1, 1) + timedelta(seconds=seconds),
+        lat=51.5,
+        lon=-0.1 * num,
+        result={"wikidata": qid, "commons_cat": {"title": qid}, "admin_level": 8},
+        response_time_ms=100 * num,
+    )
+
+
+def test_percentile() -> None:
+    """Nearest-rank percentiles."""
+    values = [float(v) for v in range(1, 101)]
+    assert replay.percentile(values, 50) == 50
+    assert replay.percentile(values, 99) == 99
+    assert replay.percentile(values, 100) == 100
+    assert replay.percentile([], 50) is None
+
+
+@responses.activate
+def test_replay_compares_results() -> None:
+    """Replayed results are compared with the logged results."""
+    responses.add(
+        responses.GET,
+        target,
+        json={"wikidata": "Q1", "commons_cat": {"title": "Q1"}, "admin_level": 8},
+    )
+    logs = [logged(1, 0, "Q1"), logged(2, 0.5, "Q2"), logged(3, 1, "Q1")]
+
+    outcomes = replay.replay(target, logs, speed=0, workers=2)
+    report = replay.compare(outcomes, 1.0)
+
+    assert report["requests"] == 3
+    assert report["errors"] == 0
+    assert [o.log_id for o in report["changed"]] == [2]
+    assert report["latency"][100][0] == 300
+    assert len(replay.format_report(report)) == 2 + 4 + 1
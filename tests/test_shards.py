@@ -0,0 +1,48 @@
+import json
+import typing
+
+import responses
+from geocode import shards
+
+scotland = shards.Shard("scotland", "http://scotland", shards.regions["scotland"])
+england = shards.Shard(
+    "england_wales", "http://england", shards.regions["england_wales"]
+)
+
+
+def batch_callback(qid: str) -> typing.Callable[..., typing.Any]:
+    """Shard batch endpoint answering every point with one QID."""
+
+    def callback(request: typing.Any) -> tuple[int, dict[str, str], str]:
+        points = json.loads(request.body or "{}")["points"]
+        results = [{"wikidata": qid, "coords": p} for p in points]
+        return 200, {}, json.dumps({"results": results})
+
+    return callback
+
+
+def test_shard_for() -> None:
+    """Points near a border go to the smaller region."""
+    router = shards.Router([england, scotland])
+    assert router.shard_for(55.95, -3.19) is scotland  # Edinburgh
+    assert router.shard_for(51.5, -0.1) is england  # London
+    assert router.shard_for(40.4, -3.7) is None  # Madrid
+
+
+@responses.activate
+def test_batch_merges_in_order() -> None:
+    """Each shard gets one batch and results come back in the original order."""
+    responses.add_callback(
+        responses.POST, "http://scotland/batch", callback=batch_callback("Q22")
+    )
+    responses.add(responses.POST, "http://england/batch", status=503)
+    router = shards.Router([england, scotland])
+
+    points = [(55.95, -3.19), (51.5, -0.1), (40.4, -3.7), (57.15, -2.1)]
+    results = router.batch(points)
+
+    assert len(responses.calls) == 2
+    assert results[0]["wikidata"] == "Q22"
+    assert "shard england_wales" in str(results[1]["error"])
+    assert results[2]["missing"]
+    assert results[3]["wikidata"] == "Q22"
@@ -0,0 +1,40 @@
+import pathlib
+
+import pytest_mock
+from geocode import tiles
+
+
+def test_valid() -> None:
+    """Tiles outside the zoom range or the world are rejected."""
+    assert tiles.valid(tiles.min_zoom, 0, 0)
+    assert not tiles.valid(tiles.min_zoom - 1, 0, 0)
+    assert not tiles.valid(tiles.max_zoom + 1, 0, 0)
+    assert not tiles.valid(10, 1024, 0)
+
+
+def test_disk_cache(
+    mocker: pytest_mock.plugin.MockerFixture, tmp_path: pathlib.Path
+) -> None:
+    """Tiles are rendered once per data version."""
+    mocker.patch.object(tiles, "cache_dir", str(tmp_path))
+    version = mocker.patch("geocode.data_version.current", return_value="v1")
+    render = mocker.patch.object(tiles, "render", return_value=b"tile")
+
+    assert tiles.get_tile(10, 500, 300) == b"tile"
+    assert tiles.get_tile(10, 500, 300) == b"tile"
+    assert render.call_count == 1
+    assert (tmp_path / "v1" / "10" / "500" / "300.mvt").read_bytes() == b"tile"
+
+    version.return_value = "v2"
+    tiles.get_tile(10, 500, 300)
+    assert render.call_count == 2
+
+
+def test_min_area() -> None:
+    """County-sized boundaries are drawn at every zoom, the filter uses metres."""
+    # Kent is about 3,700 km², roughly 9,000 km² in web mercator at 51°N
+    county = 9e9
+    assert all(county > tiles.min_area(z) for z in range(tiles.min_zoom, 15))
+    sql = str(tiles.tile_select(tiles.min_zoom, 32, 21).compile())
+    assert "way_area" not in sql
+    assert "ST_Area(ST_Transform(planet_osm_polygon.way" in sql
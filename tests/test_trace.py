@@ -0,0 +1,35 @@
+import pytest_mock
+import responses
+from geocode import sparql, trace, wikidata
+
+
+@responses.activate
+def test_trace_records_calls(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Upstream calls are traced with template, QID and retries."""
+    mocker.patch("time.sleep", return_value=None)
+    responses.add(
+        responses.GET, wikidata.api_url, json={"entities": {"Q42": {"id": "Q42"}}}
+    )
+    responses.add(responses.POST, wikidata.wikidata_query_api_url, body="busy")
+    responses.add(
+        responses.POST,
+        wikidata.wikidata_query_api_url,
+        json={"results": {"bindings": []}},
+    )
+
+    with trace.start() as calls:
+        wikidata.get_entity("Q42")
+        wikidata.wdqs(sparql.gss_query("E07000223"))
+
+    assert [c.as_dict()["kind"] for c in calls] == ["api", "wdqs"]
+    assert calls[0].detail == "Q42"
+    assert calls[1].detail == "lookup_gss.sparql"
+    assert calls[1].retries == 1
+    assert not calls[0].cached
+
+
+def test_no_trace_outside_start() -> None:
+    """Nothing is recorded unless a trace was started."""
+    with trace.call("api", "Q1") as c:
+        assert c is None
+    assert trace.current.get() is None
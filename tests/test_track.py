@@ -0,0 +1,76 @@
+import pytest
+import pytest_mock
+from geocode import deadline, track, wikidata
+from geocode.engine import LookupEngine
+
+
+class Element:
+    """Boundary with tags, standing in for a polygon from the database."""
+
+    def __init__(self, osm_id: int, tags: dict[str, str]) -> None:
+        """Init."""
+        self.osm_id = osm_id
+        self.tags = tags
+
+
+def test_parse_points() -> None:
+    """Points and GeoJSON LineStrings give [lat, lon] pairs."""
+    line = {"type": "LineString", "coordinates": [[-3.2, 55.9], [-3.3, 55.8, 12]]}
+    expect = [(55.9, -3.2), (55.8, -3.3)]
+    assert track.parse_points(line, 10) == expect
+    assert track.parse_points({"type": "Feature", "geometry": line}, 10) == expect
+    assert track.parse_points({"points": [[55.9, -3.2], ["55.8", "-3.3"]]}, 10) == (
+        expect
+    )
+
+    with pytest.raises(track.TrackError):
+        track.parse_points({"points": [[55.9, -3.2]]}, 10)
+    with pytest.raises(track.TrackError):
+        track.parse_points({"points": [[0, 0]] * 11}, 10)
+    with pytest.raises(track.TrackError):
+        track.parse_points({"points": [[0, 0], [91, 0]]}, 10)
+
+
+def test_geocode_track(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Places come back in order and each boundary is resolved once."""
+    county = Element(1, {"wikidata": "Q1", "admin_level": "6"})
+    town = Element(2, {"wikidata": "Q2", "admin_level": "8"})
+    other = Element(3, {"wikidata": "Q3", "admin_level": "8"})
+    elements = [[town, county], [town, county], [county], [other, county], [county]]
+    engine = LookupEngine(mocker.Mock())
+    mocker.patch.object(
+        track, "containing", return_value=([None] * len(elements), elements, True)
+    )
+    stub = mocker.Mock(spec=wikidata.Wikidata)
+    stub.qid_to_commons_category.side_effect = lambda qid: f"Cat {qid}"
+    engine.wikidata = stub
+
+    places = track.geocode_track(engine, [(0.0, 0.0)] * len(elements))
+
+    assert [(p["start"], p["end"], p["wikidata"]) for p in places] == [
+        (0, 1, "Q2"),
+        (2, 2, "Q1"),
+        (3, 3, "Q3"),
+        (4, 4, "Q1"),
+    ]
+    assert places[0]["commons_cat"]["title"] == "Cat Q2"
+    assert "coords" not in places[0]
+    resolved = [c.args[0] for c in stub.qid_to_commons_category.call_args_list]
+    assert sorted(resolved) == ["Q1", "Q2", "Q3"]
+
+
+def test_track_deadline(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Spatial queries running out of time give degraded places, not an error."""
+    engine = LookupEngine(mocker.Mock(), use_prepared=False)
+    engine.wikidata = mocker.Mock(spec=wikidata.Wikidata)
+    engine.wikidata.lookup_scottish_parish_many.return_value = {"S1": []}
+    mocker.patch.object(
+        engine,
+        "read_query",
+        side_effect=[[(0, "S1")], deadline.DeadlineExceeded("statement timeout")],
+    )
+
+    places = track.geocode_track(engine, [(55.9, -3.2), (55.8, -3.3)])
+
+    assert places
+    assert all(place["degraded"] for place in places)
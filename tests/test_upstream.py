@@ -0,0 +1,74 @@
+import pathlib
+
+import pytest
+import pytest_mock
+import responses
+
+from geocode import upstream, wikidata
+from geocode.upstream import CircuitBreaker, TokenBucket, UpstreamUnavailable
+
+
+def test_token_bucket_burst() -> None:
+    """Burst is available straight away, then callers wait for the rate."""
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve(max_wait=1) == 0
+    assert bucket.reserve(max_wait=1) == 0
+    wait = bucket.reserve(max_wait=1)
+    assert wait is not None and 0 < wait <= 0.1
+    assert bucket.reserve(max_wait=0.01) is None
+
+
+def test_token_bucket_shared_state(tmp_path: pathlib.Path) -> None:
+    """Buckets using the same state file share tokens."""
+    state_path = str(tmp_path / "wdqs")
+    first = TokenBucket(rate=0.1, burst=1, state_path=state_path)
+    second = TokenBucket(rate=0.1, burst=1, state_path=state_path)
+    assert first.reserve(max_wait=1) == 0
+    assert second.reserve(max_wait=1) is None
+
+
+def test_circuit_breaker() -> None:
+    """Circuit opens after the failure threshold."""
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.is_open()
+
+
+def test_parse_retry_after() -> None:
+    """Retry-After can be seconds or an HTTP date."""
+    assert upstream.parse_retry_after("120") == 120
+    assert upstream.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert upstream.parse_retry_after(None) is None
+
+
+@responses.activate
+def test_wdqs_429_fails_fast(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """429 from WDQS opens the circuit without retries."""
+    wdqs = upstream.Upstream("WDQS", rate=5, burst=10)
+    mocker.patch.object(upstream, "wdqs", wdqs)
+    mocked_sleep = mocker.patch("time.sleep", return_value=None)
+
+    responses.add(
+        responses.POST,
+        wikidata.wikidata_query_api_url,
+        body="Too Many Requests",
+        status=429,
+        headers={"Retry-After": "60"},
+    )
+
+    with pytest.raises(UpstreamUnavailable):
+        wikidata.wdqs("test query")
+    assert len(responses.calls) == 1
+    assert mocked_sleep.call_count == 0
+
+    with pytest.raises(UpstreamUnavailable):
+        wikidata.wdqs("test query")
+    assert len(responses.calls) == 1
+    assert wdqs.bucket.reserve(max_wait=30) is None
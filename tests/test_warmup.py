@@ -0,0 +1,80 @@
+import pytest_mock
+import requests
+from geocode import warmup, wikidata
+
+
+def history(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Stub lookup history: two frequent coordinates, a place and a sample."""
+    mocker.patch.object(warmup, "total_lookups", return_value=100)
+    coords = [(51.5, -0.1, 40), (55.9, -3.2, 10)]
+    mocker.patch.object(warmup, "frequent_coords", return_value=coords)
+    mocker.patch.object(warmup, "frequent_places", return_value=[("Q84", 30)])
+    mocker.patch.object(warmup, "samples", [(51.5, -0.1, "London"), (53.4, -3.0, "")])
+    mocker.patch.object(warmup.Throttle, "wait")
+
+
+def test_points(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Frequent coordinates come first, then samples not already included."""
+    history(mocker)
+    mocker.patch.object(wikidata, "qid_to_commons_category")
+    lookup = mocker.Mock(return_value={"result": {"wikidata": "Q1"}})
+
+    report = warmup.warm(lookup)
+
+    assert [c.args for c in lookup.call_args_list] == [
+        (51.5, -0.1),
+        (55.9, -3.2),
+        (53.4, -3.0),
+    ]
+    assert report["coords"] == 3 and report["places"] == 1
+    assert report["coords_coverage"] == 0.5
+    assert report["places_coverage"] == 0.3
+
+
+def test_errors(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """A failed lookup is counted and the rest carry on."""
+    history(mocker)
+    mocker.patch.object(
+        wikidata, "qid_to_commons_category", side_effect=requests.ConnectionError
+    )
+    ok = {"result": {"wikidata": "Q1"}}
+    lookup = mocker.Mock(side_effect=[requests.Timeout, ok, ok])
+
+    report = warmup.warm(lookup)
+
+    assert lookup.call_count == 3
+    assert report["errors"] == 2
+    assert report["coords"] == 2 and report["places"] == 0
+    assert report["coords_coverage"] == 0.1
+
+
+def test_stop_early(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """A degraded lookup stops the run and isn't counted as warmed."""
+    history(mocker)
+    places = mocker.patch.object(wikidata, "qid_to_commons_category")
+    degraded = {"result": {"wikidata": "Q2", "degraded": True}}
+    lookup = mocker.Mock(side_effect=[{"result": {"wikidata": "Q1"}}, degraded])
+    progress = mocker.Mock()
+
+    report = warmup.warm(lookup, progress=progress)
+
+    assert lookup.call_count == 2
+    assert not places.called
+    assert report["coords"] == 1
+    assert report["coords_coverage"] == 0.4
+    progress.assert_called_with("stopped early: lookup degraded, Wikidata unavailable")
+
+
+def test_throttle(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Calls are spaced by the interval."""
+    clock = mocker.patch.object(warmup.time, "monotonic", return_value=100.0)
+    sleep = mocker.patch.object(warmup.time, "sleep")
+    throttle = warmup.Throttle(rate=2.0)
+
+    throttle.wait()
+    throttle.wait()
+    assert [c.args[0] for c in sleep.call_args_list] == [0.5]
+
+    clock.return_value = 110.0
+    throttle.wait()
+    assert sleep.call_count == 1
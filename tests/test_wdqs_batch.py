@@ -0,0 +1,48 @@
+import pytest_mock
+from geocode import sparql, wikidata
+
+
+def row(key: int, qid: str) -> wikidata.Row:
+    """Batched query result row."""
+    return {
+        "key": {"type": "literal", "value": str(key)},
+        "item": {"type": "uri", "value": f"http://www.wikidata.org/entity/{qid}"},
+    }
+
+
+def test_batch_query() -> None:
+    """Each code is bound with its position in the batch."""
+    query = sparql.gss_batch_query(["E1", "E2"])
+    assert '("0" "E1")' in query and '("1" "E2")' in query
+    query = sparql.name_batch_query([("Crail", 56.26, -2.63)])
+    assert """("0" 'Crail'@en "Point(-2.63 56.26)"^^geo:wktLiteral)""" in query
+
+
+def test_lookup_gss_many(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Codes are fetched in batches and the rows returned to each code."""
+    mocker.patch.object(wikidata, "batch_size", 2)
+    request = mocker.patch.object(
+        wikidata, "wdqs_request", side_effect=[[row(1, "Q2"), row(0, "Q1")], []]
+    )
+
+    results = wikidata.Wikidata().lookup_gss_many(["E1", "E2", "E3"])
+
+    assert request.call_count == 2
+    assert [wikidata.wd_to_qid(r["item"]) for r in results["E1"]] == ["Q1"]
+    assert [wikidata.wd_to_qid(r["item"]) for r in results["E2"]] == ["Q2"]
+    assert results["E3"] == []
+    assert "key" not in results["E1"][0]
+
+
+def test_batch_lookup(mocker: pytest_mock.plugin.MockerFixture) -> None:
+    """Queued keys are fetched with the first key needed, once."""
+    fetch = mocker.Mock(side_effect=lambda keys: {k: [] for k in keys})
+    batch: wikidata.BatchLookup[str] = wikidata.BatchLookup(fetch)
+    batch.add("E1")
+    batch.add("E2")
+    assert not fetch.called
+
+    assert batch.get("E2") == []
+    batch.get("E1")
+    batch.get("E3")
+    assert [c.args[0] for c in fetch.call_args_list] == [["E2", "E1"], ["E3"]]